@@ -0,0 +1,324 @@
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+import sep_phot
+import synthetic_sky
+from ossos_scripts import util
+from ossos_scripts import wcs
+
+'''
+Microbenchmarks for the photometry hot path: sep_phot.sep_phot, append_table, compare_to_catalogue,
+neighbour_search, iden_good_neighbours, check_involvement, wcs.xy2sky/sky2xy and util.match_lists.
+Each case runs on synthetic inputs sized by source count and catalogue size (or on a real stamp, --fixture),
+in its own subprocess so its peak memory (ru_maxrss) is its own.  Results are written as JSON with every timing
+sample and summary statistics, e.g.
+    python benchmark_phot.py --sources 100 1000 --catalogue 1000 10000 --output before.json
+'''
+
+CASES = ['sep_phot', 'append_table', 'compare_to_catalogue', 'neighbour_search', 'iden_good_neighbours',
+         'check_involvement', 'xy2sky', 'sky2xy', 'match_lists']
+CCD_SHAPE = synthetic_sky.CCD_SHAPE
+ZEROPOINT = 26.0
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Time the photometry functions on synthetic inputs and write the timings as JSON.')
+    parser.add_argument("--cases",
+                        nargs='+',
+                        default=CASES,
+                        choices=CASES,
+                        help='Cases to run, default all.')
+    parser.add_argument("--sources",
+                        nargs='+',
+                        type=int,
+                        default=[100, 1000],
+                        help='Source counts to run each case with.')
+    parser.add_argument("--catalogue",
+                        nargs='+',
+                        type=int,
+                        default=[1000, 10000],
+                        help='Catalogue sizes to run each case with.')
+    parser.add_argument("--repeat", '-r',
+                        type=int,
+                        default=5,
+                        help='Timed runs per case, after one untimed warm up run.')
+    parser.add_argument("--seed",
+                        type=int,
+                        default=42,
+                        help='Random seed for the synthetic inputs.')
+    parser.add_argument("--fixture",
+                        default=None,
+                        help='A real stamp (FITS) to run sep_phot on in place of the synthetic image.')
+    parser.add_argument("--output", '-o',
+                        default='benchmark_phot.json',
+                        help='JSON file to write the results to.')
+    parser.add_argument("--child",
+                        nargs=3,
+                        default=None,
+                        metavar=('CASE', 'SOURCES', 'CATALOGUE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        case, n_sources, n_catalogue = args.child
+        result = run_case(case, int(n_sources), int(n_catalogue), args.repeat, args.seed, args.fixture)
+        sys.stdout.write(json.dumps(result) + '\n')
+        return
+
+    results = []
+    for case in args.cases:
+        for n_sources in args.sources:
+            # the catalogue only matters to the cases that search one
+            for n_catalogue in (args.catalogue if case in ('compare_to_catalogue', 'match_lists') else [0]):
+                result = run_in_subprocess(case, n_sources, n_catalogue, args.repeat, args.seed, args.fixture)
+                results.append(result)
+                if 'error' in result:
+                    print "{:<22} sources={:<6} catalogue={:<6} FAILED: {}".format(case, n_sources, n_catalogue,
+                                                                                  result['error'])
+                else:
+                    print "{:<22} sources={:<6} catalogue={:<6} median {:.4f} s  peak {:.1f} MB".format(
+                        case, n_sources, n_catalogue, result['timing']['median'], result['peak_rss_kb'] / 1024.0)
+
+    with open(args.output, 'w') as outfile:
+        json.dump({'meta': metadata(args), 'results': results}, outfile, indent=1)
+    print "----- Wrote {} results to {} -----".format(len(results), args.output)
+
+
+def metadata(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'fixture': args.fixture}
+
+
+def run_in_subprocess(case, n_sources, n_catalogue, repeat, seed, fixture=None):
+    '''
+    Run one case in a fresh interpreter, so the peak memory reported is that of the case alone.
+    '''
+    command = [sys.executable, os.path.abspath(__file__), '--child', case, str(n_sources), str(n_catalogue),
+               '--repeat', str(repeat), '--seed', str(seed)]
+    if fixture is not None:
+        command += ['--fixture', os.path.abspath(fixture)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        return {'case': case, 'sources': n_sources, 'catalogue': n_catalogue,
+                'error': err.strip().splitlines()[-1] if err.strip() else 'exit {}'.format(process.returncode)}
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes on Linux
+    return rss / 1024.0 if sys.platform == 'darwin' else float(rss)
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    n = len(ordered)
+    mean = sum(ordered) / n
+    return {'n': n,
+            'min': ordered[0],
+            'max': ordered[-1],
+            'mean': mean,
+            'median': ordered[n // 2] if n % 2 else 0.5 * (ordered[n // 2 - 1] + ordered[n // 2]),
+            'p90': ordered[min(n - 1, int(math.ceil(0.9 * n)) - 1)],
+            'stdev': math.sqrt(sum((t - mean) ** 2 for t in ordered) / n)}
+
+
+def run_case(case, n_sources, n_catalogue, repeat, seed, fixture=None):
+    '''
+    Time one case: setup builds fresh inputs for every run (several of the functions modify them), only the call
+    itself is timed.  The functions print as they go, that output is discarded.
+    '''
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    try:
+        os.chdir(workdir)
+        sys.stdout = open(os.devnull, 'w')
+        setup = SETUPS[case]
+        rng = np.random.RandomState(seed)
+        call = setup(rng, n_sources, n_catalogue, fixture)
+        setup_rss = peak_rss_kb()
+        call()  # warm up
+        samples = []
+        for i in range(repeat):
+            call = setup(np.random.RandomState(seed), n_sources, n_catalogue, fixture)
+            gc.collect()
+            start = timeit.default_timer()
+            call()
+            samples.append(timeit.default_timer() - start)
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return {'case': case,
+            'sources': n_sources,
+            'catalogue': n_catalogue,
+            'samples': samples,
+            'timing': summarize(samples),
+            'setup_rss_kb': setup_rss,
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def synthetic_sources(rng, n_sources, pvwcs, shape=CCD_SHAPE):
+    '''
+    A sep_phot style source table (x, y, flux, a, b, theta) with ra, dec and mag filled in.
+    '''
+    x = rng.uniform(10, shape[1] - 10, n_sources)
+    y = rng.uniform(10, shape[0] - 10, n_sources)
+    flux = 10 ** rng.uniform(2, 5, n_sources)
+    b = rng.uniform(1.0, 3.0, n_sources)
+    a = b + rng.exponential(1.0, n_sources)
+    theta = rng.uniform(-math.pi / 2, math.pi / 2, n_sources)
+    table = Table([x, y, flux, a, b, theta], names=('x', 'y', 'flux', 'a', 'b', 'theta'))
+    ra, dec = zip(*[pvwcs.xy2sky(x[i], y[i]) for i in range(n_sources)])
+    table['ra'] = ra
+    table['dec'] = dec
+    table['mag'] = -2.5 * np.log10(flux) + ZEROPOINT
+    return table
+
+
+def write_photcat(rng, n_catalogue, sources, directory='catalogue'):
+    '''
+    Write a catalogue of n_catalogue stars split over the four photcat files compare_to_catalogue reads; half of
+    them are the sources themselves, so both the matched and the unmatched paths get exercised.
+    '''
+    n_matched = min(len(sources) // 2, n_catalogue)
+    ra = np.concatenate([np.array(sources['ra'][:n_matched]),
+                         rng.uniform(min(sources['ra']), max(sources['ra']), n_catalogue - n_matched)])
+    dec = np.concatenate([np.array(sources['dec'][:n_matched]),
+                          rng.uniform(min(sources['dec']), max(sources['dec']), n_catalogue - n_matched)])
+    mag = np.concatenate([np.array(sources['mag'][:n_matched]), rng.uniform(16, 24, n_catalogue - n_matched)])
+    synthetic_sky.write_photcat(directory, zip(ra, dec, mag))
+
+
+def synthetic_image(rng, n_sources, sigma=1.5, sky=1000.0):
+    '''
+    Gaussian stars on a flat noisy sky, the image grows with the source count to keep the density constant.
+    '''
+    side = max(256, int(math.sqrt(n_sources) * 40))
+    data = rng.normal(sky, math.sqrt(sky), (side, side)).astype(np.float32)
+    half = int(4 * sigma) + 1
+    yy, xx = np.mgrid[-half:half + 1, -half:half + 1]
+    for x, y, flux in zip(rng.uniform(half, side - half - 1, n_sources), rng.uniform(half, side - half - 1, n_sources),
+                          10 ** rng.uniform(3, 5, n_sources)):
+        ix, iy = int(x), int(y)
+        psf = np.exp(-((xx + ix - x) ** 2 + (yy + iy - y) ** 2) / (2 * sigma ** 2))
+        data[iy - half:iy + half + 1, ix - half:ix + half + 1] += flux * psf / psf.sum()
+    return data
+
+
+def setup_sep_phot(rng, n_sources, n_catalogue, fixture=None):
+    if fixture is not None:
+        with fits.open(fixture) as hdulist:
+            data = hdulist[0].data.astype(np.float32)
+    else:
+        data = synthetic_image(rng, n_sources)
+    return lambda: sep_phot.sep_phot(data, 10.0, 3.5)
+
+
+def setup_append_table(rng, n_sources, n_catalogue, fixture=None):
+    pvwcs = wcs.WCS(synthetic_sky.pv_header(150.0, 10.0))
+    table = synthetic_sources(rng, n_sources, pvwcs)
+    table.remove_columns(['ra', 'dec', 'mag'])
+    return lambda: sep_phot.append_table(table, pvwcs, ZEROPOINT)
+
+
+def setup_compare_to_catalogue(rng, n_sources, n_catalogue, fixture=None):
+    pvwcs = wcs.WCS(synthetic_sky.pv_header(150.0, 10.0))
+    table = synthetic_sources(rng, n_sources, pvwcs)
+    write_photcat(rng, n_catalogue, table)
+    return lambda: sep_phot.compare_to_catalogue(table, pvwcs)
+
+
+def setup_neighbour_search(rng, n_sources, n_catalogue, fixture=None):
+    pvwcs = wcs.WCS(synthetic_sky.pv_header(150.0, 10.0))
+    table = synthetic_sources(rng, n_sources, pvwcs)
+    return lambda: sep_phot.neighbour_search(table, pvwcs, 50.0, table['ra'][0], table['dec'][0])
+
+
+def setup_iden_good_neighbours(rng, n_sources, n_catalogue, fixture=None):
+    pvwcs = wcs.WCS(synthetic_sky.pv_header(150.0, 10.0))
+    table = synthetic_sources(rng, n_sources, pvwcs)
+    if not os.path.isdir('asteroid_families/temp_phot_files'):
+        os.makedirs('asteroid_families/temp_phot_files')
+    i_list = range(n_sources)
+    mag_list_jpl = [19.0, 20.0, 21.0]
+    return lambda: sep_phot.iden_good_neighbours('1616690p', i_list, table, ZEROPOINT, mag_list_jpl, 30.0, 20.0,
+                                                 287.0, pvwcs)
+
+
+def setup_check_involvement(rng, n_sources, n_catalogue, fixture=None):
+    pvwcs = wcs.WCS(synthetic_sky.pv_header(150.0, 10.0))
+    table = synthetic_sources(rng, n_sources, pvwcs)
+    objectdata = table[:1]
+    return lambda: sep_phot.check_involvement(objectdata, table, 2.0)
+
+
+def setup_xy2sky(rng, n_sources, n_catalogue, fixture=None):
+    pvwcs = wcs.WCS(synthetic_sky.pv_header(150.0, 10.0))
+    x = rng.uniform(1, CCD_SHAPE[1], n_sources)
+    y = rng.uniform(1, CCD_SHAPE[0], n_sources)
+    return lambda: [pvwcs.xy2sky(x[i], y[i]) for i in range(n_sources)]
+
+
+def setup_sky2xy(rng, n_sources, n_catalogue, fixture=None):
+    pvwcs = wcs.WCS(synthetic_sky.pv_header(150.0, 10.0))
+    table = synthetic_sources(rng, n_sources, pvwcs)
+    ra = np.array(table['ra'])
+    dec = np.array(table['dec'])
+    return lambda: [pvwcs.sky2xy(ra[i], dec[i]) for i in range(n_sources)]
+
+
+def setup_match_lists(rng, n_sources, n_catalogue, fixture=None):
+    # match_lists indexes with int16
+    n_sources = min(n_sources, 32767)
+    n_catalogue = min(n_catalogue, 32767)
+    n_matched = min(n_sources, n_catalogue) // 2
+    pos1 = rng.uniform(0, CCD_SHAPE[1], (n_sources, 2))
+    pos2 = np.concatenate([pos1[:n_matched] + rng.normal(0, 0.2, (n_matched, 2)),
+                           rng.uniform(0, CCD_SHAPE[1], (n_catalogue - n_matched, 2))])
+    return lambda: util.match_lists(pos1, pos2, tolerance=1.0)
+
+
+SETUPS = {'sep_phot': setup_sep_phot,
+          'append_table': setup_append_table,
+          'compare_to_catalogue': setup_compare_to_catalogue,
+          'neighbour_search': setup_neighbour_search,
+          'iden_good_neighbours': setup_iden_good_neighbours,
+          'check_involvement': setup_check_involvement,
+          'xy2sky': setup_xy2sky,
+          'sky2xy': setup_sky2xy,
+          'match_lists': setup_match_lists}
+
+
+if __name__ == '__main__':
+    main()
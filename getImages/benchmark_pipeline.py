@@ -0,0 +1,349 @@
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+
+import standin_server
+import synthetic_sky
+
+'''
+End-to-end throughput benchmark: runs the do_all flow over a fixed synthetic family against the local stand-in
+services and reports stamps per second, requests per stamp, CPU seconds per stamp, peak RSS and the time in each
+stage.
+Every run is appended to a history file and compared against a stored baseline; the exit status is 1 when a
+metric is worse than the baseline by more than --threshold, so it can gate changes before a full-belt run, e.g.
+    python benchmark_pipeline.py --update-baseline      # once, on a known good commit
+    python benchmark_pipeline.py                        # after a change
+The fixture (exposures, catalogue, Horizons responses, image lists) is generated once into --fixture-dir and
+copied afresh for every run, so runs start with cold caches and an empty stamp directory.
+'''
+
+FAMILY = 'BENCH'
+STAGES = [('exists', 'ossos_scripts.storage', 'exists_many'),
+          ('cutout', 'do_all', 'cutout'),
+          ('prefetch', 'do_all', 'fetch_inputs'),
+          ('photometry', 'do_all', 'measure'),
+          ('upload', 'ossos_scripts.upload_queue', 'flush')]
+# metric: True if larger is better
+METRICS = {'stamps_per_second': True,
+           'requests_per_stamp': False,
+           'cpu_per_stamp': False,
+           'peak_rss_kb': False}
+HORIZONS_HEADER = ' Date__(UT)__HR:MN, , , APmag, RA_3sigma, DEC_3sigma, R.A._(ICRF/J2000.0), DEC_(ICRF/J2000.0), ' \
+                  'dRA*cosD, d(DEC)/dt,\n'
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the do_all flow against the stand-in services and check it for regressions.')
+    parser.add_argument("--objects", '-n',
+                        type=int,
+                        default=20,
+                        help='Number of objects (one exposure each) in the fixture family.')
+    parser.add_argument("--exposure-size",
+                        type=int,
+                        default=1024,
+                        help='Width and height, in pixels, of the fixture exposures.')
+    parser.add_argument("--runs",
+                        type=int,
+                        default=1,
+                        help='Number of runs, the best is kept.')
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.0,
+                        help='Latency the stand-in adds to every request, seconds.')
+    parser.add_argument("--seed",
+                        type=int,
+                        default=1,
+                        help='Seed of the fixture.')
+    parser.add_argument("--fixture-dir",
+                        default='benchmark_fixture',
+                        help='Where the fixture is generated and kept between runs.')
+    parser.add_argument("--history",
+                        default='benchmark_history.jsonl',
+                        help='File every result is appended to, one JSON object per line.')
+    parser.add_argument("--baseline",
+                        default='benchmark_baseline.json',
+                        help='Result to compare against.')
+    parser.add_argument("--update-baseline",
+                        action='store_true',
+                        help='Store this result as the baseline instead of comparing against it.')
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=0.10,
+                        help='Fractional worsening of a metric counted as a regression.')
+    parser.add_argument("--child",
+                        default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        sys.stdout.write(json.dumps(run_child(args.child)) + '\n')
+        return
+
+    build_fixture(args.fixture_dir, args.objects, args.exposure_size, args.seed)
+    results = [run_once(args.fixture_dir, args.latency) for i in range(args.runs)]
+    result = max(results, key=lambda r: r['stamps_per_second'])
+    result['meta'] = metadata(args)
+    report(result)
+
+    with open(args.history, 'a') as outfile:
+        outfile.write(json.dumps(result) + '\n')
+
+    if args.update_baseline or not os.access(args.baseline, os.R_OK):
+        with open(args.baseline, 'w') as outfile:
+            json.dump(result, outfile, indent=1)
+        print "----- Stored as the baseline in {} -----".format(args.baseline)
+        return
+
+    with open(args.baseline) as infile:
+        baseline = json.load(infile)
+    regressions = compare(result, baseline, args.threshold)
+    for regression in regressions:
+        print "REGRESSION: {}".format(regression)
+    if len(regressions) > 0:
+        sys.exit(1)
+    print "----- No regression beyond {:.0%} of the baseline ({}) -----".format(args.threshold,
+                                                                          baseline['meta'].get('commit'))
+
+
+def metadata(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'objects': args.objects,
+            'exposure_size': args.exposure_size,
+            'latency': args.latency,
+            'seed': args.seed}
+
+
+def compare(result, baseline, threshold):
+    '''
+    The metrics of result worse than baseline by more than threshold, as messages.
+    '''
+    regressions = []
+    for metric, larger_is_better in sorted(METRICS.items()):
+        new = result.get(metric)
+        old = baseline.get(metric)
+        if new is None or not old:
+            continue
+        change = (new - old) / float(old)
+        if (larger_is_better and change < -threshold) or (not larger_is_better and change > threshold):
+            regressions.append("{} {:.4g} -> {:.4g} ({:+.1%})".format(metric, old, new, change))
+    return regressions
+
+
+def report(result):
+    print "----- {} stamps in {:.2f} s: {:.2f} stamps/s, {:.1f} requests/stamp, {:.2f} CPU s/stamp, " \
+          "peak RSS {:.1f} MB -----".format(result['stamps'], result['wall'], result['stamps_per_second'],
+                                            result['requests_per_stamp'], result['cpu_per_stamp'],
+                                            result['peak_rss_kb'] / 1024.0)
+    # the stages run side by side on several threads: their seconds overlap, CPU is only known for the whole process
+    print "  seconds in each stage, summed over the threads running it:"
+    for name, stage in sorted(result['stages'].items()):
+        print "  {:<12} {:>5} calls  {:8.2f} s".format(name, stage['calls'], stage['seconds'])
+    for name, stage in sorted(result['metrics']['stages'].items()):
+        print "  {:<20} {:>5} calls  {:8.2f} s  (longest {:.2f} s)".format(name, stage['calls'], stage['seconds'],
+                                                                         stage['max_seconds'])
+    for endpoint, count in sorted(result['endpoints'].items()):
+        print "  {:<12} {:>5} requests".format(endpoint, count)
+
+
+def build_fixture(fixture_dir, n_objects, size, seed):
+    '''
+    Generate the family, once: one exposure per object in the stand-in's dbimages, the Horizons responses
+    placing each object on its exposure, the photcat catalogue of the stars drawn, and the family and image lists.
+    '''
+    marker = os.path.join(fixture_dir, 'fixture.json')
+    params = {'objects': n_objects, 'size': size, 'seed': seed}
+    if os.access(marker, os.R_OK):
+        with open(marker) as infile:
+            if json.load(infile) == params:
+                return
+        shutil.rmtree(fixture_dir)
+    print "----- Generating the benchmark fixture in {} -----".format(fixture_dir)
+
+    work = os.path.join(fixture_dir, 'work')
+    standin = os.path.join(fixture_dir, 'standin')
+    family_dir = os.path.join(work, 'asteroid_families', FAMILY)
+    for directory in (os.path.join(family_dir, '{}_stamps'.format(FAMILY)), os.path.join(standin, 'horizons'),
+                      os.path.join(standin, 'vospace', 'kawebb', 'postage_stamps', FAMILY)):
+        os.makedirs(directory)
+
+    rng = np.random.RandomState(seed)
+    results = []
+    stars = []
+    for i in range(n_objects):
+        rate = rng.uniform(10.0, 60.0)
+        angle = rng.uniform(0, 2 * math.pi)
+        obj = {'name': 'B{:05d}'.format(i), 'mag': rng.uniform(18.0, 20.5),
+               'ra_rate': rate * math.cos(angle), 'dec_rate': rate * math.sin(angle),
+               'ra': 150.0 + rng.uniform(-1, 1), 'dec': 10.0 + rng.uniform(-1, 1), 'coma': False, 'tail': False}
+        spec = {'index': i, 'seed': seed * 1000003 + i, 'object': obj, 'expnum': '{}p'.format(1800000 + i),
+                'mjd': 57000.0 + i * 0.05, 'size': size, 'star_density': 1.0, 'fwhm': 0.7, 'sky': 1000.0,
+                'read_noise': 5.0, 'exptime': 287.0, 'zeropoint': 26.0}
+        hdu, truth, drawn = synthetic_sky.render_stamp(spec)
+        stars.extend(drawn)
+        expnum = spec['expnum'][:-1]
+        header = hdu.header.copy()
+        header['EXTNAME'] = 'ccd00'
+        dbimages = os.path.join(standin, 'vospace', 'OSSOS', 'dbimages', expnum)
+        os.makedirs(dbimages)
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data=hdu.data, header=header)]).writeto(
+            os.path.join(dbimages, '{}.fits'.format(spec['expnum'])))
+        write_horizons(os.path.join(standin, 'horizons', '{}.txt'.format(obj['name'])), spec, truth)
+        truth['file'] = ''
+        results.append({'index': i, 'truth': truth, 'mjd': spec['mjd'], 'exptime': spec['exptime'], 'stars': []})
+
+    synthetic_sky.write_photcat(os.path.join(work, 'catalogue'), stars)
+    synthetic_sky.write_image_list(os.path.join(family_dir, '{}_images.txt'.format(FAMILY)), results)
+    synthetic_sky.write_truth(os.path.join(family_dir, '{}_truth.txt'.format(FAMILY)), results)
+    with open(os.path.join(family_dir, '{}_family.txt'.format(FAMILY)), 'w') as outfile:
+        outfile.write('\n'.join(result['truth']['Object'] for result in results) + '\n')
+    with open(marker, 'w') as outfile:
+        json.dump(params, outfile)
+
+
+def _sexagesimal(value, hours=False):
+    sign = '-' if value < 0 else '+'
+    value = abs(value) / (15.0 if hours else 1.0)
+    d = int(value)
+    m = int((value - d) * 60)
+    s = ((value - d) * 60 - m) * 60
+    if hours:
+        return '{:02d} {:02d} {:05.2f}'.format(d, m, s)
+    return '{}{:02d} {:02d} {:04.1f}'.format(sign, d, m, s)
+
+
+def write_horizons(filename, spec, truth):
+    '''
+    A Horizons batch response with the columns both sep_phot queries read, placing the object at its position
+    on the exposure in the middle row.
+    '''
+    with open(filename, 'w') as outfile:
+        outfile.write('*' * 79 + '\n')
+        outfile.write(HORIZONS_HEADER)
+        outfile.write('*' * 79 + '\n')
+        outfile.write('$$SOE\n')
+        for offset in (-1, 0, 1):
+            date = Time(spec['mjd'] + offset / 1440.0, format='mjd', scale='utc').datetime.strftime('%Y-%b-%d %H:%M')
+            outfile.write(' {}, , , {:.3f}, 0.500, 0.500, {}, {}, {:.4f}, {:.4f},\n'.format(
+                date, truth['mag'], _sexagesimal(truth['RA'], hours=True), _sexagesimal(truth['DEC']),
+                truth['ra_rate'], truth['dec_rate']))
+        outfile.write('$$EOE\n')
+
+
+def run_once(fixture_dir, latency=0.0):
+    '''
+    Copy the fixture, serve it with the stand-in and run the do_all flow on it in a child process.
+    '''
+    run_dir = tempfile.mkdtemp()
+    try:
+        work = os.path.join(run_dir, 'work')
+        standin = os.path.join(run_dir, 'standin')
+        shutil.copytree(os.path.join(fixture_dir, 'work'), work)
+        shutil.copytree(os.path.join(fixture_dir, 'standin'), standin)
+        server = standin_server.start_in_thread(standin, latency=latency)
+        env = dict(os.environ)
+        # VOSPACE_WEBSERVICE too, services.py leaves it alone if the environment already has one
+        env.update({'OSSOS_STANDIN': server.url,
+                    'VOSPACE_WEBSERVICE': server.url.split('://', 1)[1],
+                    'HOME': run_dir,
+                    'OSSOS_HEADER_CACHE': os.path.join(run_dir, 'header_cache'),
+                    'OSSOS_UPLOAD_JOURNAL': os.path.join(run_dir, 'upload_journal')})
+        env.pop('OSSOS_RECORD', None)
+        env.pop('OSSOS_REPLAY', None)
+        try:
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', work], env=env,
+                                       stdout=subprocess.PIPE)
+            out, _ = process.communicate()
+        finally:
+            server.shutdown()
+            server.server_close()
+        if process.returncode != 0:
+            raise RuntimeError("The benchmark run failed with exit status {}".format(process.returncode))
+        result = json.loads(out.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(run_dir)
+    stamps = max(1, result['stamps'])
+    result['requests'] = server.stats['requests']
+    result['request_bytes'] = server.stats['bytes']
+    result['endpoints'] = server.stats['endpoints']
+    result['stamps_per_second'] = result['stamps'] / result['wall']
+    result['requests_per_stamp'] = server.stats['requests'] / float(stamps)
+    result['cpu_per_stamp'] = result['cpu'] / stamps
+    return result
+
+
+def _cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_child(work):
+    '''
+    Run do_all_things on the fixture, timing the calls of each stage and the CPU and wall clock of the whole run.
+    '''
+    os.chdir(work)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import do_all
+    from ossos_scripts import metrics
+
+    stages = {}
+    lock = threading.Lock()
+
+    # do_all runs the stages side by side on several threads, so the CPU of the process while a stage ran is not that
+    # of the stage: only the time in its calls is kept, CPU is measured for the whole run
+    def timed(name, function):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with lock:
+                    stage = stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+                    stage['calls'] += 1
+                    stage['seconds'] += time.time() - start
+        return wrapper
+
+    for name, module_name, attribute in STAGES:
+        module = sys.modules[module_name]
+        setattr(module, attribute, timed(name, getattr(module, attribute)))
+
+    stdout = sys.stdout
+    sys.stdout = sys.stderr  # the pipeline's own output, keep stdout for the result
+    cpu, wall = _cpu(), time.time()
+    try:
+        do_all.do_all_things(FAMILY, username='benchmark', password='benchmark')
+    finally:
+        sys.stdout = stdout
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'stamps': stages.get('photometry', {}).get('calls', 0),
+            'wall': time.time() - wall,
+            'cpu': _cpu() - cpu,
+            'stages': stages,
+            'metrics': metrics.snapshot(),
+            'peak_rss_kb': rss / 1024.0 if sys.platform == 'darwin' else float(rss)}
+
+
+if __name__ == '__main__':
+    main()
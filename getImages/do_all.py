@@ -1,14 +1,17 @@
 import argparse
 import os
 import getpass
-import pandas as pd
 
 from find_family import find_family_members
-from find_family import get_all_families_list
-from get_images import get_image_info
-from get_stamps import get_stamps, cutout
-from sep_phot import iterate_thru_images
+from get_images import get_image_info, read_image_list
+from get_stamps import cutout
+from sep_phot import iterate_thru_images, fetch_inputs, measure, print_output
 from ossos_scripts import storage
+from ossos_scripts import cadc_session
+from ossos_scripts import upload_queue
+from ossos_scripts import taskgraph
+from ossos_scripts import stream
+from ossos_scripts import profiling
 
 def main():
     """
@@ -50,68 +53,149 @@ def main():
                     help='threshold value.')
     parser.add_argument("--object", '-obj',
                     action='store',
-                    default='54286',
-                    help='the object to preform photometry on')
+                    default='all',
+                    help='the object to preform photometry on, all for every object in the image list')
+    parser.add_argument("--workers", '-w',
+                    action='store',
+                    type=int,
+                    default=4,
+                    help='Number of threads cutting out stamps and querying Horizons.')
+    parser.add_argument("--cpu-workers",
+                    action='store',
+                    type=int,
+                    default=1,
+                    help='Number of threads doing the photometry.')
+    parser.add_argument("--prefetch",
+                    action='store',
+                    type=int,
+                    default=8,
+                    help='Stamps fetched ahead of the photometry, raise it if the photometry stage is starved.')
+    parser.add_argument("--state",
+                    action='store',
+                    default=None,
+                    help='sqlite database of finished tasks, default asteroid_families/<family>/<family>_state.sqlite')
+    parser.add_argument("--force",
+                    action='store_true',
+                    help='Run every task again, even those already done.')
+    profiling.add_arguments(parser)
                             
     args = parser.parse_args()
+    profiling.from_args(args)
 
-    do_all_things(args.family, args.object, args.filter, args.type, args.radius, args.aperture, args.thresh)
+    do_all_things(args.family, args.object, args.filter, args.type, float(args.radius), float(args.aperture),
+                  float(args.thresh), workers=args.workers, state_path=args.state, force=args.force,
+                  cpu_workers=args.cpu_workers, prefetch_depth=args.prefetch)
 
-def do_all_things(familyname, objectname=None, filtertype='r', imagetype='p', radius=0.01, aperture=10.0, thresh=5.0):
+def do_all_things(familyname, objectname=None, filtertype='r', imagetype='p', radius=0.01, aperture=10.0, thresh=5.0,
+                  username=None, password=None, workers=4, state_path=None, force=False, cpu_workers=1, prefetch_depth=8):
+    '''
+    Run family lookup -> image search -> stamps -> photometry as a task graph. Finished tasks are kept in a sqlite
+    database next to the family files, a rerun only does what is left and what failed last time. The stamps and
+    photometry run as a stream: workers threads cut out stamps and query Horizons while cpu_workers threads do SEP.
+    '''
    
-    username = raw_input("CADC username: ")
-    password = getpass.getpass("CADC password: ")
-    
-    family_list_path = 'asteroid_families/{}/{}_family.txt'.format(familyname, familyname)
+    if username is None:
+        username = raw_input("CADC username: ")
+        password = getpass.getpass("CADC password: ")
+    cadc_session.login(username, password)
     
-    if  os.path.exists(family_list_path):
-        print "----- List of objects in family {} exists already -----".format(familyname)
-        with open(family_list_path) as infile:
-            filestr = infile.read()
-            all_object_list = filestr.split('\n')
-    else:    
-        all_object_list = find_family_members(familyname)
+    family_dir = 'asteroid_families/{}'.format(familyname)
+    family_list_path = '{}/{}_family.txt'.format(family_dir, familyname)
+    image_list_path = '{}/{}_images.txt'.format(family_dir, familyname)
+    if state_path is None:
+        state_path = '{}/{}_state.sqlite'.format(family_dir, familyname)
+    state = taskgraph.StateDB(state_path)
     
+    # the image list decides which stamps there are, so the graph is run in two passes
+    graph = taskgraph.TaskGraph(state, workers=workers)
+    graph.add(taskgraph.Task('family:{}'.format(familyname), find_family_members, (familyname,),
+                             outputs=[family_list_path]))
+    graph.add(taskgraph.Task('images:{}'.format(familyname), get_image_info, (familyname, filtertype, imagetype),
+                             requires=['family:{}'.format(familyname)], outputs=[image_list_path]))
+    counts = graph.run(force=force)
+    if not os.path.exists(image_list_path):
+        print "ERROR: no list of images for family {}, {}".format(familyname, counts)
+        return counts
     
     out_filename = '{}_r{}_t{}_output.txt'.format(familyname, aperture, thresh)
-    with open('asteroid_families/{}/{}_stamps/{}'.format(familyname, familyname, out_filename), 'w') as outfile:
-        outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format('Object', "Image", 'flux', 'mag', 'RA', 'DEC', 'ecc', 'index'))
+    out_path = '{}/{}_stamps/{}'.format(family_dir, familyname, out_filename)
+    if force or not os.path.exists(out_path):
+        # photometry appends to it, a resumed run keeps what is there
+        if not os.path.isdir(os.path.dirname(out_path)):
+            os.makedirs(os.path.dirname(out_path))
+        with open(out_path, 'w') as outfile:
+            outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format('Object', "Image", 'flux', 'mag', 'RA', 'DEC', 'ecc', 'index'))
     
-
-    image_list_path = 'asteroid_families/{}/{}_images_test.txt'.format(familyname, familyname) # USING TEST FILE
-    print "WARNING: USING A TEST FILE ***************************************************************" 
-    if  os.path.exists(image_list_path):
-        table = pd.read_table(image_list_path, usecols=[0, 1, 3, 4], header=0, names=['Object', 'Image', 'RA', 'DEC'], sep=' ', dtype={'Object':object})
-        for row in range(0,4):#len(table)):
-            print '\n----- Searching for {} {} -----'.format(table['Object'][row], table['Image'][row])
-            vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
-            postage_stamp_filename = "{}_{}_{:8f}_{:8f}.fits".format(table['Object'][row], table['Image'][row], table['RA'][row], table['DEC'][row])
-            if storage.exists('{}/{}'.format(vos_dir, postage_stamp_filename)) == True:
-                print "-- Stamp already exists"
-            else:
-                cutout(table['Object'][row], table['Image'][row], table['RA'][row], table['DEC'][row], radius, username, password, familyname)
-                
-            object_data = iterate_thru_images(familyname, str(table['Object'][row]), table['Image'][row], username, password, aperture, thresh, filtertype, imagetype)
-    else:  
-        go_the_long_way(familyname, filtertype, imagetype)
-
-def go_the_long_way(familyname, filtertype, imagetype):
-        
-    image_list, expnum_list, ra_list, dec_list = get_image_info(familyname, filtertype, imagetype) 
+    vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
+    if not storage.exists_many([vos_dir], force=True)[vos_dir]:
+        storage.mkdir(vos_dir)
     
-    for index, objectname in enumerate(image_list):
-        
-        print '\n----- Searching for {} {} -----'.format(objectname, expnum_list[index])
-        
-        vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
-        postage_stamp_filename = "{}_{}_{:8f}_{:8f}.fits".format(objectname, expnum_list[index], ra_list[index], dec_list[index])
-        if storage.exists('{}/{}'.format(vos_dir, postage_stamp_filename)) == True:
-            print "-- Stamp already exists"
+    graph = taskgraph.TaskGraph(state, workers=workers)
+    for name, expnum, ra, dec, ext in read_image_list(image_list_path):
+        if objectname is not None and objectname != 'all' and name != objectname:
+            continue
+        uri = "{}/{}_{}_{:8f}_{:8f}.fits".format(vos_dir, name, expnum, ra, dec)
+        stamp_task = 'stamp:{}'.format(os.path.basename(uri))
+        phot_task = 'photometry:{}:{}'.format(name, expnum)
+        if stamp_task in graph.tasks:
+            continue
+        graph.add(taskgraph.Task(stamp_task, cutout, (name, expnum, ra, dec, radius, username, password, familyname),
+                                 {'ext': ext}, outputs=[uri]))
+        if phot_task in graph.tasks:
+            graph.tasks[phot_task].requires.append(stamp_task)
         else:
-            cutout(objectname, expnum_list[index], ra_list[index], dec_list[index], radius, username, password, familyname)
-                
-        object_data = iterate_thru_images(familyname, objectname, expnum_list[index], username, password, aperture, thresh, filtertype, imagetype)  
+            graph.add(taskgraph.Task(phot_task, iterate_thru_images,
+                                     (familyname, name, expnum, username, password, aperture, thresh, filtertype,
+                                      imagetype), requires=[stamp_task]))
+    
+    # stream the photometry: stamps and Horizons are prefetched on workers threads, at most prefetch ahead of the
+    # CPU bound SEP and matching, and one thread writes the output
+    pending = graph.pending(force=force)
+    to_run = set(pending)
+    photometry_tasks = [name for name in pending if name.startswith('photometry:')]
+    print "----- {} of {} stamps and photometry tasks to do for family {} -----".format(len(pending), len(graph.tasks), familyname)
+    
+    def prefetch(phot_task):
+        task = graph.tasks[phot_task]
+        for stamp_task in task.requires:
+            if stamp_task in to_run and graph.execute(stamp_task) != taskgraph.DONE:
+                raise IOError("{} failed".format(stamp_task))
+        state.started(phot_task)
+        return phot_task, fetch_inputs(*task.args[:5])
+    
+    def photometry(item):
+        # a task without a result is recorded failed, not done, so the next run tries it again
+        phot_task, inputs = item
+        if inputs is None:
+            raise IOError("no readable stamp for {}".format(phot_task))
+        good_neighbours = measure(inputs, aperture, thresh)
+        if good_neighbours is None:
+            raise ValueError("object not identified in the stamp of {}".format(phot_task))
+        return phot_task, good_neighbours
+    
+    def output(item):
+        phot_task, good_neighbours = item
+        task = graph.tasks[phot_task]
+        print_output(familyname, task.args[1], task.args[2], good_neighbours, aperture, thresh)
+        state.finished(phot_task, taskgraph.DONE)
+    
+    def record_failure(stage, item, error):
+        phot_task = stage.name == 'prefetch' and item or item[0]
+        state.finished(phot_task, taskgraph.FAILED, error=error)
+    
+    stages = stream.run(photometry_tasks, [stream.Stage('prefetch', prefetch, workers),
+                                           stream.Stage('photometry', photometry, cpu_workers, queue_size=prefetch_depth),
+                                           stream.Stage('output', output)], on_error=record_failure, depth=prefetch_depth)
+    print stream.report(stages)
+    counts['skipped'] += len([name for name in graph.tasks if name.startswith('photometry:')]) - len(photometry_tasks)
+    counts[taskgraph.DONE] = counts.get(taskgraph.DONE, 0) + stages[-1].stats['items']
+    counts[taskgraph.FAILED] = counts.get(taskgraph.FAILED, 0) + sum(stage.stats['errors'] for stage in stages)
+    failed = upload_queue.flush()
+    if len(failed) > 0:
+        print "WARNING: {} stamps were not uploaded, they are retried on the next run".format(len(failed))
+    state.close()
+    print "----- Tasks: {} -----".format(', '.join('{} {}'.format(number, status) for status, number in sorted(counts.items())))
+    return counts
                         
 if __name__ == '__main__':
     main()                        
-    
\ No newline at end of file
@@ -0,0 +1,191 @@
+import Queue
+import threading
+import time
+
+import requests
+
+'''
+Parallel download scheduler for cutout requests.
+A bounded pool of worker threads runs the downloads, the bytes held by downloads in flight (or waiting in the
+output queue) are capped so memory stays bounded, transient HTTP failures are retried with backoff and finished
+downloads are streamed to the caller in completion order.
+The number of concurrent downloads adapts AIMD-style: it grows by one each window of downloads whose throughput
+held up, and is halved when CADC starts returning errors or throughput drops.
+'''
+
+MB = 1024 * 1024
+TRANSIENT_STATUS = (408, 429, 500, 502, 503, 504)
+DECREASE = 0.5          # multiplicative decrease of the concurrency limit
+THROUGHPUT_DROP = 0.25  # fractional drop in window throughput treated as congestion
+
+_FED = object()         # marks the end of the submitted jobs in the output queue
+
+
+def is_transient(error):
+    '''
+    True for failures worth retrying: dropped connections, timeouts, throttling and server errors.
+    '''
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in TRANSIENT_STATUS
+    return False
+
+
+class DownloadScheduler(object):
+    '''
+    Run fetch(job) for many jobs on a worker pool whose active size adapts between min_workers and max_workers.
+    '''
+
+    def __init__(self, fetch, workers=4, min_workers=1, max_workers=16, max_inflight_bytes=256 * MB,
+                 retries=3, backoff=2.0, queue_size=64):
+        self.fetch = fetch
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.max_inflight_bytes = max_inflight_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.limit = float(max(min_workers, min(workers, max_workers)))
+
+        self.active = 0
+        self.pending = 0
+        self.inflight_bytes = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.bytes_done = 0
+
+        self._cond = threading.Condition()
+        self._jobs = Queue.Queue()
+        self.output = Queue.Queue(maxsize=queue_size)
+        self._reset_window(None)
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(target=self._work, name='download-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _reset_window(self, throughput):
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_decreased = False
+        self._last_throughput = throughput
+
+    def submit(self, job, nbytes=0):
+        '''
+        Queue a job expected to download nbytes. Blocks while the in-flight byte cap is reached, a single job
+        bigger than the cap is still let through on its own.
+        '''
+        with self._cond:
+            while self.inflight_bytes > 0 and self.inflight_bytes + nbytes > self.max_inflight_bytes:
+                self._cond.wait()
+            self.inflight_bytes += nbytes
+            self.pending += 1
+        self._jobs.put((job, nbytes, 0))
+
+    def _work(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            job, nbytes, attempt = item
+            with self._cond:
+                while self.active >= int(self.limit):
+                    self._cond.wait()
+                self.active += 1
+
+            result = None
+            error = None
+            try:
+                result = self.fetch(job)
+            except Exception, e:
+                error = e
+
+            with self._cond:
+                self.active -= 1
+                self._adapt(error, nbytes)
+                self._cond.notify_all()
+
+            if error is not None and is_transient(error) and attempt < self.retries:
+                with self._cond:
+                    self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+                self._jobs.put((job, nbytes, attempt + 1))
+                continue
+            self.output.put((job, result, error, nbytes))
+
+    def _adapt(self, error, nbytes):
+        '''
+        AIMD update of the concurrency limit, called with the condition held.
+        '''
+        if error is not None:
+            if is_transient(error) and not self._window_decreased:
+                # at most one decrease per window, the requests already in flight hit the same congestion
+                self.limit = max(self.min_workers, self.limit * DECREASE)
+                self._window_decreased = True
+            return
+        self._window_bytes += nbytes
+        self._window_count += 1
+        if self._window_count < int(self.limit):
+            return
+        elapsed = max(time.time() - self._window_start, 1e-6)
+        throughput = self._window_bytes / elapsed
+        if self._window_decreased:
+            pass
+        elif self._last_throughput is not None and throughput < self._last_throughput * (1 - THROUGHPUT_DROP):
+            self.limit = max(self.min_workers, self.limit * DECREASE)
+        else:
+            self.limit = min(self.max_workers, self.limit + 1)
+        self._reset_window(throughput)
+
+    def _feed(self, jobs):
+        try:
+            for job, nbytes in jobs:
+                self.submit(job, nbytes)
+        finally:
+            self.output.put(_FED)
+
+    def run(self, jobs):
+        '''
+        Download every (job, nbytes) in jobs and yield (job, result, error) as each finishes.
+        error is the exception of a job that failed for good (after retries), result is then None.
+        '''
+        feeder = threading.Thread(target=self._feed, args=(jobs,), name='download-feeder')
+        feeder.daemon = True
+        feeder.start()
+        fed = False
+        while True:
+            with self._cond:
+                if fed and self.pending == 0:
+                    break
+            item = self.output.get()
+            if item is _FED:
+                fed = True
+                continue
+            job, result, error, nbytes = item
+            with self._cond:
+                self.pending -= 1
+                self.inflight_bytes -= nbytes
+                if error is None:
+                    self.completed += 1
+                    self.bytes_done += nbytes
+                else:
+                    self.failed += 1
+                self._cond.notify_all()
+            yield job, result, error
+        feeder.join()
+
+    def close(self):
+        '''
+        Stop the worker threads once the queued jobs are done.
+        '''
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def report(self):
+        print "  Downloads: {} done, {} failed, {} retried, {:.3g} bytes, concurrency {}".format(
+            self.completed, self.failed, self.retried, float(self.bytes_done), int(self.limit))
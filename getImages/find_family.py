@@ -1,5 +1,7 @@
 import numpy as np
-import requests
+from ossos_scripts import cadc_session
+from ossos_scripts import services
+from ossos_scripts import metrics
 import argparse
 import os
 import pandas as pd
@@ -44,6 +46,7 @@ def main():
     parse_for_all(mba_list, args.status, args.fromfile)
     #parse_for_mba(mba_list, args.status)
     
+@metrics.timer(metrics.FAMILY_LOOKUP)
 def find_family_members(familyname, output=None):    
     '''
     Queries the AstDys database for members of specified family, family name is name of largest member
@@ -55,8 +58,8 @@ def find_family_members(familyname, output=None):
     if os.path.isdir(output_dir) == False:
         os.makedirs(output_dir)
     
-    BASEURL = 'http://hamilton.dm.unipi.it/~astdys2/propsynth/numb.members'
-    r = requests.get(BASEURL)
+    BASEURL = services.ASTDYS_URL + '/numb.members'
+    r = cadc_session.get_session().get(BASEURL)
     r.raise_for_status()
     table = r.content
     table_lines = table.split('\n')
@@ -79,6 +82,7 @@ def find_family_members(familyname, output=None):
               
     return asteroid_list
 
+@metrics.timer(metrics.FAMILY_LOOKUP)
 def get_all_families_list(output=None):
     '''
     Queries the AstDys database for members of all known families, family name is name of largest member
@@ -87,8 +91,8 @@ def get_all_families_list(output=None):
     if output == None:
         output = 'all_families.txt'
 
-    BASEURL = 'http://hamilton.dm.unipi.it/~astdys2/propsynth/numb.famtab'
-    r = requests.get(BASEURL)
+    BASEURL = services.ASTDYS_URL + '/numb.famtab'
+    r = cadc_session.get_session().get(BASEURL)
     r.raise_for_status()
     table = r.content
     table_lines = table.split('\n')
@@ -115,8 +119,8 @@ def find_by_status(status=3, output=None):
     with a particular family designation status
     '''
     
-    BASEURL = 'http://hamilton.dm.unipi.it/~astdys2/propsynth/numb.famrec'
-    r = requests.get(BASEURL)
+    BASEURL = services.ASTDYS_URL + '/numb.famrec'
+    r = cadc_session.get_session().get(BASEURL)
     r.raise_for_status()
     table = r.content
     table_lines = table.split('\n')
@@ -156,8 +160,8 @@ def get_all_astrometry(mba_list, status=3):
     
     print '----- Getting astrometry -----'    
     
-    BASEURL = 'http://hamilton.dm.unipi.it/~astdys2/propsynth/numb.syn'
-    r = requests.get(BASEURL)
+    BASEURL = services.ASTDYS_URL + '/numb.syn'
+    r = cadc_session.get_session().get(BASEURL)
     r.raise_for_status()
     table = r.content
     table_lines = table.split('\n')
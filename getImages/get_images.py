@@ -1,13 +1,28 @@
 import datetime
 import os
-from astropy.io import ascii
 from astropy.time import Time
 import requests
 import argparse
-from ossos_scripts.ssos import Query
+from multiprocessing.pool import ThreadPool
+from ossos_scripts.ssos import Query, MAX_CONNECTIONS
+from ossos_scripts.ssos_cache import SSOISCache
+from ossos_scripts import ssos_parser
+from ossos_scripts import profiling
+from ossos_scripts import horizons
+from ossos_scripts import horizons_parser
+from ossos_scripts.footprints import FootprintIndex, locate_objects
+import threading
 import time
+import numpy as np
 import pandas as pd
 
+TELESCOPE_INSTRUMENT = 'CFHT/MegaCam'
+EXPTIMES = [287, 387, 500]  # OSSOS exposure times
+# the columns of parse_ssois_return that get_image_info writes, for images found in a footprint index
+FOOTPRINT_DTYPE = [('Image', 'S16'), ('MJD', np.float64), ('Filter', 'S16'), ('Exptime', np.int64),
+                   ('Object_RA', np.float64), ('Object_Dec', np.float64), ('Ext', np.int64)]
+FOOTPRINT_CHUNK = 200  # objects joined against the footprint index at once
+
 dir_path_base = '/Users/admin/Desktop/MainBeltComets/getImages/asteroid_families'
 
 def main():
@@ -34,15 +49,40 @@ def main():
     parser.add_argument('--suffix',
                         default=None,
                         help="Suffix of object list file")
+    parser.add_argument('--threads',
+                        default=8,
+                        type=int,
+                        help="Number of SSOIS queries to have in flight at once")
+    parser.add_argument('--no-cache',
+                        action='store_false',
+                        dest='cache',
+                        help="Always query SSOIS, do not use or update the local SSOIS cache")
+    parser.add_argument('--offline',
+                        action='store_true',
+                        help="Only use SSOIS results already in the local cache")
+    parser.add_argument('--no-server-filter',
+                        action='store_false',
+                        dest='server_filter',
+                        help="Ask SSOIS for frames from every telescope and filter them all locally")
+    parser.add_argument('--footprints',
+                        default=None,
+                        help="Find the images in this saved footprint index (ossos_scripts.footprints) "
+                             "from the objects' Horizons ephemerides instead of asking SSOIS")
+    profiling.add_arguments(parser)
                         
     args = parser.parse_args()
+    profiling.from_args(args)
             
-    get_image_info(args.family, args.suffix, args.filter, args.type)
+    get_image_info(args.family, args.filter, args.type, suffix=args.suffix, threads=args.threads,
+                   cache=args.cache, offline=args.offline, server_filter=args.server_filter,
+                   footprints=args.footprints)
 
-def get_image_info(familyname, filtertype='r', imagetype='p', suffix=None):
+def get_image_info(familyname, filtertype='r', imagetype='p', suffix=None, threads=8, cache=True, offline=False,
+                   server_filter=True, footprints=None):
     '''
     Query the ssois ephemeris for images of objects in a given family. Then parse through for desired image type, 
-    filter, exposure time, and telescope instrument
+    filter, exposure time, and telescope instrument. Given the file of a saved footprint index, the images are looked
+    up in it instead, see query_footprints.
     CADC : search = bynameCADC , MPC : search = bynameMPC
     ephemeris, name, date range, resolve image extension, resolve to x,y, positional uncertainty?
     http:// www3.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/cadcbin/ssos/ssosclf.pl?lang=en; object=elst-pizarro; 
@@ -76,8 +116,8 @@ def get_image_info(familyname, filtertype='r', imagetype='p', suffix=None):
     
     # Setup output, label columns
     with open('{}/{}'.format(family_dir, output), 'w') as outfile:
-        outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-            "Object", "Image", "Exp_time", "RA", "DEC", "time", "filter"))
+        outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+            "Object", "Image", "Exp_time", "RA", "DEC", "time", "filter", "ext"))
         
     print "-------------------- \n Searching for images of objects in family {} from CFHT/Megacam from the MPC ephemeris".format(familyname)
     print " with filter {} and exposure time of 287, 387, 500 seconds (OSSOS data) \n--------------------".format(filtertype)
@@ -86,36 +126,148 @@ def get_image_info(familyname, filtertype='r', imagetype='p', suffix=None):
     expnum_list = []
     ra_list = []
     dec_list = []
-    for object_name in object_list[:len(object_list)-1]:
-        query = Query(object_name, search_start_date=search_start_date, search_end_date=search_end_date)
-        
-        try:
-            objects = parse_ssois_return(query.get(), object_name, imagetype, camera_filter=filtertype)
-        except IOError:
-            time.sleep(20)
-            print "Sleeping 20 seconds"
-            try:
-                objects = parse_ssois_return(query.get(), object_name, imagetype, camera_filter=filtertype)
-            except IOError:
-                time.sleep(40)
-                print "Sleeping 40 seconds"
-                objects = parse_ssois_return(query.get(), object_name, imagetype, camera_filter=filtertype)
-                
-        for line in objects:
-            with open('{}/{}'.format(family_dir, output), 'a') as outfile:
-                    image_list.append(object_name)
-                    expnum_list.append(line['Exptime'])
-                    ra_list.append(line['Object_RA'])
-                    dec_list.append(line['Object_Dec'])
-                    try:
-                        outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(object_name,
-                            line['Image'], line['Exptime'], line['Object_RA'], line['Object_Dec'],
-                            Time(line['MJD'], format='mjd', scale='utc'), line['Filter']))
-                    except:
-                        print "cannot write to outfile"    
+    object_list = object_list[:len(object_list)-1]
+    if footprints is not None:
+        results = query_footprints(object_list, FootprintIndex.load(footprints), imagetype, filtertype,
+                                   search_start_date, search_end_date)
+    else:
+        ssois_cache = (cache or offline) and SSOISCache(offline=offline) or None
+        results = query_ssois(object_list, imagetype, filtertype, search_start_date, search_end_date,
+                              threads=threads, ssois_cache=ssois_cache, server_filter=server_filter)
+    with open('{}/{}'.format(family_dir, output), 'a') as outfile:
+        for object_name, objects in results:
+            for line in objects:
+                image_list.append(object_name)
+                expnum_list.append(line['Image'])
+                ra_list.append(line['Object_RA'])
+                dec_list.append(line['Object_Dec'])
+                try:
+                    outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(object_name,
+                        line['Image'], line['Exptime'], line['Object_RA'], line['Object_Dec'],
+                        Time(line['MJD'], format='mjd', scale='utc'), line['Filter'], extension(line)))
+                except:
+                    print "cannot write to outfile"    
                
     return image_list, expnum_list, ra_list, dec_list
                     
+def query_ssois(object_list, imagetype, filtertype, search_start_date, search_end_date, threads=8, retries=3,
+                backoff=20, ssois_cache=None, server_filter=True, stats=None):
+    '''
+    Query SSOIS for every object in object_list with up to 'threads' queries in flight over the shared
+    ssos session. Each query is retried with exponential backoff. Returns an iterator of (object name,
+    parsed result) in the same order as object_list. If an SSOISCache is given, only epochs missing from the
+    cache are requested from SSOIS. With server_filter SSOIS only returns CFHT/MegaCam frames,
+    parse_ssois_return still applies every selection locally. The bytes, rows and parse time of the
+    responses are added up in stats, if given a dict, and printed once the iterator is exhausted.
+    '''
+    
+    telescope_instrument = server_filter and TELESCOPE_INSTRUMENT or None
+    if stats is None:
+        stats = {}
+    stats.update({'bytes': 0, 'rows': 0, 'parse_time': 0.0})
+    stats_lock = threading.Lock()
+    
+    def get_response(object_name):
+        if ssois_cache is not None:
+            return ssois_cache.get(object_name, search_start_date=search_start_date,
+                                   search_end_date=search_end_date, telescope_instrument=telescope_instrument)
+        query = Query(object_name, search_start_date=search_start_date, search_end_date=search_end_date,
+                      telescope_instrument=telescope_instrument)
+        return query.get()
+    
+    def query_object(object_name):
+        for attempt in range(retries):
+            try:
+                ssois_return = get_response(object_name)
+                parse_start = time.time()
+                objects = parse_ssois_return(ssois_return, object_name, imagetype, camera_filter=filtertype,
+                                             telescope_instrument=TELESCOPE_INSTRUMENT)
+                with stats_lock:
+                    stats['bytes'] += len(ssois_return)
+                    stats['rows'] += len(objects)
+                    stats['parse_time'] += time.time() - parse_start
+                return object_name, objects
+            except (IOError, requests.RequestException):
+                if ssois_cache is not None and ssois_cache.offline:
+                    print "No cached SSOIS result for {}, skipping while offline".format(object_name)
+                    return object_name, []
+                if attempt == retries - 1:
+                    raise
+                delay = backoff * 2 ** attempt
+                print "SSOIS query for {} failed, sleeping {} seconds".format(object_name, delay)
+                time.sleep(delay)
+    
+    pool = ThreadPool(max(1, min(threads, MAX_CONNECTIONS)))
+    try:
+        # imap hands back results in submission order, so the output file is deterministic
+        for result in pool.imap(query_object, object_list):
+            yield result
+    finally:
+        pool.terminate()
+    print " SSOIS responses: {} bytes, {} selected rows, {:.2f} s parsing (server side filter: {})".format(
+        stats['bytes'], stats['rows'], stats['parse_time'], telescope_instrument)
+                    
+def query_footprints(object_list, index, imagetype, filtertype, search_start_date, search_end_date):
+    '''
+    The images of every object in object_list from a local footprint index rather than SSOIS: the daily Horizons
+    ephemeris of each object is interpolated to the exposures in the index and joined against their CCD footprints.
+    Returns an iterator of (object name, rows with the columns of FOOTPRINT_DTYPE) in the same order as object_list.
+    Unlike SSOIS the index does not know the targets of the exposures, OSSOS wallpaper frames are not left out.
+    '''
+    exptimes = dict(zip(index.expnum, index.exptime))
+    for first in range(0, len(object_list), FOOTPRINT_CHUNK):
+        chunk = object_list[first:first + FOOTPRINT_CHUNK]
+        predictions = {}
+        for object_name in chunk:
+            try:
+                ephemerides = horizons.batch(object_name, search_start_date.iso, search_end_date.iso, 1, su='d',
+                                             params=[1])[1]
+            except Exception, e:
+                print "No Horizons ephemeris for {}, skipping, {}".format(object_name, e)
+                continue
+            dates = [datetime.datetime.strptime(date, '%Y-%b-%d %H:%M') for date in ephemerides[ephemerides.names[0]]]
+            if len(dates) < 2:
+                continue
+            predictions[object_name] = index.predict(Time(dates, scale='utc').mjd,
+                                                     ephemerides[horizons_parser.RA_DEG_COLUMN],
+                                                     ephemerides[horizons_parser.DEC_DEG_COLUMN])
+        rows = dict((object_name, []) for object_name in chunk)
+        for object_name, expnum, ccd, x, y, mjd, ra, dec in locate_objects(index, predictions,
+                                                                            camera_filter=filtertype):
+            exptime = int(round(exptimes[expnum]))
+            if exptime in EXPTIMES:
+                # SSOIS numbers the extensions of the MEF from 1, the CCDs from 0
+                rows[object_name].append(('{}{}'.format(expnum, imagetype), mjd, filtertype, exptime, ra, dec,
+                                          ccd + 1))
+        for object_name in chunk:
+            print "Searching for object %s " % object_name
+            if len(rows[object_name]) > 0:
+                print " %d images found" % len(rows[object_name])
+            yield object_name, np.array(rows[object_name], dtype=FOOTPRINT_DTYPE)
+                    
+def read_image_list(filename):
+    '''
+    The rows of an image list written by get_image_info: [(object, expnum, RA, DEC, ext)], ext None if unknown
+    '''
+    rows = []
+    with open(filename) as infile:
+        for line in infile.readlines()[1:]:  # skip header info
+            columns = line.split()
+            if len(columns) == 0:
+                continue
+            # the time column is 'date time', ext is the last column
+            ext = len(columns) > 7 and columns[-1] not in ['None', 'nan'] and columns[-1] or None
+            rows.append((columns[0], columns[1], float(columns[3]), float(columns[4]), ext))
+    return rows
+
+def extension(line):
+    '''
+    The FITS extension SSOIS resolved the object onto, 'None' if SSOIS did not return an Ext column
+    '''
+    if 'Ext' in line.dtype.names:
+        return line['Ext']
+    return 'None'
+                    
 def parse_ssois_return(ssois_return, object_name, imagetype, camera_filter='r.MP9601', telescope_instrument='CFHT/MegaCam'):
     '''
     Parse through objects in ssois query and filter out images of desired filter, type, exposure time, and instrument
@@ -123,26 +275,10 @@ def parse_ssois_return(ssois_return, object_name, imagetype, camera_filter='r.MP
     
     assert camera_filter in ['r.MP9601', 'u.MP9301']
     
-    ret_table = []
-    good_table = 0
-
-    table_reader = ascii.get_reader(Reader=ascii.Basic)
-    table_reader.inconsistent_handler = _skip_missing_data
-    table_reader.header.splitter.delimiter = '\t'
-    table_reader.data.splitter.delimiter = '\t'
-    table = table_reader.read(ssois_return)
-    
-    for row in table:
-        # check if a dbimages object exists
-        mjd = row['MJD']
-        # Excludes the OSSOS wallpaper.
-        # note: 'Telescope_Insturment' is a typo in SSOIS's return format
-        if (row['Telescope_Insturment'] == telescope_instrument) and (row['Filter'] == camera_filter) \
-                and (row['Image'].endswith('{}'.format(imagetype))) and not str(row['Image_target']).startswith('WP'):
-                
-            if (int(row['Exptime']) == 287) or (int(row['Exptime']) == 387 ) or (int(row['Exptime']) == 500 ):
-                good_table += 1
-                ret_table.append(row)
+    # instrument, filter, image type, exposure time and the OSSOS wallpaper are all masked in one pass
+    table = ssos_parser.parse(ssois_return)
+    ret_table = ssos_parser.select(table, telescope_instrument, camera_filter, imagetype, EXPTIMES)
+    good_table = len(ret_table)
             
     print "Searching for object %s " % object_name
     
@@ -150,17 +286,6 @@ def parse_ssois_return(ssois_return, object_name, imagetype, camera_filter='r.MP
         print " %d images found" % good_table
 
     return ret_table
-
-def _skip_missing_data(str_vals, ncols):
-    """
-    add a extra column if one is missing, else return None.
-    """
-    if len(str_vals) == ncols - 1:
-        str_vals.append('None')
-        return str_vals
-    else:
-        #raise ValueError("not enough columns in table")
-        print '  Not enough columns in data table'
     
 
 if __name__ == '__main__':
@@ -6,21 +6,46 @@ import requests
 import os
 import vos
 from astropy.time import Time
-import urllib2 as url
 import numpy as np
+import math
+import json
+import tempfile
+import threading
 from astropy.table import Table, Column
 
 import sys
 sys.path.append('/Users/admin/Desktop/MainBeltComets/getImages/ossos_scripts/')
 
 from ossos_scripts import storage
+from ossos_scripts import horizons
 from ossos_scripts import coding
 from ossos_scripts import mpc
 from ossos_scripts import util
+from ossos_scripts import wcs
+from ossos_scripts import cadc_session
+from ossos_scripts import stamp_index
+from ossos_scripts import upload_queue
+from ossos_scripts import services
+from ossos_scripts import metrics
+from ossos_scripts import profiling
+import download_scheduler
 
 _TARGET = "TARGET"
 
-BASEURL = "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/vospace/auth/synctrans"
+BASEURL = services.SYNCTRANS_URL
+
+# persistent map of (expnum, ra, dec) -> EXTNAME found by probe cutouts, so each stamp is only one cutout request;
+# one JSON object per line, appended as they are found, the last line for a key wins
+EXTENSION_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asteroid_families', 'extension_map.jsonl')
+_extension_map = None
+_extension_lock = threading.Lock()
+
+# cost model for cutout_many, in bytes transferred
+PIXEL_SCALE = 0.185                     # arcseconds / pixel
+BYTES_PER_PIXEL = 4                     # BITPIX = -32
+CCD_BYTES = 2112 * 4644 * BYTES_PER_PIXEL
+REQUEST_COST_BYTES = 2 * 1024 * 1024    # latency of one synctrans request, as the bytes it could have moved
+MAX_CUTOUTS_PER_REQUEST = 32
 
 """
 Retrieval of cutouts of the FITS images associated with the CFHT/MegaCam detections.
@@ -46,21 +71,30 @@ def main():
                         help="The input .txt files of astrometry/photometry measurements.")
     parser.add_argument("--radius", '-r',
                         action='store',
+                        type=float,
                         default=0.01,
                         help='Radius (degree) of circle of cutout postage stamp.')
     parser.add_argument("--suffix", '-s',
                         action='store',
                         default=None,
                         help='Suffix of mba without family designation')
+    parser.add_argument("--workers", '-w',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='Number of concurrent cutout downloads to start with, adapts to throughput.')
+    profiling.add_arguments(parser)
     args = parser.parse_args()
+    profiling.from_args(args)
     
     # CADC PERMISSIONS
     username = raw_input("CADC username: ")
     password = getpass.getpass("CADC password: ")
+    cadc_session.login(username, password)
     
-    get_stamps(args.family, username, password, args.radius, args.suffix)
+    get_stamps(args.family, username, password, args.radius, args.suffix, args.workers)
     
-def get_stamps(familyname, username, password, radius=0.01, suffix=None):
+def get_stamps(familyname, username, password, radius=0.01, suffix=None, workers=4):
     
     print "----- Cutting postage stamps of objects in family {}  from CFHT/MegaCam images -----".format(familyname)	                  
     
@@ -70,7 +104,12 @@ def get_stamps(familyname, username, password, radius=0.01, suffix=None):
     if os.path.isdir(family_dir) == False:
         print "Invalid family name or directory does not exist"
 
+    vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
+    if not storage.exists_many([vos_dir], force=True)[vos_dir]:
+        storage.mkdir(vos_dir)
+
     image_list = '{}/{}_images.txt'.format(family_dir, familyname)
+    rows = []
     with open(image_list) as infile: 
         for line in infile.readlines()[1:]: # skip header info
             assert len(line.split()) > 0
@@ -78,33 +117,69 @@ def get_stamps(familyname, username, password, radius=0.01, suffix=None):
             expnum = line.split()[1]
             RA = float(line.split()[3])   
             DEC = float(line.split()[4])
-                        
-            vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
-            if not storage.exists(vos_dir, force=True):
-                storage.mkdir(vos_dir)
-            assert storage.exists(vos_dir, force=True)
-
-            postage_stamp_filename = "{}_{}_{:8f}_{:8f}.fits".format(objectname, expnum, RA, DEC)
-            if storage.exists('{}/{}'.format(vos_dir, postage_stamp_filename)) == True:
-                print "  Stamp already exists"
+            ext = len(line.split()) > 7 and line.split()[7] or None
+            uri = '{}/{}_{}_{:8f}_{:8f}.fits'.format(vos_dir, objectname, expnum, RA, DEC)
+            rows.append((uri, objectname, expnum, RA, DEC, ext))
+
+    # one listing of vos_dir filters out the stamps that already exist
+    present = storage.exists_many([row[0] for row in rows], force=True)
+    pending = {}  # image -> [(objectname, RA, DEC, radius, ext)], cut out together per exposure
+    object_radius = {}  # Horizons is asked once per object
+    for uri, objectname, expnum, RA, DEC, ext in rows:
+        if present[uri]:
+            print "  Stamp already exists"
+            continue
+        
+        if objectname not in object_radius:
+            object_radius[objectname] = uncertainty_radius(familyname, objectname, radius)
+        pending.setdefault(expnum, []).append((objectname, RA, DEC, object_radius[objectname], ext))
+
+    def fetch(expnum):
+        objects = pending[expnum]
+        return cutout_many(expnum, [(RA, DEC, r) for objectname, RA, DEC, r, ext in objects],
+                           username, password, exts=[ext for objectname, RA, DEC, r, ext in objects],
+                           raise_errors=True)
+
+    jobs = [(expnum, sum(cutout_bytes(r) for objectname, RA, DEC, r, ext in pending[expnum]))
+            for expnum in sorted(pending)]
+    scheduler = download_scheduler.DownloadScheduler(fetch, workers=workers)
+    for expnum, stamps, error in scheduler.run(jobs):
+        objects = pending[expnum]
+        if error is not None:
+            print 'Cutouts of {} failed, {}'.format(expnum, error)
+            continue
+        for (objectname, RA, DEC, r, ext), stamp in zip(objects, stamps):
+            if stamp is None:
+                # e.g. the region fell off the returned pixels, go back to a single cutout
+                cutout(objectname, expnum, RA, DEC, r, username, password, familyname, ext=ext)
             else:
-                
-                urlData, date_start, date_end = query_jpl(familyname, objectname, step=1)
-                print "----- Querying JPL Horizon's ephemeris for RA and DEC uncertainties -----"
-                RA_3sigma, DEC_3sigma = parse_mag_jpl(urlData, date_start, date_end) # in arcseconds
-            
-                RA_3sigma_avg = np.mean(RA_3sigma) / 3600 # convert to degrees
-                DEC_3sigma_avg = np.mean(DEC_3sigma) / 3600
-            
-                if RA_3sigma_avg > DEC_3sigma_avg:
-                    r_temp = RA_3sigma_avg
-                else:
-                    r_temp = DEC_3sigma_avg
-                
-                if r_temp > radius:
-                    radius = r_temp
-                
-                cutout(objectname, expnum, RA, DEC, radius, username, password, familyname)
+                write_stamp(stamp, objectname, expnum, RA, DEC, familyname)
+    scheduler.close()
+    scheduler.report()
+    failed = upload_queue.flush()
+    if len(failed) > 0:
+        print "WARNING: {} stamps were not uploaded, they are retried on the next run".format(len(failed))
+
+
+def uncertainty_radius(familyname, objectname, radius=0.01):
+    '''
+    Cutout radius (degrees) for an object: the larger of its JPL Horizons 3-sigma RA and DEC uncertainties, at least radius
+    '''
+    ephemerides, date_start, date_end = query_jpl(familyname, objectname, step=1)
+    print "----- Querying JPL Horizon's ephemeris for RA and DEC uncertainties -----"
+    RA_3sigma, DEC_3sigma = parse_mag_jpl(ephemerides, date_start, date_end) # in arcseconds
+
+    RA_3sigma_avg = np.mean(RA_3sigma) / 3600 # convert to degrees
+    DEC_3sigma_avg = np.mean(DEC_3sigma) / 3600
+
+    if RA_3sigma_avg > DEC_3sigma_avg:
+        r_temp = RA_3sigma_avg
+    else:
+        r_temp = DEC_3sigma_avg
+    
+    if r_temp > radius:
+        radius = r_temp
+    return radius
                 
 def get_one_stamp(objectname, expnum, radius, username, password, familyname):
     
@@ -116,6 +191,10 @@ def get_one_stamp(objectname, expnum, radius, username, password, familyname):
     if os.path.isdir(family_dir) == False:
         print "Invalid family name or directory does not exist"
 
+    vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
+    if not storage.exists(vos_dir, force=True):
+        storage.mkdir(vos_dir)
+
     image_list = '{}/{}_images.txt'.format(family_dir, familyname)
     with open(image_list) as infile: 
         for line in infile.readlines()[1:]: # skip header info
@@ -124,16 +203,12 @@ def get_one_stamp(objectname, expnum, radius, username, password, familyname):
             expnum_file = line.split()[1]
             RA = float(line.split()[3])   
             DEC = float(line.split()[4])
-                        
-            vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
-            if not storage.exists(vos_dir, force=True):
-                storage.mkdir(vos_dir)
-            #assert storage.exists(vos_dir, force=True)
             
             if expnum == expnum_file:
                 
                 postage_stamp_filename = "{}_{}_{:8f}_{:8f}.fits".format(objectname, expnum, RA, DEC)
                 storage.remove('vos:kawebb/postage_stamps/{}/{}'.format(familyname, postage_stamp_filename))
+                stamp_index.record_remove('vos:kawebb/postage_stamps/{}/{}'.format(familyname, postage_stamp_filename))
                 cutout(objectname, expnum, RA, DEC, radius, username, password, familyname)
                 return                
 	
@@ -141,7 +216,7 @@ def centered_stamp(objectname, expnum,radius, RA, DEC, username, password, famil
     
     vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
     postage_stamp_filename = "{}_{}_{:8f}_{:8f}_centered.fits".format(objectname, expnum, RA, DEC)
-    if storage.exists('{}/{}'.format(vos_dir, postage_stamp_filename)) == True:
+    if stamp_index.get_index(vos_dir).exists(postage_stamp_filename):
         print "  Stamp already exists"
     else:
         print type(objectname, expnum, RA, DEC, radius, username, password, familyname)
@@ -149,7 +224,7 @@ def centered_stamp(objectname, expnum,radius, RA, DEC, username, password, famil
     return
 
 
-def cutout(object_name, image, ra, dec, radius, username, password, family_name, test=False):
+def cutout(object_name, image, ra, dec, radius, username, password, family_name, test=False, ext=None):
     """
     Test for image known to work   
     image = '1667879p'
@@ -157,71 +232,301 @@ def cutout(object_name, image, ra, dec, radius, username, password, family_name,
     DEC = 11.8697277778
     """
     
-    vos_dir = 'vos:kawebb/postage_stamps/{}'.format(family_name)
-    output_dir = 'asteroid_families/{}/{}_stamps'.format(family_name, family_name)
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
+    cutout_fobj = fetch_cutout(image, ra, dec, radius, username, password, ext=ext)
+    if cutout_fobj is None:
+        return
+    return write_stamp(cutout_fobj, object_name, image, ra, dec, family_name, test=test)
 
-    this_cutout = "CIRCLE ICRS {} {} {}".format(ra, dec, 2*0.18/3600.0)
-    print "cut out: {}".format(this_cutout)
+
+def fetch_cutout(image, ra, dec, radius, username, password, ext=None):
+    """
+    Retrieve a CIRCLE cutout of radius (degrees) around ra, dec from the given image.
+    Returns a fits.PrimaryHDU of the extension the centre falls on, or None if the request failed.
+    The extension is resolved locally (see resolve_extension) so this is normally a single request,
+    a small probe cutout is only made when that fails.
+    """
 
     expnum = image.split('p')[0]  # only want calibrated images
     target = storage.vospace.fixURI(storage.get_uri(expnum))
-    direction = "pullFromVoSpace"
-    protocol = "ivo://ivoa.net/vospace/core#httpget"
-    view = "cutout"
-    params = {_TARGET: target,
-              "PROTOCOL": protocol,
-              "DIRECTION": direction,
-              "cutout": this_cutout,
-              "view": view}
-    r = requests.get(BASEURL, params=params, auth=(username, password))
+    
+    extname = resolve_extension(expnum, ra, dec, ext=ext)
+    if extname is None:
+        extname = probe_extension(target, ra, dec, username, password)
+        if extname is False:
+            return
+        remember_extension(expnum, ra, dec, extname)
+
+    this_cutout = "CIRCLE ICRS {} {} {}".format(ra, dec, radius)
+    print "cut out: {}".format(this_cutout)
 
     try:
-        r.raise_for_status()
-        small_fobj = fits.open(StringIO(r.content))
-        extname = small_fobj[0].header.get('EXTNAME', None)
-        del small_fobj
+        full_fobj = _get_cutout(target, this_cutout, username, password)
     except requests.HTTPError, e:
         print 'Connection Failed, {}'.format(e)
         return
+    
+    if extname is None or len(full_fobj) == 1:
+        cutout_fobj = full_fobj[0]
+    else:
+        try:
+            cutout_fobj = full_fobj[extname]
+        except KeyError:
+            print "WARNING: extension {} not in cutout of {}, probing".format(extname, image)
+            extname = probe_extension(target, ra, dec, username, password)
+            if extname is False:
+                return
+            remember_extension(expnum, ra, dec, extname)
+            if extname is None:
+                cutout_fobj = full_fobj[0]
+            else:
+                cutout_fobj = full_fobj[extname]
 
-    this_cutout = "CIRCLE ICRS {} {} {}".format(ra, dec, radius)
-    print "cut out: {}".format(this_cutout)
+    return fits.PrimaryHDU(data=cutout_fobj.data, header=cutout_fobj.header)
 
-    expnum = image.split('p')[0]  # only want calibrated images
-    target = storage.vospace.fixURI(storage.get_uri(expnum))
+
+@metrics.timer(metrics.CUTOUT_DOWNLOAD)
+def _get_cutout(target, this_cutout, username, password):
+    """
+    Make one synctrans cutout request and return the HDUList, raises requests.HTTPError on failure.
+    this_cutout may be a list, the service then returns one extension per cutout.
+    The request goes through the shared CADC session, with its credentials unless username is given.
+    """
     direction = "pullFromVoSpace"
     protocol = "ivo://ivoa.net/vospace/core#httpget"
     view = "cutout"
-    params = {"TARGET": target,
+    params = {_TARGET: target,
               "PROTOCOL": protocol,
               "DIRECTION": direction,
               "cutout": this_cutout,
               "view": view}
+    auth = None
+    if username is not None:
+        auth = (username, password)
+    r = cadc_session.get_session().get(BASEURL, params=params, auth=auth)
+    r.raise_for_status()
+    return fits.open(StringIO(r.content))
 
-    r = requests.get(BASEURL, params=params, auth=(username, password))
 
-    try:
-        r.raise_for_status()
-        full_fobj = fits.open(StringIO(r.content))
-        if extname is not None:
-            cutout_fobj = full_fobj[extname]
+def cutout_bytes(radius):
+    """
+    Approximate size of a circle cutout of radius (degrees): the enclosing box of pixels.
+    """
+    return (2 * radius * 3600.0 / PIXEL_SCALE) ** 2 * BYTES_PER_PIXEL
+
+
+def plan_cutouts(regions, extnames):
+    """
+    Decide how to fetch many regions of one exposure. Regions on the same CCD are fetched as the whole
+    extension (then sliced locally) when their cutouts would move more bytes than the CCD itself, every
+    other region goes into multi-cutout requests of at most MAX_CUTOUTS_PER_REQUEST circles.
+    Returns a list of (method, extname, region indices), method being 'full' or 'multi'.
+    """
+    by_ext = {}
+    for idx, extname in enumerate(extnames):
+        by_ext.setdefault(extname, []).append(idx)
+
+    jobs = []
+    multi = []
+    for extname in sorted(by_ext):
+        members = by_ext[extname]
+        multi_cost = sum(cutout_bytes(regions[idx][2]) for idx in members)
+        if extname is not None and multi_cost > CCD_BYTES + REQUEST_COST_BYTES:
+            jobs.append(('full', extname, members))
         else:
-            cutout_fobj = full_fobj[0]
+            multi.extend(members)
+    multi.sort()
+    for start in range(0, len(multi), MAX_CUTOUTS_PER_REQUEST):
+        jobs.append(('multi', None, multi[start:start + MAX_CUTOUTS_PER_REQUEST]))
+    return jobs
+
+
+def cutout_many(image, regions, username, password, exts=None, raise_errors=False):
+    """
+    Retrieve many (ra, dec, radius) regions of one exposure with as few requests as plan_cutouts allows.
+    Returns a list with a fits.PrimaryHDU (CRPIX shifted to the stamp) per region, None where it failed.
+    With raise_errors a failed request raises requests.HTTPError instead, so the caller can retry.
+    """
+    expnum = image.split('p')[0]  # only want calibrated images
+    target = storage.vospace.fixURI(storage.get_uri(expnum))
+    if exts is None:
+        exts = [None] * len(regions)
+    extnames = [resolve_extension(expnum, ra, dec, ext=ext) for (ra, dec, radius), ext in zip(regions, exts)]
+
+    stamps = [None] * len(regions)
+    for method, extname, members in plan_cutouts(regions, extnames):
+        if method == 'full':
+            this_cutout = "[{}]".format(extname)
+        else:
+            this_cutout = ["CIRCLE ICRS {} {} {}".format(*regions[idx]) for idx in members]
+        print "cut out: {} {} of {} for {} regions".format(method, extname or '', image, len(members))
+        try:
+            fobj = _get_cutout(target, this_cutout, username, password)
+        except requests.HTTPError, e:
+            if raise_errors:
+                raise
+            print 'Connection Failed, {}'.format(e)
+            continue
+        for idx in members:
+            stamps[idx] = _best_slice(fobj, *regions[idx])
+    return stamps
+
+
+def _best_slice(fobj, ra, dec, radius):
+    """
+    Slice ra, dec out of whichever extension of a cutout response holds the most of its box.
+    """
+    best = None
+    for hdu in fobj:
+        if hdu.data is None or len(hdu.data.shape) != 2:
+            continue
+        stamp = slice_stamp(hdu, ra, dec, radius)
+        if stamp is not None and (best is None or stamp.data.size > best.data.size):
+            best = stamp
+    return best
+
+
+def probe_extension(target, ra, dec, username, password):
+    """
+    Find the EXTNAME that ra, dec falls on with a tiny cutout. Returns False if the request failed.
+    """
+    this_cutout = "CIRCLE ICRS {} {} {}".format(ra, dec, 2*0.18/3600.0)
+    print "cut out: {}".format(this_cutout)
+    try:
+        small_fobj = _get_cutout(target, this_cutout, username, password)
+        extname = small_fobj[0].header.get('EXTNAME', None)
+        del small_fobj
     except requests.HTTPError, e:
         print 'Connection Failed, {}'.format(e)
+        return False
+    return extname
+
+
+def _extension_key(expnum, ra, dec):
+    return "{}_{:8f}_{:8f}".format(expnum, float(ra), float(dec))
+
+
+def _load_extension_map():
+    global _extension_map
+    if _extension_map is None:
+        _extension_map = {}
+        legacy = os.path.splitext(EXTENSION_MAP)[0] + '.json'  # the whole map in one JSON object
+        if os.path.exists(legacy):
+            with open(legacy) as infile:
+                _extension_map.update(json.load(infile))
+        if os.path.exists(EXTENSION_MAP):
+            with open(EXTENSION_MAP) as infile:
+                for line in infile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short, that extension is probed again
+                        continue
+                    _extension_map[entry['key']] = entry['extname']
+    return _extension_map
+
+
+def remember_extension(expnum, ra, dec, extname):
+    """
+    Record the extension a probe cutout found for (expnum, ra, dec) in the persistent extension map.
+    """
+    if extname is None:
         return
+    key = _extension_key(expnum, ra, dec)
+    with _extension_lock:
+        _load_extension_map()[key] = extname
+        map_dir = os.path.dirname(EXTENSION_MAP)
+        if not os.path.isdir(map_dir):
+            os.makedirs(map_dir)
+        with open(EXTENSION_MAP, 'a') as outfile:
+            outfile.write(json.dumps({'key': key, 'extname': extname}) + '\n')
 
-    cutout_fobj = fits.PrimaryHDU(data=cutout_fobj.data, header=cutout_fobj.header)
+
+def resolve_extension(expnum, ra, dec, ext=None):
+    """
+    Work out which CCD extension (EXTNAME) of an exposure ra, dec falls on without a cutout request:
+    from the persistent extension map, from the Ext column SSOIS returned, or from the exposure's
+    cached WCS headers. Returns None if it could not be resolved.  Only the extensions probe cutouts find are
+    persisted, the others are as quick to work out again.
+    """
+    with _extension_lock:
+        extname = _load_extension_map().get(_extension_key(expnum, ra, dec), None)
+    metrics.cache_lookup('extension_map', extname is not None)
+    if extname is not None:
+        return extname
+    
+    if ext is not None and str(ext).isdigit():
+        # SSOIS numbers the extensions of the MEF from 1, the CCDs from 0
+        extname = 'ccd{:02d}'.format(int(ext) - 1)
+    else:
+        extname = _extension_from_headers(expnum, ra, dec)
+    if extname is not None:
+        with _extension_lock:
+            _load_extension_map()[_extension_key(expnum, ra, dec)] = extname
+    return extname
+
+
+def _extension_from_headers(expnum, ra, dec):
+    try:
+        headers = storage.get_astheader(expnum, ccd=None)
+    except Exception, e:
+        print "WARNING: no astrometric headers for {}, {}".format(expnum, e)
+        return None
+    if not isinstance(headers, (list, tuple)):
+        # a single header, from the exposure itself rather than a .head file: no CCD to tell apart
+        return None
+    for ccd, header in enumerate(headers[1:]):
+        if header is None or 'CRVAL1' not in header:
+            continue
+        x, y = wcs.WCS(header).sky2xy(ra, dec)
+        if 0.5 <= x <= header.get('NAXIS1', 2112) + 0.5 and 0.5 <= y <= header.get('NAXIS2', 4644) + 0.5:
+            return 'ccd{:02d}'.format(ccd)
+    return None
+
+
+def write_stamp(cutout_fobj, object_name, image, ra, dec, family_name, test=False):
+    """
+    Write a postage stamp to the family's local stamps directory and queue its upload to VOSpace, return its path.
+    The local copy is usable as soon as this returns; upload_queue.flush() waits for the uploads.
+    """
+    
+    vos_dir = 'vos:kawebb/postage_stamps/{}'.format(family_name)
+    output_dir = 'asteroid_families/{}/{}_stamps'.format(family_name, family_name)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
 
     postage_stamp_filename = "{}_{}_{:8f}_{:8f}.fits".format(object_name, image, float(ra), float(dec))
-    cutout_fobj.writeto("{}/{}".format(output_dir, postage_stamp_filename))
-    del cutout_fobj
-    if test:
-        return
-    storage.copy('{}/{}'.format(output_dir, postage_stamp_filename),
-                 '{}/{}'.format(vos_dir, postage_stamp_filename))
+    # a stamp cut again replaces the earlier one whole, whose upload may still be queued: that upload is superseded
+    fd, tmp_name = tempfile.mkstemp(prefix=postage_stamp_filename, suffix='.tmp', dir=output_dir)
+    os.close(fd)
+    cutout_fobj.writeto(tmp_name, clobber=True)
+    os.rename(tmp_name, "{}/{}".format(output_dir, postage_stamp_filename))
+    if not test:
+        upload_queue.get_queue().submit('{}/{}'.format(output_dir, postage_stamp_filename),
+                                        '{}/{}'.format(vos_dir, postage_stamp_filename))
+    return '{}/{}'.format(output_dir, postage_stamp_filename)
+
+
+def slice_stamp(hdu, ra, dec, radius):
+    """
+    Cut the box enclosing a circle of radius (degrees) around ra, dec out of an already downloaded image.
+    The data is a numpy view of the parent and CRPIX is shifted so the WCS stays correct.
+    Returns a fits.PrimaryHDU, or None if ra, dec is not on the image.
+    """
+    header = hdu.header
+    x, y = wcs.WCS(header).sky2xy(ra, dec)
+    naxis2, naxis1 = hdu.data.shape
+    if not (0.5 <= x <= naxis1 + 0.5 and 0.5 <= y <= naxis2 + 0.5):
+        return None
+    scale = 3600.0 * math.sqrt(abs(header['CD1_1'] * header['CD2_2'] - header['CD1_2'] * header['CD2_1']))
+    half = radius * 3600.0 / scale
+    x0 = max(0, int(math.floor(x - half)) - 1)
+    x1 = min(naxis1, int(math.ceil(x + half)))
+    y0 = max(0, int(math.floor(y - half)) - 1)
+    y1 = min(naxis2, int(math.ceil(y + half)))
+    stamp_header = header.copy()
+    stamp_header['CRPIX1'] = header['CRPIX1'] - x0
+    stamp_header['CRPIX2'] = header['CRPIX2'] - y0
+    return fits.PrimaryHDU(data=hdu.data[y0:y1, x0:x1], header=stamp_header)
     
 
 def query_jpl(familyname, objectname, step=1, su='d'):
@@ -253,7 +558,7 @@ def query_jpl(familyname, objectname, step=1, su='d'):
     s = '36' # select parameter for RA and DEC uncertainty
 
     # form URL pieces that Horizon needs for its processing instructions
-    urlArr = ["http://ssd.jpl.nasa.gov/horizons_batch.cgi?batch=1&COMMAND=",
+    urlArr = [services.HORIZONS_URL + "?batch=1&COMMAND=",
               '',
               "&MAKE_EPHEM='YES'&TABLE_TYPE='OBSERVER'&START_TIME=",
               '',
@@ -282,61 +587,30 @@ def query_jpl(familyname, objectname, step=1, su='d'):
     urlArr[7] = step  # timestep   
     urlStr = "".join(urlArr)  # create the url to pass to Horizons
    
-    # Query Horizons; if it's busy, wait and try again in a minute
-    done = 0
-    while not done:
-        urlHan = url.urlopen(urlStr)
-        urlData = urlHan.readlines()
-        urlHan.close()
-        if len(urlData[0].split()) > 1:
-            if "BUSY:" <> urlData[0].split()[1]:
-                done = 1
-            else:
-                print urlData[0],
-                print "Sleeping 60 s and trying again"
-                time.sleep(60)
-        else:
-            done = 1   
+    ephemerides = horizons.query(urlStr)
         
-    return urlData, date_start, date_end
+    return ephemerides, date_start, date_end
 
-def parse_mag_jpl(urlData, date_start, date_end):
-        
-    # parse through urlData for indexes of start and end dates    
-    index_end = None
-    index_start = None
-    for idx, line in enumerate(urlData):  #testing
-        assert line.split() > 0
-        try:
-            date_jpl = line.split()[0]+' '+(line.split()[1]).strip(',')
-            if date_start == date_jpl:
-                index_start = idx
-        except:
-            None
-    if index_start is None:
-        print "WARNING: index start could not be obtained, set to index 69"
-        index_start = 69
-    for idx, line in enumerate(urlData):  #testing
-        try:
-            date_jpl = line.split()[0]+' '+(line.split()[1]).strip(',')
-            if date_end == date_jpl:
-                index_end = idx
-        except:
-            None
-    if index_end is None:
-        print "WARNING: index end could not be obtained, set to index 70"
-        index_end = 70
-        
-    # for indexes from start to end dates, get apparent magnitude values
-    RA_3sigma = []
-    DEC_3sigma = []
-    for line in urlData[index_start:index_end+1]:
-        assert len(line.split()) > 0 
-        try:
-            RA_3sigma.append(float((line.split()[4]).strip(',')))
-            DEC_3sigma.append(float((line.split()[5]).strip(',')))
-        except:
-            print "WARNING: could not get magnitude from JPL line"
+def parse_mag_jpl(ephemerides, date_start, date_end):
+    '''
+    Select the RA and DEC 3-sigma uncertainties between the start and end dates from the parsed ephemeris
+    '''
+    dates = ephemerides.dates
+    index_start = 0
+    index_end = len(dates) - 1
+    start_match = np.flatnonzero(dates == date_start)
+    end_match = np.flatnonzero(dates == date_end)
+    if len(start_match) == 0:
+        print "WARNING: index start could not be obtained, using first ephemeris row"
+    else:
+        index_start = start_match[-1]
+    if len(end_match) == 0:
+        print "WARNING: index end could not be obtained, using last ephemeris row"
+    else:
+        index_end = end_match[-1]
+
+    RA_3sigma = ephemerides['RA_3sigma'][index_start:index_end+1]
+    DEC_3sigma = ephemerides['DEC_3sigma'][index_start:index_end+1]
     
     assert len(RA_3sigma) > 0
     return RA_3sigma, DEC_3sigma
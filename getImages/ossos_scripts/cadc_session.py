@@ -0,0 +1,174 @@
+"""One authenticated, connection pooled session shared by every CADC HTTP and VOSpace call."""
+import logging
+import netrc
+import os
+import threading
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase, HTTPBasicAuth
+
+import metrics
+import replay
+import services  # before vos, it may point VOSPACE_WEBSERVICE at a stand-in
+import vos
+
+logger = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = 16
+CERTFILE = os.path.join(os.getenv('HOME', '.'), '.ssl', 'cadcproxy.pem')
+# credentials are only ever sent to these hosts, the session also carries e.g. JPL Horizons queries
+CADC_DOMAINS = ('cadc-ccda.hia-iha.nrc-cnrc.gc.ca', 'cadc.hia.nrc.gc.ca', 'canfar.phys.uvic.ca', 'canfar.net')
+
+
+def is_cadc(url):
+    host = urlparse.urlparse(url).hostname or ''
+    return any(host == domain or host.endswith('.' + domain) for domain in CADC_DOMAINS)
+
+
+class CADCAuth(AuthBase):
+    """
+    HTTP basic auth that is only attached to requests going to CADC.
+    """
+
+    def __init__(self, username, password):
+        self.basic = HTTPBasicAuth(username, password)
+
+    def __call__(self, request):
+        if is_cadc(request.url):
+            return self.basic(request)
+        return request
+
+
+class CADCSession(object):
+    """
+    Holds the CADC credentials (username/password or a proxy certificate), a keep-alive requests.Session whose
+    connection pool is sized for concurrent workers, and a vos.Client.  Building any of these is expensive (a TLS
+    handshake per connection) so every module shares the one from get_session().
+    """
+
+    def __init__(self, username=None, password=None, certfile=None, pool_size=MAX_CONNECTIONS):
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        # OSSOS_RECORD / OSSOS_REPLAY swap in an adapter that records or replays the traffic
+        replay.install(self.http, pool_size=pool_size)
+        self.http.hooks['response'].append(metrics.record_response)
+        self.certfile = None
+        self._vospace = None
+        self._lock = threading.Lock()
+        self.login(username, password, certfile)
+
+    def login(self, username=None, password=None, certfile=None):
+        """
+        Set the credentials used for CADC requests from now on.
+
+        :param username: CADC user name, used with password for HTTP basic auth
+        :param password: CADC password
+        :param certfile: CADC proxy certificate (e.g. ~/.ssl/cadcproxy.pem), used for VOSpace and https requests
+        """
+        if username is not None:
+            self.http.auth = CADCAuth(username, password)
+        if certfile is None and os.access(CERTFILE, os.R_OK):
+            certfile = CERTFILE
+        if certfile is not None and certfile != self.certfile:
+            self.certfile = certfile
+            self.http.cert = certfile
+            self._vospace = None
+
+    @property
+    def vospace(self):
+        """
+        The shared vos.Client, built on first use.
+        """
+        with self._lock:
+            if self._vospace is None:
+                if self.certfile is not None:
+                    self._vospace = vos.Client(vospace_certfile=self.certfile)
+                else:
+                    self._vospace = vos.Client()
+                # vos clients that talk through requests get recorded and replayed as well
+                vos_http = getattr(getattr(self._vospace, 'conn', None), 'session', None)
+                if isinstance(vos_http, requests.Session):
+                    replay.install(vos_http)
+            return self._vospace
+
+    def get(self, url, **kwargs):
+        return self.http.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.http.post(url, **kwargs)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    The session shared by every module, created without credentials on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = CADCSession()
+        return _session
+
+
+def login(username=None, password=None, certfile=None):
+    """
+    Give the shared session its credentials; call once from a script's main().
+    """
+    session = get_session()
+    session.login(username, password, certfile)
+    return session
+
+
+def netrc_credentials(filename=None):
+    """
+    The (username, password) of the first CADC machine in ~/.netrc (or filename), None if there is none.
+    """
+    try:
+        hosts = netrc.netrc(filename).hosts
+    except (IOError, netrc.NetrcParseError) as e:
+        logger.debug("No usable netrc: {}".format(e))
+        return None
+    for host, (login_name, account, password) in sorted(hosts.items()):
+        if is_cadc('https://{}/'.format(host)) and login_name:
+            return login_name, password
+    return None
+
+
+def login_unattended(certfile=None, netrc_file=None):
+    """
+    Log the shared session in without asking anybody: with the proxy certificate (certfile, or ~/.ssl/cadcproxy.pem)
+    and, if it has a CADC entry, the user name and password from netrc.  Raises EnvironmentError if there is neither,
+    a worker left running on its own should stop at once rather than fail every request.
+    """
+    if certfile is not None and not os.access(certfile, os.R_OK):
+        raise EnvironmentError("Cannot read the CADC certificate {}".format(certfile))
+    credentials = netrc_credentials(netrc_file)
+    session = get_session()
+    if credentials is not None:
+        session.login(credentials[0], credentials[1], certfile)
+    else:
+        session.login(certfile=certfile)
+    if session.certfile is None and credentials is None:
+        raise EnvironmentError("No CADC credentials: need a proxy certificate ({}) or a CADC machine in "
+                               "netrc".format(CERTFILE))
+    return session
+
+
+class _VOSpaceProxy(object):
+    """
+    Stands in for a module-global vos.Client, forwarding to the client of the shared session so that it follows
+    whatever credentials login() was given.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_session().vospace, name)
+
+
+vospace = _VOSpaceProxy()
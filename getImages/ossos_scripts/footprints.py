@@ -0,0 +1,281 @@
+"""Local index of CFHT/MegaCam exposure footprints for answering 'which images contain object X at time t'."""
+import logging
+import math
+
+import numpy
+from astropy.io import fits
+
+import storage
+import wcs
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 0.5  # degrees
+SECONDS_PER_DAY = 86400.0
+# MegaCam CCD size, used when a header (e.g. a CFHTSG .head file) does not carry NAXIS1/NAXIS2
+DEFAULT_NAXIS1 = 2112
+DEFAULT_NAXIS2 = 4644
+
+MATCH_DTYPE = [('index', numpy.int64), ('expnum', numpy.int64), ('ccd', numpy.int16),
+               ('x', numpy.float64), ('y', numpy.float64)]
+
+
+class FootprintIndex(object):
+    """
+    CCD footprints of exposures with their MJD range, filter and exposure time.
+
+    Footprints are bucketed on a TILE_SIZE degree RA/DEC grid for spatial lookups and kept sorted by start time for
+    interval lookups, so locate() can match many predicted positions against many exposures without asking SSOIS.
+    """
+
+    def __init__(self):
+        self.expnum = []
+        self.ccd = []
+        self.mjd_start = []
+        self.mjd_end = []
+        self.filter = []
+        self.exptime = []
+        self.ra_min = []
+        self.ra_max = []
+        self.dec_min = []
+        self.dec_max = []
+        self.headers = []
+        self._wcs = {}
+        self._tiles = None
+        self._order = None
+
+    def __len__(self):
+        return len(self.expnum)
+
+    def add(self, expnum, ccd, header, mjd_start=None, exptime=None, camera_filter=None):
+        """
+        Add the footprint of one CCD of an exposure.
+
+        :param expnum: CFHT exposure number
+        :param ccd: CCD in the mosaic [0-35]
+        :param header: fits.Header with the (PV distortion) WCS of the CCD
+        :param mjd_start: start of the exposure, defaults to MJD-OBS from the header
+        :param exptime: exposure time in seconds, defaults to EXPTIME from the header
+        :param camera_filter: filter name, defaults to FILTER from the header
+        """
+        if mjd_start is None:
+            mjd_start = header.get('MJD-OBS', None)
+        if exptime is None:
+            exptime = header.get('EXPTIME', 0.0)
+        if camera_filter is None:
+            camera_filter = header.get('FILTER', '')
+        if mjd_start is None:
+            raise ValueError("No start time for {} ccd {}".format(expnum, ccd))
+
+        naxis1 = header.get('NAXIS1', DEFAULT_NAXIS1)
+        naxis2 = header.get('NAXIS2', DEFAULT_NAXIS2)
+        pvwcs = wcs.WCS(header)
+        corners = [pvwcs.xy2sky(x, y) for x, y in ((1, 1), (naxis1, 1), (naxis1, naxis2), (1, naxis2))]
+        ras = numpy.array([corner[0] for corner in corners])
+        decs = numpy.array([corner[1] for corner in corners])
+        if ras.max() - ras.min() > 180:
+            # footprint straddles RA=0, store it with RA running past 360
+            ras = numpy.where(ras < 180, ras + 360, ras)
+
+        self.expnum.append(int(expnum))
+        self.ccd.append(int(ccd))
+        self.mjd_start.append(float(mjd_start))
+        self.mjd_end.append(float(mjd_start) + float(exptime) / SECONDS_PER_DAY)
+        self.filter.append(str(camera_filter))
+        self.exptime.append(float(exptime))
+        self.ra_min.append(ras.min())
+        self.ra_max.append(ras.max())
+        self.dec_min.append(decs.min())
+        self.dec_max.append(decs.max())
+        self.headers.append(header)
+        self._tiles = None
+        self._order = None
+
+    def add_exposure(self, expnum, mjd_start=None, exptime=None, camera_filter=None, version='p'):
+        """
+        Add every CCD of an exposure using the astrometric headers cached by storage.get_astheader.
+
+        The CFHTSG .head files carry the WCS but neither EXPTIME nor FILTER: give them (add_cone_search takes them
+        from the TAP query), or they are taken from the primary header if it has them.
+        """
+        headers = storage.get_astheader(expnum, ccd=None, version=version)
+        primary = headers[0] is not None and headers[0] or {}
+        if exptime is None:
+            exptime = primary.get('EXPTIME', None)
+        if camera_filter is None:
+            camera_filter = primary.get('FILTER', None)
+        for ccd, header in enumerate(headers[1:]):
+            if header is None or 'CRVAL1' not in header:
+                continue
+            self.add(expnum, ccd, header, mjd_start=mjd_start, exptime=exptime, camera_filter=camera_filter)
+
+    def add_cone_search(self, ra, dec, dra=0.01, ddec=0.01, version='p'):
+        """
+        Add every exposure that a storage.cone_search TAP query returns for this part of the sky.
+        """
+        table = storage.cone_search(ra, dec, dra=dra, ddec=ddec)
+        known = set(self.expnum)
+        for row in table:
+            expnum = int(str(row['collectionID']).strip('op'))
+            if expnum in known:
+                continue
+            known.add(expnum)
+            mjd_start = float(row['mjdate'])
+            try:
+                self.add_exposure(expnum, mjd_start=mjd_start,
+                                  exptime=(float(row['mjdend']) - mjd_start) * SECONDS_PER_DAY,
+                                  camera_filter=str(row['filter']), version=version)
+            except Exception as e:
+                logger.warning("Could not add footprint of {}: {}".format(expnum, e))
+
+    @staticmethod
+    def _tile_keys(ra, dec):
+        nra = int(round(360.0 / TILE_SIZE))
+        return (numpy.floor((numpy.asarray(dec) + 90.0) / TILE_SIZE).astype(numpy.int64) * nra +
+                numpy.floor(numpy.mod(ra, 360.0) / TILE_SIZE).astype(numpy.int64) % nra)
+
+    def _build(self):
+        """
+        Build the tile and time-ordered lookups from the footprint lists.
+        """
+        if self._tiles is not None:
+            return
+        self._arrays = dict((name, numpy.array(getattr(self, name))) for name in
+                            ['expnum', 'ccd', 'mjd_start', 'mjd_end', 'exptime',
+                             'ra_min', 'ra_max', 'dec_min', 'dec_max'])
+        tiles = {}
+        for idx in range(len(self)):
+            dec_steps = numpy.arange(math.floor(self.dec_min[idx] / TILE_SIZE),
+                                     math.floor(self.dec_max[idx] / TILE_SIZE) + 1) * TILE_SIZE
+            ra_steps = numpy.arange(math.floor(self.ra_min[idx] / TILE_SIZE),
+                                    math.floor(self.ra_max[idx] / TILE_SIZE) + 1) * TILE_SIZE
+            for tile_dec in dec_steps:
+                # tile centres, so a footprint edge sitting on a tile boundary is not rounded into the wrong tile
+                for key in self._tile_keys(ra_steps + TILE_SIZE / 2.0,
+                                           numpy.zeros(len(ra_steps)) + tile_dec + TILE_SIZE / 2.0):
+                    tiles.setdefault(key, []).append(idx)
+        self._tiles = dict((key, numpy.array(members)) for key, members in tiles.items())
+        self._order = numpy.argsort(self._arrays['mjd_start'])
+        self._sorted_start = self._arrays['mjd_start'][self._order]
+        self._max_duration = len(self) and (self._arrays['mjd_end'] - self._arrays['mjd_start']).max() or 0.0
+
+    def predict(self, mjd, ra, dec):
+        """
+        Interpolate an ephemeris to the middle of every exposure in the index taken while it runs.
+
+        :param mjd: increasing epochs of the ephemeris, e.g. a daily Horizons table
+        :param ra: RA at those epochs, degrees
+        :param dec: DEC at those epochs, degrees
+        :return: (mjd, ra, dec) arrays for locate() or locate_objects()
+        """
+        self._build()
+        mjd = numpy.asarray(mjd, dtype=numpy.float64)
+        epochs = numpy.unique((self._arrays['mjd_start'] + self._arrays['mjd_end']) / 2.0)
+        epochs = epochs[(epochs >= mjd[0]) & (epochs <= mjd[-1])]
+        # unwrapped, so an object crossing RA=0 is interpolated the short way round
+        ra = numpy.degrees(numpy.unwrap(numpy.radians(numpy.asarray(ra, dtype=numpy.float64))))
+        return epochs, numpy.mod(numpy.interp(epochs, mjd, ra), 360.0), numpy.interp(epochs, mjd, dec)
+
+    def during(self, mjd, time_tolerance=0.0):
+        """
+        Indices of the footprints whose exposure was open at mjd (+/- time_tolerance days).
+        """
+        self._build()
+        lo = numpy.searchsorted(self._sorted_start, mjd - self._max_duration - time_tolerance, side='left')
+        hi = numpy.searchsorted(self._sorted_start, mjd + time_tolerance, side='right')
+        candidates = self._order[lo:hi]
+        return candidates[self._arrays['mjd_end'][candidates] >= mjd - time_tolerance]
+
+    def locate(self, ra, dec, mjd, time_tolerance=0.0, camera_filter=None):
+        """
+        Find the exposures and CCDs that contain each predicted position at its epoch.
+
+        :param ra: array of predicted RA, degrees
+        :param dec: array of predicted DEC, degrees
+        :param mjd: array of the epochs of the predictions
+        :param time_tolerance: days by which the exposure intervals are widened
+        :param camera_filter: only match exposures taken in this filter
+        :return: numpy record array of (index, expnum, ccd, x, y), index being the position of the prediction
+        """
+        self._build()
+        ra = numpy.mod(numpy.atleast_1d(numpy.asarray(ra, dtype=numpy.float64)), 360.0)
+        dec = numpy.atleast_1d(numpy.asarray(dec, dtype=numpy.float64))
+        mjd = numpy.atleast_1d(numpy.asarray(mjd, dtype=numpy.float64))
+        keys = self._tile_keys(ra, dec)
+        arrays = self._arrays
+        matches = []
+        for key in numpy.unique(keys):
+            members = self._tiles.get(key, None)
+            if members is None:
+                continue
+            points = numpy.flatnonzero(keys == key)
+            p_ra = ra[points][:, None]
+            p_dec = dec[points][:, None]
+            p_mjd = mjd[points][:, None]
+            # (points x members) masks: time interval, then bounding box; wrapped footprints run past RA=360
+            hit = ((arrays['mjd_start'][members] - time_tolerance <= p_mjd) &
+                   (arrays['mjd_end'][members] + time_tolerance >= p_mjd) &
+                   (arrays['dec_min'][members] <= p_dec) & (arrays['dec_max'][members] >= p_dec) &
+                   (((arrays['ra_min'][members] <= p_ra) & (arrays['ra_max'][members] >= p_ra)) |
+                    ((arrays['ra_min'][members] <= p_ra + 360) & (arrays['ra_max'][members] >= p_ra + 360))))
+            if camera_filter is not None:
+                hit &= numpy.array([self.filter[member] == camera_filter for member in members])[None, :]
+            for point_idx, member_idx in zip(*numpy.nonzero(hit)):
+                point = points[point_idx]
+                footprint = members[member_idx]
+                header = self.headers[footprint]
+                if footprint not in self._wcs:
+                    self._wcs[footprint] = wcs.WCS(header)
+                x, y = self._wcs[footprint].sky2xy(ra[point], dec[point])
+                if 0.5 <= x <= header.get('NAXIS1', DEFAULT_NAXIS1) + 0.5 and \
+                        0.5 <= y <= header.get('NAXIS2', DEFAULT_NAXIS2) + 0.5:
+                    matches.append((point, self.expnum[footprint], self.ccd[footprint], x, y))
+        matches.sort()
+        return numpy.array(matches, dtype=MATCH_DTYPE)
+
+    def save(self, filename):
+        """
+        Write the index to a numpy .npz file, headers stored as FITS card strings.
+        """
+        numpy.savez(filename,
+                    expnum=self.expnum, ccd=self.ccd, mjd_start=self.mjd_start, exptime=self.exptime,
+                    filter=self.filter,
+                    headers=numpy.array([header.tostring() for header in self.headers]))
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        data = numpy.load(filename)
+        for expnum, ccd, mjd_start, exptime, camera_filter, header_str in zip(
+                data['expnum'], data['ccd'], data['mjd_start'], data['exptime'], data['filter'], data['headers']):
+            index.add(expnum, ccd, fits.Header.fromstring(str(header_str)), mjd_start=mjd_start, exptime=exptime,
+                      camera_filter=camera_filter)
+        return index
+
+
+def locate_objects(index, predictions, time_tolerance=0.0, camera_filter=None):
+    """
+    Join the predicted positions of many objects against the footprint index.
+
+    :param index: FootprintIndex
+    :param predictions: dict of object name -> (mjd, ra, dec) arrays, see FootprintIndex.predict
+    :return: list of (object name, expnum, ccd, x, y, mjd, ra, dec) tuples
+    """
+    names = []
+    mjd = []
+    ra = []
+    dec = []
+    for name, (obj_mjd, obj_ra, obj_dec) in predictions.items():
+        obj_mjd = numpy.atleast_1d(obj_mjd)
+        names.extend([name] * len(obj_mjd))
+        mjd.append(obj_mjd)
+        ra.append(numpy.atleast_1d(obj_ra))
+        dec.append(numpy.atleast_1d(obj_dec))
+    if len(names) == 0:
+        return []
+    mjd = numpy.concatenate(mjd)
+    ra = numpy.concatenate(ra)
+    dec = numpy.concatenate(dec)
+    matches = index.locate(ra, dec, mjd, time_tolerance=time_tolerance, camera_filter=camera_filter)
+    return [(names[match['index']], match['expnum'], match['ccd'], match['x'], match['y'], mjd[match['index']],
+             ra[match['index']], dec[match['index']]) for match in matches]
@@ -0,0 +1,174 @@
+"""LRU bounded cache of FITS headers, backed by an on-disk store shared between processes."""
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from astropy.io import fits
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv('OSSOS_HEADER_CACHE', os.path.join(os.getenv('HOME', '.'), '.ossos_header_cache'))
+MAX_BYTES = int(os.getenv('OSSOS_HEADER_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+def _header_bytes(value):
+    if value is None:
+        return 0
+    if isinstance(value, (list, tuple)):
+        return sum(_header_bytes(header) for header in value)
+    return len(value) * fits.Card.length
+
+
+def _dump(value):
+    if isinstance(value, (list, tuple)):
+        # e.g. the headers of a whole exposure, which start with a None placeholder
+        return {'list': [None if header is None else header.tostring() for header in value]}
+    return {'header': value.tostring()}
+
+
+def _load(entry):
+    if 'list' in entry:
+        return [None if header_str is None else fits.Header.fromstring(str(header_str))
+                for header_str in entry['list']]
+    return fits.Header.fromstring(str(entry['header']))
+
+
+class HeaderCache(object):
+    """
+    A dict-like cache of fits.Header objects (or lists of them, as returned for a whole exposure) keyed by URI.
+
+    At most max_bytes of header cards are kept in memory, least recently used first out.  Every entry is also
+    written to cache_dir/name, so other processes (and later runs) find it on disk instead of asking CADC again.
+    """
+
+    def __init__(self, name, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, persistent=True):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.directory = persistent and os.path.join(cache_dir, name) or None
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+        if self.directory is not None and not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _filename(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.json')
+
+    def _remember(self, key, value):
+        if key in self._entries:
+            self.bytes -= self._sizes.pop(key)
+            del self._entries[key]
+        size = _header_bytes(value)
+        self._entries[key] = value
+        self._sizes[key] = size
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            old_key, _ = self._entries.popitem(last=False)
+            self.bytes -= self._sizes.pop(old_key)
+            self.evictions += 1
+
+    def _read_disk(self, key):
+        if self.directory is None:
+            return None
+        filename = self._filename(key)
+        if not os.access(filename, os.R_OK):
+            return None
+        try:
+            with open(filename) as fobj:
+                entry = json.load(fobj)
+            return _load(entry)
+        except Exception as e:
+            logger.warning("Ignoring unreadable cached header {}: {}".format(filename, e))
+            return None
+
+    def _write_disk(self, key, value):
+        if self.directory is None:
+            return
+        entry = _dump(value)
+        entry['key'] = key
+        # write then rename so a concurrent reader never sees a partial entry
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(entry, fobj)
+        os.rename(tmp_name, self._filename(key))
+
+    def get(self, key, default=None):
+        """
+        Look key up in memory, then on disk; counts towards the hit rate.
+        """
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value  # most recently used
+                self.hits += 1
+                metrics.cache_lookup(self.name, True, tier='memory')
+                return value
+            value = self._read_disk(key)
+            if value is not None:
+                self.disk_hits += 1
+                metrics.cache_lookup(self.name, True, tier='disk')
+                self._remember(key, value)
+                return value
+            self.misses += 1
+            metrics.cache_lookup(self.name, False)
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+        self._write_disk(key, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """
+        Empty the in-memory cache, the disk store is kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return lookups and float(self.hits + self.disk_hits) / lookups or 0.0
+
+    def stats(self):
+        return {'name': self.name,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hit_rate()}
@@ -4,11 +4,12 @@
 # rewritten and documented by Michele Bannister, Dec 2010
 # rewritten again by MB, Jan 2015
 
-import urllib2 as url
 import time
-import io
 
-import pandas as pd
+import cadc_session
+import horizons_parser
+import metrics
+import services
 
 
 '''
@@ -65,6 +66,28 @@ def parse_orbital_elements(urlData):
         return None
 
 
+@metrics.timer(metrics.HORIZONS_QUERY)
+def query(urlStr):
+    """
+    Send a batch query url to Horizons and parse the ephemeris table out of the response as it is read.
+    If Horizons is busy, wait and try again in a minute.
+
+    :param urlStr: a horizons_batch.cgi url
+    :return: horizons_parser.Ephemerides
+    """
+    while True:
+        response = cadc_session.get_session().get(urlStr, stream=True)
+        try:
+            response.raise_for_status()
+            return horizons_parser.parse(response.iter_lines())
+        except horizons_parser.HorizonsBusyError as e:
+            print e
+            print "Sleeping 60 s and trying again"
+            time.sleep(60)
+        finally:
+            response.close()
+
+
 # Run a Horizons query
 # eg. output = batch("Haumea", "2010-12-28 10:00", "2010-12-29 10:00", 1, su='d')
 
@@ -86,7 +109,7 @@ def batch(object, t, T, step, su='d',
             s += "{},".format(p)
 
     # The pieces of the url that Horizons needs for its processing instructions. Leave intact.
-    urlArr = ["http://ssd.jpl.nasa.gov/horizons_batch.cgi?batch=1&COMMAND=",
+    urlArr = [services.HORIZONS_URL + "?batch=1&COMMAND=",
               '',
               "&MAKE_EPHEM='YES'&TABLE_TYPE='OBSERVER'&START_TIME=",
               '',
@@ -116,41 +139,8 @@ def batch(object, t, T, step, su='d',
 
     urlStr = "".join(urlArr)  # create the url to pass to Horizons
 
-    # Query Horizons; if it's busy, wait and try again in a minute
-    done = 0
-    while not done:
-        urlHan = url.urlopen(urlStr)
-        urlData = urlHan.readlines()
-        urlHan.close()
-        if len(urlData[0].split()) > 1:
-            if "BUSY:" <> urlData[0].split()[1]:
-                done = 1
-            else:
-                print urlData[0],
-                print "Sleeping 60 s and trying again"
-                time.sleep(60)
-        else:
-            done = 1
-
-    EPHEM_CSV_START_MARKER = '$$SOE'
-    EPHEM_CSV_END_MARKER = '$$EOE'
-    ephemCSV_start = None
-    ephemCSV_end = None
-    for i, dataLine in enumerate(urlData):
-        if dataLine.strip() == EPHEM_CSV_START_MARKER:
-            ephemCSV_start = i
-        elif dataLine.strip() == EPHEM_CSV_END_MARKER:
-            ephemCSV_end = i
-    assert ephemCSV_start is not None, 'No ephem start'
-    assert ephemCSV_end is not None, 'No ephem end'
-    assert ephemCSV_start < ephemCSV_end, 'Ephem are a bit odd'
-    # The header, the lines *after* the start marker, up to (but not including, because it is a slice) the end marker
-    csv_lines = [urlData[ephemCSV_start - 2]] + urlData[ephemCSV_start + 1: ephemCSV_end]
-    ephemCSV = ''.join(csv_lines)
-    ephemCSVfile = io.BytesIO(ephemCSV)
-    ephemerides = pd.DataFrame.from_csv(ephemCSVfile)
-
-    orbital_elements = parse_orbital_elements(urlData)
+    ephemerides = query(urlStr)
+    orbital_elements = parse_orbital_elements(ephemerides.header_lines)
 
     return orbital_elements, ephemerides
 
@@ -160,4 +150,4 @@ if __name__ == "__main__":
 
     # just a few test print statements
     print(elems)  # elements
-    print(ephems.keys())
+    print(ephems.names)
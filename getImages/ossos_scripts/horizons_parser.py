@@ -0,0 +1,169 @@
+"""Single pass parser for the CSV ephemeris tables returned by JPL Horizons batch queries."""
+import logging
+import re
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+EPHEM_CSV_START_MARKER = '$$SOE'
+EPHEM_CSV_END_MARKER = '$$EOE'
+BUSY_MARKER = 'BUSY:'
+
+RA_DEG_COLUMN = 'RA_deg'
+DEC_DEG_COLUMN = 'DEC_deg'
+
+_RA_COLUMN = re.compile(r'^R\.A\._\(')
+_DEC_COLUMN = re.compile(r'^DEC_\(')
+_MISSING = ['n.a.', '']
+
+
+class HorizonsBusyError(IOError):
+    """Horizons answered the batch query with a BUSY message."""
+    pass
+
+
+class Ephemerides(object):
+    """
+    The columns of a Horizons ephemeris table as NumPy arrays.
+
+    Columns keep the order (and, stripped of white space, the names) that
+    Horizons uses in the CSV header.  Columns that are entirely numeric are
+    float arrays with n.a. entries set to NaN, everything else is an array of
+    stripped strings.  If the table has sexagesimal RA/DEC columns these are
+    also provided, in degrees, as RA_deg and DEC_deg.
+    """
+
+    def __init__(self, names, columns, header_lines):
+        self.names = names
+        self.columns = columns
+        self.header_lines = header_lines
+
+    def __len__(self):
+        if len(self.names) == 0:
+            return 0
+        return len(self.columns[self.names[0]])
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def column(self, idx):
+        """
+        The idx'th column after the date column, the same column that pandas.DataFrame.icol(idx) gave
+        when the table was read with the date as the index.
+        """
+        return self.columns[self.names[idx + 1]]
+
+    @property
+    def dates(self):
+        return self.columns[self.names[0]]
+
+
+def _split(line):
+    return [value.strip() for value in line.rstrip('\r\n').split(',')]
+
+
+def _to_array(values):
+    """
+    Convert a list of strings to a float array if every entry is numeric (or n.a.), else a string array.
+    """
+    try:
+        return numpy.array([value in _MISSING and numpy.nan or float(value) for value in values],
+                           dtype=numpy.float64)
+    except ValueError:
+        return numpy.array(values)
+
+
+def sexagesimal_to_degrees(values, hours=False):
+    """
+    Convert an array of 'DD MM SS.s' (or 'HH MM SS.ss') strings to decimal degrees in one numpy operation.
+
+    :param values: sequence of sexagesimal strings
+    :param hours: the values are hours of RA rather than degrees
+    :return: numpy.ndarray of degrees
+    """
+    values = numpy.asarray(values)
+    if len(values) == 0:
+        return numpy.zeros(0)
+    parts = numpy.array([value.split() for value in values], dtype=numpy.float64)
+    negative = numpy.char.startswith(numpy.char.strip(values.astype(str)), '-')
+    degrees = numpy.abs(parts[:, 0]) + parts[:, 1] / 60.0 + parts[:, 2] / 3600.0
+    degrees = numpy.where(negative, -degrees, degrees)
+    if hours:
+        degrees *= 15.0
+    return degrees
+
+
+def parse(stream):
+    """
+    Read a Horizons batch response incrementally and return the ephemeris table.
+
+    The response is consumed line by line in a single pass: lines before the $$SOE marker are kept
+    (they hold the orbital elements and, two lines before the marker, the CSV column names), rows are
+    collected up to the $$EOE marker and the remainder of the response is never read.
+
+    :param stream: any iterable of lines, e.g. an open url handle or a list of strings.
+    :return: Ephemerides
+    :raise: HorizonsBusyError if Horizons is busy, AssertionError if the table markers are missing.
+    """
+    header_lines = []
+    rows = []
+    in_table = False
+    ended = False
+    for line in stream:
+        if not in_table:
+            if len(header_lines) == 0 and len(line.split()) > 1 and line.split()[1] == BUSY_MARKER:
+                raise HorizonsBusyError(line.strip())
+            if line.strip() == EPHEM_CSV_START_MARKER:
+                in_table = True
+                continue
+            header_lines.append(line)
+            continue
+        if line.strip() == EPHEM_CSV_END_MARKER:
+            ended = True
+            break
+        rows.append(_split(line))
+
+    assert in_table, 'No ephem start'
+    assert ended, 'No ephem end'
+    assert len(header_lines) > 1, 'Ephem are a bit odd'
+
+    names = _split(header_lines[-2])
+    # Horizons ends each row with a ',' which leaves an unnamed trailing column; drop it.
+    if len(names) > 1 and names[-1] == '':
+        names = names[:-1]
+    ncols = len(names)
+    for idx, row in enumerate(rows):
+        if len(row) < ncols:
+            row.extend([''] * (ncols - len(row)))
+        rows[idx] = row[:ncols]
+
+    # blank column names (the solar/lunar presence flags) are made unique so no column is lost.
+    unique_names = []
+    for idx, name in enumerate(names):
+        if name == '' or name in unique_names:
+            name = '{}_{}'.format(name, idx)
+        unique_names.append(name)
+
+    columns = {}
+    if len(rows) > 0:
+        transposed = zip(*rows)
+    else:
+        transposed = [[] for _ in unique_names]
+    for name, values in zip(unique_names, transposed):
+        if name == unique_names[0]:
+            columns[name] = numpy.array(values)
+        else:
+            columns[name] = _to_array(list(values))
+
+    for name in unique_names:
+        if _RA_COLUMN.match(name) and columns[name].dtype.kind in 'SU':
+            columns[RA_DEG_COLUMN] = sexagesimal_to_degrees(columns[name], hours=True)
+        elif _DEC_COLUMN.match(name) and columns[name].dtype.kind in 'SU':
+            columns[DEC_DEG_COLUMN] = sexagesimal_to_degrees(columns[name])
+
+    logger.debug("Parsed {} ephemeris rows with columns {}".format(len(rows), unique_names))
+    return Ephemerides(unique_names, columns, header_lines)
@@ -0,0 +1,264 @@
+"""Low overhead timers and counters for the pipeline stages, exportable as JSON and Prometheus text."""
+import atexit
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+# OSSOS_METRICS=/path/run writes /path/run.json and /path/run.prom every OSSOS_METRICS_INTERVAL seconds and at exit
+EXPORT_PREFIX = os.getenv('OSSOS_METRICS', None)
+EXPORT_INTERVAL = float(os.getenv('OSSOS_METRICS_INTERVAL', 60))
+NAMESPACE = 'ossos'
+
+# the stages the pipeline reports time for
+FAMILY_LOOKUP = 'family_lookup'
+SSOIS_QUERY = 'ssois_query'
+HORIZONS_QUERY = 'horizons_query'
+CUTOUT_DOWNLOAD = 'cutout_download'
+VOSPACE_IO = 'vospace_io'
+SEP_EXTRACTION = 'sep_extraction'
+CATALOGUE_MATCH = 'catalogue_match'
+IDENTIFICATION = 'identification'
+
+
+class Registry(object):
+    """
+    Stage timers (calls, total and maximum seconds) and labelled counters, behind one lock.
+
+    Counters are keyed by (name, sorted label items) so that incrementing one is a dict update.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._timers = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            timer = self._timers.get(stage)
+            if timer is None:
+                timer = self._timers[stage] = [0, 0.0, 0.0]
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._timers.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """
+        The metrics as plain data: {'uptime', 'stages': {stage: {calls, seconds, max_seconds}}, 'counters': [...]}.
+        """
+        with self._lock:
+            stages = dict((stage, {'calls': calls, 'seconds': seconds, 'max_seconds': longest})
+                          for stage, (calls, seconds, longest) in self._timers.items())
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+        return {'uptime': time.time() - self.started, 'stages': stages, 'counters': counters}
+
+
+registry = Registry()
+
+# (enter, exit) callables run around every timed stage, e.g. by profiling; empty unless someone asks
+_stage_hooks = []
+
+
+def add_stage_hook(enter, exit):
+    """
+    Call enter(stage) as each timed stage starts and exit(stage) as it ends, in the thread running it.
+    """
+    _stage_hooks.append((enter, exit))
+
+
+class timer(object):
+    """
+    Time a block, or a function when used as a decorator, as one call of a stage:
+
+        with metrics.timer(metrics.CATALOGUE_MATCH):
+            ...
+
+        @metrics.timer(metrics.SEP_EXTRACTION)
+        def sep_phot(data, ap, th):
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self._local = threading.local()
+
+    def __enter__(self):
+        for enter, _ in _stage_hooks:
+            enter(self.stage)
+        self._local.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.observe(self.stage, time.time() - self._local.start)
+        for _, exit in _stage_hooks:
+            exit(self.stage)
+        return False
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            for enter, _ in _stage_hooks:
+                enter(self.stage)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                registry.observe(self.stage, time.time() - start)
+                for _, exit in _stage_hooks:
+                    exit(self.stage)
+        return wrapper
+
+
+def incr(name, value=1, **labels):
+    """
+    Add value to the counter name{labels}.
+    """
+    registry.incr(name, value, **labels)
+
+
+def cache_lookup(cache, hit, **labels):
+    """
+    Count a hit or a miss of the named cache.
+    """
+    registry.incr(hit and 'cache_hits' or 'cache_misses', 1, cache=cache, **labels)
+
+
+def record_response(response, *args, **kwargs):
+    """
+    requests response hook counting requests and bytes per host, installed on the shared session.
+    """
+    request = response.request
+    host = urlparse.urlsplit(request.url).hostname or ''
+    registry.incr('http_requests', 1, host=host, method=request.method, status=str(response.status_code))
+    body = request.body
+    if isinstance(body, basestring):
+        registry.incr('http_sent_bytes', len(body), host=host)
+    if kwargs.get('stream'):
+        # a streamed body is not read here, count what the server announced
+        length = response.headers.get('Content-Length', '')
+        nbytes = int(length) if length.isdigit() else 0
+    else:
+        # requests reads it right after the hooks anyway
+        nbytes = len(response.content)
+    registry.incr('http_received_bytes', nbytes, host=host)
+    return response
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+def to_json():
+    return json.dumps(snapshot(), indent=1, sort_keys=True)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+def to_prometheus():
+    """
+    The metrics in the Prometheus text exposition format.
+    """
+    data = snapshot()
+    lines = ['# TYPE {}_uptime_seconds gauge'.format(NAMESPACE),
+             '{}_uptime_seconds {:.3f}'.format(NAMESPACE, data['uptime'])]
+    for metric, field, kind in (('stage_calls_total', 'calls', 'counter'),
+                                ('stage_seconds_total', 'seconds', 'counter'),
+                                ('stage_seconds_max', 'max_seconds', 'gauge')):
+        lines.append('# TYPE {}_{} {}'.format(NAMESPACE, metric, kind))
+        for stage, values in sorted(data['stages'].items()):
+            lines.append('{}_{}{} {}'.format(NAMESPACE, metric, _labels({'stage': stage}), values[field]))
+    seen = set()
+    for counter in data['counters']:
+        name = '{}_{}_total'.format(NAMESPACE, counter['name'])
+        if name not in seen:
+            lines.append('# TYPE {} counter'.format(name))
+            seen.add(name)
+        lines.append('{}{} {}'.format(name, _labels(counter['labels']), counter['value']))
+    return '\n'.join(lines) + '\n'
+
+
+def _write(filename, text):
+    # write then rename, a monitor polling the file never reads half of it
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fobj:
+        fobj.write(text)
+    os.rename(tmp_name, filename)
+
+
+def export(prefix):
+    """
+    Write prefix.json and prefix.prom.
+    """
+    _write(prefix + '.json', to_json())
+    _write(prefix + '.prom', to_prometheus())
+
+
+class Exporter(threading.Thread):
+    """
+    Exports the metrics every interval seconds, and once more at exit.
+    """
+
+    def __init__(self, prefix, interval=EXPORT_INTERVAL):
+        threading.Thread.__init__(self, name='metrics-exporter')
+        self.daemon = True
+        self.prefix = prefix
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.export()
+
+    def export(self):
+        try:
+            export(self.prefix)
+        except (IOError, OSError) as e:
+            logger.warning("Could not export metrics to {}: {}".format(self.prefix, e))
+
+    def stop(self):
+        self._stop_event.set()
+        self.export()
+
+
+_exporter = None
+
+
+def start_exporter(prefix=EXPORT_PREFIX, interval=EXPORT_INTERVAL):
+    """
+    Start exporting to prefix.json/.prom in the background, if not already.
+    """
+    global _exporter
+    if _exporter is None and prefix:
+        _exporter = Exporter(prefix, interval)
+        _exporter.start()
+        atexit.register(_exporter.stop)
+    return _exporter
+
+
+if EXPORT_PREFIX:
+    start_exporter()
@@ -0,0 +1,217 @@
+"""Opt-in cProfile or sampling profiles of the pipeline stages timed by metrics, one output file per stage and worker."""
+import atexit
+import collections
+import cProfile
+import logging
+import os
+import resource
+import sys
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tracemalloc  # python 3, or the pytracemalloc backport
+except ImportError:
+    tracemalloc = None
+
+CPROFILE = 'cprofile'
+SAMPLE = 'sample'
+MODES = [CPROFILE, SAMPLE]
+STAGES = [metrics.FAMILY_LOOKUP, metrics.SSOIS_QUERY, metrics.HORIZONS_QUERY, metrics.CUTOUT_DOWNLOAD,
+          metrics.VOSPACE_IO, metrics.SEP_EXTRACTION, metrics.CATALOGUE_MATCH, metrics.IDENTIFICATION]
+DEFAULT_DIR = 'profiles'
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+TOP_ALLOCATIONS = 50
+
+
+def add_arguments(parser):
+    """
+    The --profile options shared by the pipeline scripts.
+    """
+    parser.add_argument("--profile",
+                        choices=MODES,
+                        default=None,
+                        help='Profile the pipeline stages: cprofile writes <stage>.<pid>.<thread>.pstats, '
+                             'sample writes flame graph ready <stage>.<pid>.<thread>.folded stack counts.')
+    parser.add_argument("--profile-stages",
+                        nargs='+',
+                        choices=STAGES,
+                        default=STAGES,
+                        help='Stages to profile, default all.')
+    parser.add_argument("--profile-dir",
+                        default=DEFAULT_DIR,
+                        help='Directory the profiles are written to.')
+    parser.add_argument("--tracemalloc",
+                        action='store_true',
+                        help='Also record how much memory each stage grows the process by, and the '
+                             'allocation hot spots (with tracemalloc).')
+
+
+def from_args(args):
+    """
+    Start profiling as asked for on the command line, if at all.
+    """
+    if args.profile is None and not args.tracemalloc:
+        return None
+    return start(args.profile, stages=args.profile_stages, output_dir=args.profile_dir,
+                 trace_malloc=args.tracemalloc)
+
+
+class Profiler(object):
+    """
+    Follows metrics stage entries and exits.  In cprofile mode each (stage, thread) gets its own cProfile.Profile
+    that is only enabled while that thread is in that stage; in sample mode a background thread snapshots the stacks
+    of the threads in a profiled stage every interval.  Profiled stages do not nest: a stage entered from inside
+    a profiled one is accounted to the outer one.  Everything is written out by dump(), which runs at exit.
+    """
+
+    def __init__(self, mode, stages=STAGES, output_dir=DEFAULT_DIR, interval=SAMPLE_INTERVAL, trace_malloc=False):
+        self.mode = mode
+        self.stages = set(stages)
+        self.output_dir = output_dir
+        self.interval = interval
+        self.profiles = {}  # (stage, thread name) -> cProfile.Profile
+        self.samples = collections.defaultdict(collections.Counter)  # (stage, thread name) -> folded stack counts
+        self.active = {}  # thread ident -> (stage, thread name)
+        self.memory = {}  # stage -> [passes, summed growth, largest growth] of traced memory or RSS
+        self.trace_malloc = trace_malloc
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        if trace_malloc:
+            if tracemalloc is None:
+                logger.warning("tracemalloc is not available, recording the RSS growth of each stage instead")
+            elif not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+        if mode == SAMPLE:
+            self._sampler = threading.Thread(target=self._sample, name='profile-sampler')
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def enter(self, stage):
+        if stage not in self.stages or getattr(self._local, 'stage', None) is not None:
+            return
+        self._local.stage = stage
+        if self.trace_malloc:
+            self._local.memory = _current_memory()
+        key = (stage, threading.current_thread().name)
+        if self.mode == CPROFILE:
+            with self._lock:
+                profile = self.profiles.get(key)
+                if profile is None:
+                    profile = self.profiles[key] = cProfile.Profile()
+            self._local.profile = profile
+            profile.enable()
+        elif self.mode == SAMPLE:
+            with self._lock:
+                self.active[threading.current_thread().ident] = key
+
+    def exit(self, stage):
+        if getattr(self._local, 'stage', None) != stage:
+            return
+        self._local.stage = None
+        if self.mode == CPROFILE:
+            self._local.profile.disable()
+        elif self.mode == SAMPLE:
+            with self._lock:
+                self.active.pop(threading.current_thread().ident, None)
+        if self.trace_malloc:
+            self._record_memory(stage)
+
+    def _record_memory(self, stage):
+        # what the process holds now less what it held when the stage was entered; tracing is process wide, so
+        # stages running on other threads at the same time add to it too
+        growth = _current_memory() - self._local.memory
+        with self._lock:
+            passes, total, largest = self.memory.get(stage, (0, 0, growth))
+            self.memory[stage] = [passes + 1, total + growth, max(largest, growth)]
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                active = dict(self.active)
+            if len(active) == 0:
+                continue
+            frames = sys._current_frames()
+            for ident, key in active.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                folded = ';'.join(reversed(stack))
+                with self._lock:
+                    self.samples[key][folded] += 1
+
+    def _filename(self, stage, thread_name, suffix):
+        return os.path.join(self.output_dir, '{}.{}.{}.{}'.format(stage, os.getpid(), thread_name, suffix))
+
+    def dump(self):
+        """
+        Write a .pstats (cprofile) or .folded (sample) file per stage and thread, and the allocation report.
+        """
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        with self._lock:
+            for (stage, thread_name), profile in self.profiles.items():
+                profile.dump_stats(self._filename(stage, thread_name, 'pstats'))
+            for (stage, thread_name), counts in self.samples.items():
+                with open(self._filename(stage, thread_name, 'folded'), 'w') as outfile:
+                    for stack, count in counts.most_common():
+                        outfile.write('{} {}\n'.format(stack, count))
+            if self.trace_malloc:
+                self._dump_memory()
+        logger.info("Profiles written to {}".format(self.output_dir))
+
+    def _dump_memory(self):
+        filename = os.path.join(self.output_dir, 'memory.{}.txt'.format(os.getpid()))
+        with open(filename, 'w') as outfile:
+            unit = tracemalloc is not None and 'bytes traced' or 'kB RSS'
+            outfile.write('stage\tpasses\tgrowth\tlargest growth in one pass\t({})\n'.format(unit))
+            for stage, (passes, total, largest) in sorted(self.memory.items()):
+                outfile.write('{}\t{}\t{}\t{}\n'.format(stage, passes, total, largest))
+            if tracemalloc is not None and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                snapshot.dump(os.path.join(self.output_dir, 'tracemalloc.{}.snapshot'.format(os.getpid())))
+                outfile.write('\nTop {} allocation sites\n'.format(TOP_ALLOCATIONS))
+                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    outfile.write('{}\n'.format(stat))
+
+
+def _current_memory():
+    # traced bytes if tracemalloc is on, otherwise the resident set in kB: /proc where there is one, else the peak,
+    # which only ever grows
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+_profiler = None
+
+
+def start(mode, stages=STAGES, output_dir=DEFAULT_DIR, interval=SAMPLE_INTERVAL, trace_malloc=False):
+    """
+    Start profiling the given stages for the rest of the process, the output is written at exit.
+    """
+    global _profiler
+    if _profiler is not None:
+        return _profiler
+    _profiler = Profiler(mode, stages=stages, output_dir=output_dir, interval=interval, trace_malloc=trace_malloc)
+    metrics.add_stage_hook(_profiler.enter, _profiler.exit)
+    atexit.register(_profiler.dump)
+    logger.info("Profiling {} ({}) into {}".format(', '.join(sorted(_profiler.stages)), mode, output_dir))
+    return _profiler
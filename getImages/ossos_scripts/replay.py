@@ -0,0 +1,198 @@
+"""Record the HTTP traffic of a run into a compact archive, and replay it later without the network."""
+import atexit
+import base64
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import urllib
+import urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+logger = logging.getLogger(__name__)
+
+# OSSOS_RECORD=run.jsonl.gz records every request of the shared session, OSSOS_REPLAY=run.jsonl.gz serves them back
+RECORD = os.getenv('OSSOS_RECORD', None)
+REPLAY = os.getenv('OSSOS_REPLAY', None)
+
+
+class ReplayMiss(requests.RequestException):
+    """
+    A request that is not in the replay archive; replays never fall through to the network.  Not a ConnectionError,
+    so retry loops give up on it at once.
+    """
+
+
+def request_key(method, url, body=None):
+    """
+    The key a request is recorded under: method, path, sorted query and a digest of the body.  The host is left out
+    so that a run recorded against CADC replays whatever the service URLs are set to.
+    """
+    parts = urlparse.urlsplit(url)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True)))
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    digest = hashlib.sha1(body).hexdigest()[:16] if isinstance(body, str) and body else ''
+    return ' '.join([method.upper(), parts.path, query, digest])
+
+
+class Recorder(object):
+    """
+    Appends one JSON line per response to a gzip archive; the bodies are base64 encoded.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self._fobj = gzip.open(filename, 'ab')
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def record(self, request, response):
+        entry = {'key': request_key(request.method, request.url, request.body),
+                 'url': request.url,
+                 'status': response.status_code,
+                 'reason': response.reason,
+                 'headers': dict(response.headers),
+                 'elapsed': response.elapsed.total_seconds(),
+                 'body': base64.b64encode(response.content)}
+        with self._lock:
+            if self._fobj is None:
+                return
+            self._fobj.write(json.dumps(entry) + '\n')
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._fobj is not None:
+                self._fobj.close()
+                self._fobj = None
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    A normal pooled adapter that also hands every response to a Recorder.
+    """
+
+    def __init__(self, recorder, **kwargs):
+        HTTPAdapter.__init__(self, **kwargs)
+        self.recorder = recorder
+
+    def send(self, request, **kwargs):
+        response = HTTPAdapter.send(self, request, **kwargs)
+        # reading the body here leaves it in response.content, streamed callers are served from there
+        self.recorder.record(request, response)
+        return response
+
+
+def load_archive(filename):
+    """
+    The responses of an archive grouped by request key, in the order they were recorded.
+    """
+    entries = {}
+    with gzip.open(filename, 'rb') as fobj:
+        for line in fobj:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the tail of a recording cut short
+                continue
+            entries.setdefault(entry['key'], []).append(entry)
+    return entries
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers requests from an archive.  Repeated requests get the recorded responses in order, the last one is
+    served again once they run out, so a replay is deterministic whatever the thread interleaving.
+    """
+
+    def __init__(self, filename):
+        BaseAdapter.__init__(self)
+        self.entries = load_archive(filename)
+        self.served = 0
+        self.missed = 0
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        key = request_key(request.method, request.url, request.body)
+        with self._lock:
+            entries = self.entries.get(key)
+            if not entries:
+                self.missed += 1
+                raise ReplayMiss("{} {} was not recorded".format(request.method, request.url), request=request)
+            index = self._next.get(key, 0)
+            self._next[key] = index + 1
+            self.served += 1
+        entry = entries[min(index, len(entries) - 1)]
+        return self.build_response(request, entry)
+
+    def build_response(self, request, entry):
+        body = base64.b64decode(entry['body'])
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.raw = io.BytesIO(body)
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        pass
+
+
+def install(session, pool_size=10, record=None, replay=None):
+    """
+    Mount a recording or replaying adapter on a requests.Session, as set by OSSOS_RECORD / OSSOS_REPLAY.
+
+    :return: the adapter mounted, or None when neither mode is on
+    """
+    record = record or RECORD
+    replay = replay or REPLAY
+    if replay:
+        adapter = get_replay(replay)
+        logger.info("Replaying {} recorded requests from {}".format(len(adapter.entries), replay))
+    elif record:
+        adapter = RecordingAdapter(get_recorder(record), pool_connections=4, pool_maxsize=pool_size)
+        logger.info("Recording requests to {}".format(record))
+    else:
+        return None
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return adapter
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def get_recorder(filename):
+    """
+    One Recorder per archive, shared by every session recording into it.
+    """
+    with _shared_lock:
+        if ('record', filename) not in _shared:
+            _shared[('record', filename)] = Recorder(filename)
+        return _shared[('record', filename)]
+
+
+def get_replay(filename):
+    """
+    One ReplayAdapter per archive, so every session replaying it shares the order responses are served in.
+    """
+    with _shared_lock:
+        if ('replay', filename) not in _shared:
+            _shared[('replay', filename)] = ReplayAdapter(filename)
+        return _shared[('replay', filename)]
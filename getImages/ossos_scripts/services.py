@@ -0,0 +1,32 @@
+"""Base URLs of the external services, overridable from the environment (e.g. to point at standin_server.py)."""
+import os
+import urlparse
+
+# OSSOS_STANDIN=http://localhost:8080 points every service at one local stand-in, each URL can also be set alone.
+STANDIN = os.getenv('OSSOS_STANDIN', None)
+
+
+def _url(env, default):
+    """
+    The URL of a service: the env variable if set, else the default's path on the stand-in, else the default.
+    """
+    if os.getenv(env):
+        return os.getenv(env)
+    if STANDIN:
+        parts = urlparse.urlsplit(default)
+        return STANDIN.rstrip('/') + parts.path
+    return default
+
+
+SYNCTRANS_URL = _url('CADC_SYNCTRANS_URL', "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/vospace/auth/synctrans")
+SSOS_URL = _url('CADC_SSOS_URL', "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/cadcbin/ssos/ssos.pl")
+TAP_URL = _url('CADC_TAP_URL', "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/tap/sync")
+CFHTSG_URL = _url('CADC_CFHTSG_URL', "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/data/pub/CFHTSG")
+DATA_URL = _url('CANFAR_DATA_URL', "https://www.canfar.phys.uvic.ca/data/pub/")
+VOSPACE_NODES_URL = _url('CANFAR_VOSPACE_URL', "https://www.canfar.phys.uvic.ca/vospace/nodes/")
+HORIZONS_URL = _url('JPL_HORIZONS_URL', "http://ssd.jpl.nasa.gov/horizons_batch.cgi")
+ASTDYS_URL = _url('ASTDYS_URL', "http://hamilton.dm.unipi.it/~astdys2/propsynth")
+
+if STANDIN and not os.getenv('VOSPACE_WEBSERVICE'):
+    # vos.Client reads its server from VOSPACE_WEBSERVICE, set it before the first client is built
+    os.environ['VOSPACE_WEBSERVICE'] = urlparse.urlsplit(STANDIN).netloc
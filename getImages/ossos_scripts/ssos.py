@@ -9,9 +9,17 @@ import sys
 
 import logging
 
-SSOS_URL = "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/cadcbin/ssos/ssos.pl"
+import cadc_session
+import metrics
+import services
+
+SSOS_URL = services.SSOS_URL
 RESPONSE_FORMAT = 'tsv'
 NEW_LINE = '\r\n'
+MAX_CONNECTIONS = cadc_session.MAX_CONNECTIONS
+
+# The keep-alive session shared with every other CADC call, its pool is sized for concurrent queries.
+session = cadc_session.get_session().http
 
 class ParamDictBuilder(object):
     """ Build a dictionary of parameters needed for an SSOS Query. """
@@ -24,7 +32,8 @@ class ParamDictBuilder(object):
                  search_method='bynameMPC',
                  error_units='arcseconds',
                  resolve_extension=True,
-                 resolve_position=True):
+                 resolve_position=True,
+                 telescope_instrument=None):
         self.mbcobject = mbcobject
         self.verbose = verbose
         self.search_start_date = search_start_date
@@ -33,6 +42,7 @@ class ParamDictBuilder(object):
         self.error_units = error_units
         self.resolve_extension = resolve_extension
         self.resolve_position = resolve_position
+        self.telescope_instrument = telescope_instrument
 
     @property
     def mbcobject(self):
@@ -159,21 +169,36 @@ class ParamDictBuilder(object):
             resolve_position = False
         self._resolve_position = (resolve_position and "yes") or "no"
 
+    @property
+    def telescope_instrument(self):
+        """
+        Restrict the SSOS search to frames from this telescope/instrument (eg. 'CFHT/MegaCam').
+        None searches every telescope/instrument.
+        """
+        return self._telescope_instrument
+
+    @telescope_instrument.setter
+    def telescope_instrument(self, telescope_instrument):
+        self._telescope_instrument = telescope_instrument
+
     @property
     def params(self):
         """
         The SSOS Query parameters as dictionary, appropriate for url_encoding
         """
-        return dict(format=RESPONSE_FORMAT,
-                    verbose=self.verbose,
-                    epoch1=str(self.search_start_date),
-                    epoch2=str(self.search_end_date),
-                    search=self.search_method,
-                    eunits=self.error_units,
-                    extres=self.resolve_extension,
-                    xyres=self.resolve_position,
-                    object = self.mbcobject
-                    )
+        params = dict(format=RESPONSE_FORMAT,
+                      verbose=self.verbose,
+                      epoch1=str(self.search_start_date),
+                      epoch2=str(self.search_end_date),
+                      search=self.search_method,
+                      eunits=self.error_units,
+                      extres=self.resolve_extension,
+                      xyres=self.resolve_position,
+                      object = self.mbcobject
+                      )
+        if self.telescope_instrument is not None:
+            params['telinst'] = self.telescope_instrument
+        return params
                    
                     # obs=NEW_LINE.join((str(observation) for observation in self.observations))
 
@@ -197,13 +222,18 @@ class Query(object):
     def __init__(self,
                  mbcobject,
                  search_start_date=Time('2013-01-01', scale='utc'),
-                 search_end_date=Time('2017-01-01', scale='utc')):
+                 search_end_date=Time('2017-01-01', scale='utc'),
+                 telescope_instrument=None,
+                 http_session=None):
         self.param_dict_builder = ParamDictBuilder( mbcobject,
                 search_start_date=search_start_date,
-                search_end_date=search_end_date)
+                search_end_date=search_end_date,
+                telescope_instrument=telescope_instrument)
 
         self.headers = {'User-Agent': 'OSSOS Images'}
+        self.session = http_session is None and session or http_session
 
+    @metrics.timer(metrics.SSOIS_QUERY)
     def get(self):
         """
         :return: astropy.table.table
@@ -212,7 +242,7 @@ class Query(object):
         params = self.param_dict_builder.params
         #print("{}\n".format(params))
         
-        self.response = requests.post(SSOS_URL, data=params, headers=self.headers)
+        self.response = self.session.post(SSOS_URL, data=params, headers=self.headers)
         # print(self.response.url)
         try:
             assert isinstance(self.response, requests.Response)
@@ -224,6 +254,7 @@ class Query(object):
             raise AssertionError('response.status_code =! requests.codes.ok')
 
         lines = self.response.content
+        logging.debug("SSOS returned {} bytes for {}".format(len(lines), self.param_dict_builder.mbcobject))
         # note: spelling 'occured' is in SSOIS
         if len(lines) < 2 or "An error occured getting the ephemeris" in lines:
             raise IOError(os.errno.EACCES, "call to SSOIS failed on format error")
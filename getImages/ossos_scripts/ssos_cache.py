@@ -0,0 +1,165 @@
+"""On-disk cache of parsed SSOIS responses that only asks SSOIS for epochs it has not seen yet."""
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from astropy.time import Time
+
+import metrics
+
+from ssos import ParamDictBuilder, Query
+from ssos_parser import split_response
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv('SSOIS_CACHE_DIR', os.path.join(os.getenv('HOME', '.'), '.ssois_cache'))
+MJD_COLUMN = 'MJD'
+
+
+def join_response(columns, rows):
+    """
+    Inverse of split_response: build the tab separated text SSOIS would have sent.
+    """
+    lines = ['\t'.join(columns)]
+    for row in rows:
+        lines.append('\t'.join(row))
+    return '\n'.join(lines) + '\n'
+
+
+class SSOISCache(object):
+    """
+    Cache of SSOIS rows, one file per object and set of search parameters.
+
+    Each entry records the epoch range it covers.  A query for a wider window only sends SSOIS the
+    missing interval(s) and merges the new rows in, and in offline mode no query is ever sent.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, offline=False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @staticmethod
+    def key(params):
+        """
+        The cache key is built from every search parameter except the epochs.
+        """
+        params = dict(params)
+        params.pop('epoch1', None)
+        params.pop('epoch2', None)
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+    def filename(self, mbcobject, key):
+        safe_name = "".join([c if c.isalnum() else '_' for c in str(mbcobject)])
+        return os.path.join(self.cache_dir, '{}_{}.json'.format(safe_name, key[:12]))
+
+    def load(self, filename):
+        if not os.access(filename, os.R_OK):
+            return None
+        with open(filename) as fobj:
+            return json.load(fobj)
+
+    def save(self, filename, entry):
+        # write then rename so a concurrent reader never sees a partial entry
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(entry, fobj)
+        os.rename(tmp_name, filename)
+
+    def _fetch(self, mbcobject, start_date, end_date, telescope_instrument):
+        logger.debug("SSOIS query for {} from {} to {}".format(mbcobject, start_date.iso, end_date.iso))
+        query = Query(mbcobject, search_start_date=start_date, search_end_date=end_date,
+                      telescope_instrument=telescope_instrument)
+        return split_response(query.get())
+
+    def get(self, mbcobject,
+            search_start_date=Time('2013-01-01', scale='utc'),
+            search_end_date=Time('2017-01-01', scale='utc'),
+            telescope_instrument=None):
+        """
+        Return the SSOIS response for mbcobject in the requested window, querying SSOIS only for the epochs
+        not already in the cache.
+
+        :return: str, SSOIS tsv formatted text, as from ssos.Query.get
+        :raise: IOError if offline and nothing is cached for this object.
+        """
+        builder = ParamDictBuilder(mbcobject, search_start_date=search_start_date,
+                                   search_end_date=search_end_date,
+                                   telescope_instrument=telescope_instrument)
+        key = self.key(builder.params)
+        filename = self.filename(mbcobject, key)
+        entry = self.load(filename)
+        start_date = builder.search_start_date
+        end_date = builder.search_end_date
+
+        if entry is None:
+            self.misses += 1
+            metrics.cache_lookup('ssois', False)
+            if self.offline:
+                raise IOError(errno.ENOENT, "No cached SSOIS result for {} and running offline".format(mbcobject))
+            columns, rows = self._fetch(mbcobject, start_date, end_date, telescope_instrument)
+            entry = {'object': str(mbcobject),
+                     'epoch1': str(start_date),
+                     'epoch2': str(end_date),
+                     'columns': columns,
+                     'rows': rows}
+            self.save(filename, entry)
+        else:
+            cached_start = Time(entry['epoch1'], scale='utc')
+            cached_end = Time(entry['epoch2'], scale='utc')
+            intervals = []
+            if start_date < cached_start:
+                intervals.append((start_date, cached_start))
+            if end_date > cached_end:
+                intervals.append((cached_end, end_date))
+            if len(intervals) == 0:
+                self.hits += 1
+                metrics.cache_lookup('ssois', True)
+            elif self.offline:
+                self.hits += 1
+                metrics.cache_lookup('ssois', True)
+                logger.warning("Offline: cache for {} only covers {} to {}".format(mbcobject, entry['epoch1'],
+                                                                                  entry['epoch2']))
+            else:
+                self.misses += 1
+                metrics.cache_lookup('ssois', False)
+                known = set(tuple(row) for row in entry['rows'])
+                for interval_start, interval_end in intervals:
+                    columns, rows = self._fetch(mbcobject, interval_start, interval_end, telescope_instrument)
+                    if len(entry['columns']) == 0:
+                        entry['columns'] = columns
+                    for row in rows:
+                        if tuple(row) not in known:
+                            known.add(tuple(row))
+                            entry['rows'].append(row)
+                entry['epoch1'] = str(min(start_date, cached_start))
+                entry['epoch2'] = str(max(end_date, cached_end))
+                if MJD_COLUMN in entry['columns']:
+                    mjd_idx = entry['columns'].index(MJD_COLUMN)
+                    entry['rows'].sort(key=lambda row: float(row[mjd_idx]))
+                self.save(filename, entry)
+
+        return join_response(entry['columns'], self.window(entry, start_date, end_date))
+
+    @staticmethod
+    def window(entry, start_date, end_date):
+        """
+        The cached rows that fall inside the requested window.  SSOIS epochs are whole days so the end date is
+        inclusive.
+        """
+        if MJD_COLUMN not in entry['columns']:
+            return entry['rows']
+        mjd_idx = entry['columns'].index(MJD_COLUMN)
+        start_mjd = start_date.mjd
+        end_mjd = end_date.mjd + 1
+        return [row for row in entry['rows'] if start_mjd <= float(row[mjd_idx]) < end_mjd]
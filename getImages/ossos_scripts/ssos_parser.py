@@ -0,0 +1,109 @@
+"""Vectorized reader for the tab separated tables returned by SSOIS."""
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# note: 'Telescope_Insturment' is a typo in SSOIS's return format
+TELESCOPE_INSTRUMENT_COLUMN = 'Telescope_Insturment'
+WALLPAPER_PREFIX = 'WP'
+
+
+def split_response(ssois_return):
+    """
+    Split a tab separated SSOIS response into its column names and rows.
+
+    Rows that are missing the last column are padded with 'None', rows missing more than that are dropped.
+
+    :param ssois_return: str, the body of an SSOIS tsv response
+    :return: (list of column names, list of row lists)
+    """
+    lines = ssois_return.splitlines()
+    columns = None
+    rows = []
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        values = line.split('\t')
+        if columns is None:
+            columns = values
+            ncols = len(columns)
+            continue
+        if len(values) == ncols - 1:
+            values.append('None')
+        elif len(values) != ncols:
+            logger.warning("Not enough columns in data table, skipping: {}".format(line))
+            continue
+        rows.append(values)
+    if columns is None:
+        return [], []
+    return columns, rows
+
+
+def _typed(values):
+    """
+    Convert a column of strings to int, then float, falling back to str; the same guesses astropy.io.ascii makes.
+    """
+    for dtype in (numpy.int64, numpy.float64):
+        try:
+            return values.astype(dtype)
+        except ValueError:
+            pass
+    return values
+
+
+def to_array(columns, rows):
+    """
+    Build a numpy record array, one typed field per SSOIS column, from split_response output.
+    """
+    if len(columns) == 0:
+        return numpy.recarray(0, dtype=[])
+    if len(rows) == 0:
+        return numpy.rec.fromarrays([numpy.array([], dtype=str) for _ in columns], names=columns)
+    cells = numpy.array(rows, dtype=str)
+    return numpy.rec.fromarrays([_typed(cells[:, idx]) for idx in range(len(columns))], names=columns)
+
+
+def parse(ssois_return):
+    """
+    Tokenize an SSOIS tsv response straight into a numpy record array.
+
+    :param ssois_return: str
+    :return: numpy.recarray
+    """
+    columns, rows = split_response(ssois_return)
+    return to_array(columns, rows)
+
+
+def select(table, telescope_instrument, camera_filter, imagetype, exptimes):
+    """
+    Keep the rows of a parsed SSOIS table taken with the given telescope/instrument and filter, of the given image
+    type and one of the exposure times, and that are not OSSOS wallpaper.  Every predicate is a vectorized mask.
+
+    :param table: numpy.recarray from parse
+    :param telescope_instrument: e.g. 'CFHT/MegaCam'
+    :param camera_filter: e.g. 'r.MP9601'
+    :param imagetype: one of 'o', 'p', 's'
+    :param exptimes: list of accepted exposure times, in seconds
+    :return: numpy.recarray
+    """
+    if len(table) == 0:
+        return table
+    mask = table[TELESCOPE_INSTRUMENT_COLUMN].astype(str) == telescope_instrument
+    mask &= table['Filter'].astype(str) == camera_filter
+    mask &= numpy.char.endswith(table['Image'].astype(str), imagetype)
+    if 'Image_target' in table.dtype.names:
+        mask &= ~numpy.char.startswith(table['Image_target'].astype(str), WALLPAPER_PREFIX)
+    exptime = table['Exptime']
+    if exptime.dtype.kind not in 'if':
+        exptime = numpy.array([_float_or_nan(value) for value in exptime])
+    mask &= numpy.in1d(numpy.trunc(exptime), exptimes)
+    return table[mask]
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except ValueError:
+        return numpy.nan
@@ -0,0 +1,151 @@
+"""Index of the postage stamps in a VOSpace container, built from one directory listing."""
+import logging
+import os
+import threading
+import time
+
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 600.0  # seconds before a listing is considered stale
+STAMP_EXT = '.fits'
+
+
+def parse_stamp_name(filename):
+    """
+    Split a stamp name following the object_expnum_RA_DEC[_suffix].fits convention.
+
+    :param filename: base name of the stamp
+    :return: (object, expnum, ra, dec, suffix) or None if filename does not follow the convention
+    """
+    if not filename.endswith(STAMP_EXT):
+        return None
+    parts = filename[:-len(STAMP_EXT)].split('_')
+    if len(parts) < 4:
+        return None
+    try:
+        ra = float(parts[2])
+        dec = float(parts[3])
+    except ValueError:
+        return None
+    return parts[0], parts[1], ra, dec, '_'.join(parts[4:])
+
+
+class StampIndex(object):
+    """
+    The stamps of one VOSpace container keyed by (object, expnum).
+
+    The container is listed once and the listing is reused until it is older than ttl seconds.  Writes and removals
+    made through record_write/record_remove update the index in place so a run sees its own stamps without a
+    new listing, including stamps whose upload is still queued.
+    """
+
+    def __init__(self, vos_dir, ttl=DEFAULT_TTL):
+        self.vos_dir = vos_dir
+        self.ttl = ttl
+        self.listings = 0
+        self._names = None
+        self._stamps = None
+        self._listed = 0.0
+        self._written = set()  # our own writes, which a listing may not show while their upload is queued
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        List the container and rebuild the index.
+        """
+        names = storage.listdir(self.vos_dir, force=True)
+        logger.debug("Listed {} entries in {}".format(len(names), self.vos_dir))
+        with self._lock:
+            self._names = set()
+            self._stamps = {}
+            for name in list(names) + list(self._written):
+                self._add(name)
+            self._listed = time.time()
+            self.listings += 1
+        metrics.incr('stamp_index_listings')
+
+    def invalidate(self):
+        """
+        Forget the listing, the next lookup lists the container again.
+        """
+        with self._lock:
+            self._stamps = None
+
+    def _add(self, name):
+        self._names.add(name)
+        parsed = parse_stamp_name(name)
+        if parsed is not None:
+            stamps = self._stamps.setdefault((parsed[0], parsed[1]), [])
+            if name not in stamps:
+                stamps.append(name)
+
+    def _current(self):
+        with self._lock:
+            fresh = self._stamps is not None and time.time() - self._listed < self.ttl
+        if not fresh:
+            self.refresh()
+
+    def get(self, objectname, expnum):
+        """
+        Names of the stamps of objectname on expnum, in listing order.
+        """
+        self._current()
+        with self._lock:
+            return list(self._stamps.get((str(objectname), str(expnum)), []))
+
+    def exists(self, filename):
+        self._current()
+        with self._lock:
+            return filename in self._names
+
+    def record_write(self, filename):
+        with self._lock:
+            self._written.add(filename)
+            if self._stamps is not None:
+                self._add(filename)
+
+    def record_remove(self, filename):
+        with self._lock:
+            self._written.discard(filename)
+            if self._stamps is None:
+                return
+            self._names.discard(filename)
+            parsed = parse_stamp_name(filename)
+            if parsed is not None:
+                stamps = self._stamps.get((parsed[0], parsed[1]), [])
+                if filename in stamps:
+                    stamps.remove(filename)
+
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+def get_index(vos_dir, ttl=DEFAULT_TTL):
+    """
+    The StampIndex shared by everything working on vos_dir in this process.
+    """
+    with _indices_lock:
+        if vos_dir not in _indices:
+            _indices[vos_dir] = StampIndex(vos_dir, ttl=ttl)
+        return _indices[vos_dir]
+
+
+def record_write(uri):
+    """
+    Note that uri was written; the index of its container keeps it even across listings that do not show it yet.
+    """
+    get_index(os.path.dirname(uri)).record_write(os.path.basename(uri))
+
+
+def record_remove(uri):
+    """
+    Note that uri was removed, updating the index of its container if there is one.
+    """
+    with _indices_lock:
+        index = _indices.get(os.path.dirname(uri), None)
+    if index is not None:
+        index.record_remove(os.path.basename(uri))
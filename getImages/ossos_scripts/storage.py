@@ -13,7 +13,11 @@ import vos
 from astropy.io import fits
 import requests
 
+import cadc_session
 import coding
+import services
+import header_cache
+import metrics
 from mpc import Time
 import util
 
@@ -30,20 +34,21 @@ DBIMAGES = 'vos:OSSOS/dbimages'
 MEASURE3 = 'vos:OSSOS/measure3'
 POSTAGE_STAMPS = 'vos:OSSOS/postage_stamps'
 
-DATA_WEB_SERVICE = 'https://www.canfar.phys.uvic.ca/data/pub/'
-VOSPACE_WEB_SERVICE = 'https://www.canfar.phys.uvic.ca/vospace/nodes/'
-TAP_WEB_SERVICE = 'http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/tap/sync'
+DATA_WEB_SERVICE = services.DATA_URL
+VOSPACE_WEB_SERVICE = services.VOSPACE_NODES_URL
+TAP_WEB_SERVICE = services.TAP_URL
 
 OSSOS_TAG_URI_BASE = 'ivo://canfar.uvic.ca/ossos'
 OBJECT_COUNT = "object_count"
 
-vospace = vos.Client()
+# the vos.Client of the shared CADC session
+vospace = cadc_session.vospace
 
 SUCCESS = 'success'
 
 # ## some cache holders.
-mopheaders = {}
-astheaders = {}
+mopheaders = header_cache.HeaderCache('mopheaders')
+astheaders = header_cache.HeaderCache('astheaders')
 
 APCOR_EXT = "apcor"
 ZEROPOINT_USED_EXT = "zeropoint.used"
@@ -61,7 +66,9 @@ def cone_search(ra, dec, dra=0.01, ddec=0.01, mjdate=None, calibration_level=2):
     """
 
     data = dict(QUERY=(" SELECT Observation.observationID as collectionID, "
-                       " Plane.time_bounds_cval1 AS mjdate "
+                       " Plane.time_bounds_cval1 AS mjdate, "
+                       " Plane.time_bounds_cval2 AS mjdend, "
+                       " Plane.energy_bandpassName AS filter "
                        " FROM caom2.Observation AS Observation "
                        " JOIN caom2.Plane AS Plane "
                        " ON Observation.obsID = Plane.obsID "
@@ -81,7 +88,7 @@ def cone_search(ra, dec, dra=0.01, ddec=0.01, mjdate=None, calibration_level=2):
             mjdate + 1.0 / 24.0,
             mjdate - 1 / 24.0)
 
-    result = requests.get(TAP_WEB_SERVICE, params=data, verify=False)
+    result = cadc_session.get_session().get(TAP_WEB_SERVICE, params=data, verify=False)
     assert isinstance(result, requests.Response)
     logger.debug("Doing TAP Query using url: %s" % (str(result.url)))
 
@@ -527,10 +534,11 @@ def get_zeropoint(expnum, ccd, prefix=None, version='p'):
         return float(open_vos_or_local(uri).read())
     except Exception as err:
         logger.debug(str(err))
-        url = uri.replace('vos:', 'https://www.canfar.phys.uvic.ca/data/pub/vospace/')
-        return float(requests.get(url, cert=vospace.conn.vospace_certfile, verify=False).content)
+        url = uri.replace('vos:', DATA_WEB_SERVICE + 'vospace/')
+        return float(cadc_session.get_session().get(url, cert=vospace.conn.vospace_certfile, verify=False).content)
 
 
+@metrics.timer(metrics.VOSPACE_IO)
 def mkdir(dirname):
     """make directory tree in vospace.
 
@@ -578,6 +586,7 @@ def open_vos_or_local(path, mode="rb"):
         return open(path, mode)
 
 
+@metrics.timer(metrics.VOSPACE_IO)
 def copy(source, dest):
     """use the vospace service to get a file. """
 
@@ -614,6 +623,7 @@ def vlink(s_expnum, s_ccd, s_version, s_ext,
     return vospace.link(source_uri, link_uri)
 
 
+@metrics.timer(metrics.VOSPACE_IO)
 def remove(uri):
     try:
         vospace.delete(uri)
@@ -642,6 +652,7 @@ def my_glob(pattern):
     return result
 
 
+@metrics.timer(metrics.VOSPACE_IO)
 def listdir(directory, force=False):
     return vospace.listdir(directory, force=force)
 
@@ -650,6 +661,7 @@ def list_dbimages():
     return listdir(DBIMAGES)
 
 
+@metrics.timer(metrics.VOSPACE_IO)
 def exists(uri, force=False):
     try:
         return vospace.getNode(uri, force=force) is not None
@@ -660,6 +672,36 @@ def exists(uri, force=False):
             return False
 
 
+def exists_many(uris, force=False):
+    """
+    Check many URIs with one listing of each parent container instead of a getNode round trip per URI.
+
+    :param uris: list of vos: URIs
+    :param force: refresh the client's cached listings
+    :return: dict of uri -> bool
+    """
+    by_parent = {}
+    for uri in uris:
+        by_parent.setdefault(os.path.dirname(uri.rstrip('/')), []).append(uri)
+
+    result = {}
+    for parent, members in by_parent.items():
+        try:
+            names = set(listdir(parent, force=force))
+        except EnvironmentError as e:
+            if e.errno in [404, os.errno.ENOENT]:
+                names = set()
+            else:
+                logger.error("Listing {} failed, checking {} nodes one by one: {}".format(parent, len(members), e))
+                for uri in members:
+                    result[uri] = bool(exists(uri, force=force))
+                continue
+        for uri in members:
+            result[uri] = os.path.basename(uri.rstrip('/')) in names
+    return result
+
+
+@metrics.timer(metrics.VOSPACE_IO)
 def move(old_uri, new_uri):
     vospace.move(old_uri, new_uri)
 
@@ -819,9 +861,9 @@ def _get_sghead(expnum, version):
     :rtype : list of astropy.io.fits.Header objects.
     """
 
-    url = "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/data/pub/CFHTSG/{}{}.head".format(expnum, version)
+    url = "{}/{}{}.head".format(services.CFHTSG_URL, expnum, version)
     logging.getLogger("requests").setLevel(logging.WARNING)
-    resp = requests.get(url)
+    resp = cadc_session.get_session().get(url)
     if resp.status_code != 200:
         raise IOError(errno.ENOENT, "Could not get {}".format(url))
 
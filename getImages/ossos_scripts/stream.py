@@ -0,0 +1,107 @@
+"""Stages joined by bounded queues, each on its own threads, so that network waits overlap the CPU bound work."""
+import logging
+import Queue
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+_END = object()  # sent down a queue once per worker after the last item
+SKIP = object()  # a stage returning SKIP passes nothing on for that item
+
+
+class Stage(object):
+    """
+    function(item) -> item for the next stage, run by workers threads.  queue_size bounds the items waiting for this
+    stage, which is how far the stages before it may run ahead: the prefetch depth.
+    """
+
+    def __init__(self, name, function, workers=1, queue_size=None):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stats = {'items': 0, 'errors': 0, 'busy': 0.0, 'starved': 0.0, 'blocked': 0.0}
+        self._lock = threading.Lock()
+
+    def add(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self.stats[key] += value
+
+
+def run(items, stages, on_error=None, depth=4):
+    """
+    Pass every item through the stages in turn and return the stages, whose stats tell where the time went:
+    busy running the function, starved waiting for input, blocked waiting for room downstream.
+
+    A stage whose function raises drops that item; on_error(stage, item, exc_info) is told about it.  Queues are
+    depth items long unless the stage has its own queue_size.
+    """
+    queues = [Queue.Queue(stage.queue_size or depth) for stage in stages]
+    remaining = [stage.workers for stage in stages]  # workers of each stage still running
+    remaining_lock = threading.Lock()
+
+    def work(index):
+        stage = stages[index]
+        inbox = queues[index]
+        outbox = index + 1 < len(stages) and queues[index + 1] or None
+        while True:
+            waited = time.time()
+            item = inbox.get()
+            started = time.time()
+            stage.add(starved=started - waited)
+            if item is _END:
+                break
+            try:
+                result = stage.function(item)
+            except Exception as e:
+                stage.add(errors=1, busy=time.time() - started)
+                logger.error("Stage {} failed: {}".format(stage.name, e))
+                if on_error is not None:
+                    try:
+                        on_error(stage, item, traceback.format_exc())
+                    except Exception as e:
+                        logger.error("Error handler of stage {} failed: {}".format(stage.name, e))
+                continue
+            finished = time.time()
+            stage.add(items=1, busy=finished - started)
+            if outbox is not None and result is not SKIP:
+                outbox.put(result)
+                stage.add(blocked=time.time() - finished)
+        with remaining_lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last and outbox is not None:
+            # the last worker out tells every worker of the next stage
+            for i in range(stages[index + 1].workers):
+                outbox.put(_END)
+
+    threads = []
+    for index, stage in enumerate(stages):
+        for i in range(stage.workers):
+            thread = threading.Thread(target=work, args=(index,), name='{}-{}'.format(stage.name, i))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    for item in items:
+        queues[0].put(item)
+    for i in range(stages[0].workers):
+        queues[0].put(_END)
+    for thread in threads:
+        # join with a timeout, a bare join cannot be interrupted with ^C in python 2
+        while thread.is_alive():
+            thread.join(1.0)
+    return stages
+
+
+def report(stages):
+    """
+    One line per stage: items, errors, and seconds busy/starved/blocked summed over its workers.
+    """
+    lines = []
+    for stage in stages:
+        lines.append('{:<12} x{:<2} {items:6d} items {errors:4d} errors  busy {busy:8.1f}s  starved {starved:8.1f}s  '
+                     'blocked {blocked:8.1f}s'.format(stage.name, stage.workers, **stage.stats))
+    return '\n'.join(lines)
@@ -0,0 +1,273 @@
+"""A small task graph runner whose finished tasks are remembered in sqlite, so a rerun picks up where the last stopped."""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+BLOCKED = 'blocked'  # a task it requires failed in this run
+
+
+class Task(object):
+    """
+    One unit of pipeline work: function(*args, **kwargs), run once every task named in requires is done.  A function
+    that returns None did not do its work (the pipeline's functions print a warning and return nothing): the task is
+    recorded failed, as if it had raised.
+
+    outputs are local paths or vos: URIs the task writes.  A task recorded done whose outputs have since gone is
+    run again, and a task never recorded whose outputs all exist already (e.g. from a run before the state database)
+    counts as done.  Tasks without outputs rely on the state database alone.
+    """
+
+    def __init__(self, name, function, args=(), kwargs=None, requires=(), outputs=()):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.requires = list(requires)
+        self.outputs = list(outputs)
+
+    def __repr__(self):
+        return 'Task({})'.format(self.name)
+
+
+class StateDB(object):
+    """
+    Status of every task ever run against one database: name, status, attempts, start and end time, error, result.
+    """
+
+    def __init__(self, filename):
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._db.execute("CREATE TABLE IF NOT EXISTS tasks (name TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, started REAL, finished REAL, error TEXT, result TEXT)")
+
+    def status(self, name):
+        with self._lock:
+            row = self._db.execute("SELECT status FROM tasks WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] or None
+
+    def statuses(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT name, status FROM tasks").fetchall())
+
+    def result(self, name):
+        with self._lock:
+            row = self._db.execute("SELECT result FROM tasks WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] is not None and json.loads(row[0]) or None
+
+    def started(self, name):
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO tasks (name, status) VALUES (?, ?)", (name, PENDING))
+            self._db.execute("UPDATE tasks SET status = ?, attempts = attempts + 1, started = ?, finished = NULL, "
+                             "error = NULL WHERE name = ?", (RUNNING, time.time(), name))
+
+    def finished(self, name, status, error=None, result=None):
+        try:
+            result = result is not None and json.dumps(result) or None
+        except (TypeError, ValueError):
+            result = None  # not everything a stage returns is worth keeping
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO tasks (name, status) VALUES (?, ?)", (name, status))
+            self._db.execute("UPDATE tasks SET status = ?, finished = ?, error = ?, result = ? WHERE name = ?",
+                             (status, time.time(), error, result, name))
+
+    def forget(self, names=None):
+        """
+        Drop the given tasks, or all of them, so the next run does them again.
+        """
+        with self._lock:
+            if names is None:
+                self._db.execute("DELETE FROM tasks")
+            else:
+                self._db.executemany("DELETE FROM tasks WHERE name = ?", [(name,) for name in names])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def outputs_exist(paths):
+    """
+    Which of the local paths and vos: URIs exist, the URIs checked with one listing per container.
+    """
+    uris = [path for path in paths if path.startswith('vos:')]
+    found = len(uris) > 0 and storage.exists_many(uris) or {}
+    for path in paths:
+        if not path.startswith('vos:'):
+            found[path] = os.path.exists(path)
+    return found
+
+
+class TaskGraph(object):
+    """
+    Runs tasks in dependency order on a pool of worker threads, skipping those the state database has as done.
+
+    A failed task is recorded with its traceback and the tasks that require it are left blocked; the next run tries
+    them all again.
+    """
+
+    def __init__(self, state, workers=4):
+        self.state = state
+        self.workers = workers
+        self.tasks = {}
+
+    def add(self, task):
+        if task.name in self.tasks:
+            raise ValueError("Task {} added twice".format(task.name))
+        self.tasks[task.name] = task
+        return task
+
+    def _order(self):
+        # depth first topological order, which also catches cycles and unknown requirements
+        order, state = [], {}
+
+        def visit(name, path):
+            if state.get(name) == DONE:
+                return
+            if state.get(name) == RUNNING:
+                raise ValueError("Tasks require each other: {}".format(' -> '.join(path + [name])))
+            if name not in self.tasks:
+                raise ValueError("{} requires unknown task {}".format(path[-1], name))
+            state[name] = RUNNING
+            for required in self.tasks[name].requires:
+                visit(required, path + [name])
+            state[name] = DONE
+            order.append(name)
+
+        for name in sorted(self.tasks):
+            visit(name, [])
+        return order
+
+    def _complete(self, order):
+        # what is done already: recorded done with its outputs still there, or never recorded but all outputs there,
+        # and in both cases everything it requires done too: whatever runs again is followed by all that depends on it
+        recorded = self.state.statuses()
+        candidates = [name for name in order if recorded.get(name) in (DONE, None)]
+        found = outputs_exist(list(set(path for name in candidates for path in self.tasks[name].outputs)))
+        done = set()
+        for name in candidates:
+            if not all(required in done for required in self.tasks[name].requires):
+                continue
+            outputs = self.tasks[name].outputs
+            if recorded.get(name) == DONE and all(found[path] for path in outputs):
+                done.add(name)
+            elif recorded.get(name) is None and len(outputs) > 0 and all(found[path] for path in outputs):
+                self.state.finished(name, DONE)
+                done.add(name)
+        return done
+
+    def pending(self, force=False):
+        """
+        Names of the tasks a run would do, in an order that has every task after those it requires.
+        """
+        order = self._order()
+        done = not force and self._complete(order) or set()
+        return [name for name in order if name not in done]
+
+    def execute(self, name):
+        """
+        Run one task now, in this thread, recording the outcome; return its status.
+        """
+        return self._execute(self.tasks[name])[1]
+
+    def _execute(self, task):
+        try:
+            self.state.started(task.name)
+            result = task.function(*task.args, **task.kwargs)
+            if result is None:
+                raise RuntimeError("{} returned nothing".format(getattr(task.function, '__name__', task.function)))
+            self.state.finished(task.name, DONE, result=result)
+            return task.name, DONE
+        except Exception as e:
+            logger.error("Task {} failed: {}".format(task.name, e))
+            try:
+                self.state.finished(task.name, FAILED, error=traceback.format_exc())
+            except Exception as e:
+                logger.error("Could not record the failure of {}: {}".format(task.name, e))
+            return task.name, FAILED
+
+    def run(self, force=False):
+        """
+        Run everything not yet done (all of it if force), return {status: number of tasks}.
+        """
+        order = self._order()
+        done = not force and self._complete(order) or set()
+        logger.info("{} of {} tasks already done".format(len(done), len(order)))
+
+        status = dict((name, DONE) for name in done)
+        dependents = dict((name, []) for name in order)
+        waiting = {}  # name -> number of requirements not yet done
+        for name in order:
+            if name in status:
+                continue
+            waiting[name] = len([r for r in self.tasks[name].requires if r not in done])
+            for required in self.tasks[name].requires:
+                dependents[required].append(name)
+
+        condition = threading.Condition()
+        finished = []
+        pool = ThreadPool(self.workers)
+
+        def callback(outcome):
+            with condition:
+                finished.append(outcome)
+                condition.notify()
+
+        def block(name):
+            # everything downstream of a failure waits for the next run
+            for dependent in dependents[name]:
+                if dependent not in status:
+                    status[dependent] = BLOCKED
+                    block(dependent)
+
+        running = 0
+        ready = [name for name in order if name in waiting and waiting[name] == 0]
+        try:
+            with condition:
+                while True:
+                    for name in ready:
+                        status[name] = RUNNING
+                        pool.apply_async(self._execute, (self.tasks[name],), callback=callback)
+                        running += 1
+                    ready = []
+                    if running == 0:
+                        break
+                    while len(finished) == 0:
+                        condition.wait(1.0)
+                    for name, outcome in finished:
+                        running -= 1
+                        status[name] = outcome
+                        if outcome != DONE:
+                            block(name)
+                            continue
+                        for dependent in dependents[name]:
+                            waiting[dependent] -= 1
+                            if waiting[dependent] == 0 and dependent not in status:
+                                ready.append(dependent)
+                    del finished[:]
+        finally:
+            pool.close()
+            pool.join()
+
+        # tasks done in an earlier run are counted as skipped only
+        counts = {'skipped': len(done)}
+        for name, value in status.items():
+            if name not in done:
+                counts[value] = counts.get(value, 0) + 1
+        return counts
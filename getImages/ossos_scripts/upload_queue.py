@@ -0,0 +1,296 @@
+"""Background uploads to VOSpace with a durable journal of the uploads still pending."""
+import fcntl
+import glob
+import json
+import logging
+import os
+import Queue
+import socket
+import threading
+import time
+import uuid
+
+import stamp_index
+import storage
+
+logger = logging.getLogger(__name__)
+
+# one journal per process in this directory, so that processes sharing a home directory never rewrite each other's
+JOURNAL_DIR = os.getenv('OSSOS_UPLOAD_JOURNAL', os.path.join(os.getenv('HOME', '.'), '.ossos_upload_journal'))
+ADD = 'add'
+DONE = 'done'
+
+
+class UploadQueue(object):
+    """
+    A bounded queue of (local file, VOSpace URI) copies drained by a pool of worker threads.
+
+    Every upload is appended to a journal before it is queued and marked done once storage.copy succeeded, so a
+    process that dies with uploads pending can re-queue them with recover().  flush() is the barrier that waits for
+    every upload submitted so far.
+
+    The journal belongs to this queue alone: it holds a lock on journal.lock for as long as it lives, which is how
+    recover() tells the journals of dead processes from those of running ones.  A later upload to the same dest
+    supersedes the earlier: if that has not started it is dropped, otherwise the later one waits for it to finish.
+    """
+
+    def __init__(self, journal=None, workers=4, maxsize=64, retries=3, backoff=2.0):
+        if journal is None:
+            if not os.path.isdir(JOURNAL_DIR):
+                _make_journal_dir()
+            journal = os.path.join(JOURNAL_DIR, '{}.{}.journal'.format(socket.gethostname(), os.getpid()))
+        self.journal = journal
+        self._owner = open(journal + '.lock', 'a')
+        fcntl.flock(self._owner, fcntl.LOCK_EX)
+        self.retries = retries
+        self.backoff = backoff
+        self.uploaded = 0
+        self.failed = []
+        self._queue = Queue.Queue(maxsize=maxsize)
+        self._pending = {}  # source -> id of its latest upload, until that succeeded
+        self._dests = {}  # dest -> [id of its latest upload, lock held while uploading, uploads not finished]
+        self._lock = threading.RLock()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='upload-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _append(self, entry):
+        with self._lock:
+            with open(self.journal, 'a') as fobj:
+                fobj.write(json.dumps(entry) + '\n')
+                fobj.flush()
+                os.fsync(fobj.fileno())
+
+    def submit(self, source, dest, upload_id=None):
+        """
+        Queue the copy of local file source to dest, blocking while the queue is full.
+
+        :return: the id of the upload in the journal
+        """
+        source = os.path.abspath(source)
+        if upload_id is None:
+            upload_id = uuid.uuid4().hex
+            self._append({'op': ADD, 'id': upload_id, 'source': source, 'dest': dest})
+        with self._lock:
+            self._pending[source] = upload_id
+            self._dests.setdefault(dest, [None, threading.Lock(), 0])
+            self._dests[dest][0] = upload_id
+            self._dests[dest][2] += 1
+        stamp_index.record_write(dest)
+        self._queue.put((upload_id, source, dest))
+        return upload_id
+
+    def is_pending(self, source):
+        """
+        True until local file source has been uploaded, also when its upload failed for good: the file must not be
+        removed before then, it may be the only copy.
+        """
+        with self._lock:
+            return os.path.abspath(source) in self._pending
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._upload(*item)
+            except Exception as e:
+                # e.g. the journal could not be written: the worker lives on, the upload stays in the journal and in
+                # _pending for recover() to try again next run
+                upload_id, source, dest = item
+                logger.error("Upload of {} to {} failed: {}".format(source, dest, e))
+                with self._lock:
+                    self.failed.append((source, dest))
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, upload_id, source, dest):
+        with self._lock:
+            dest_lock = self._dests[dest][1]
+        try:
+            with dest_lock:
+                with self._lock:
+                    superseded = self._dests[dest][0] != upload_id
+                if superseded:
+                    # a later upload of the same dest is queued, it is the one that counts
+                    self._append({'op': DONE, 'id': upload_id})
+                    return
+                for attempt in range(self.retries + 1):
+                    try:
+                        storage.copy(source, dest)
+                        break
+                    except Exception as e:
+                        logger.warning("Upload of {} to {} failed (attempt {}): {}".format(source, dest, attempt + 1,
+                                                                                         e))
+                        if attempt == self.retries:
+                            # left in the journal and in _pending: the file stays until a later upload succeeds,
+                            # recover() tries it again next run
+                            with self._lock:
+                                self.failed.append((source, dest))
+                            return
+                        time.sleep(self.backoff * 2 ** attempt)
+                self._append({'op': DONE, 'id': upload_id})
+                with self._lock:
+                    if self._pending.get(source) == upload_id:
+                        del self._pending[source]
+                    self.uploaded += 1
+        finally:
+            with self._lock:
+                self._dests[dest][2] -= 1
+                if self._dests[dest][2] == 0:
+                    del self._dests[dest]
+
+    def flush(self):
+        """
+        Wait until every upload submitted so far has finished, then compact the journal.
+
+        :return: list of (source, dest) uploads that failed for good
+        """
+        self._queue.join()
+        self.compact()
+        return list(self.failed)
+
+    def unfinished(self):
+        """
+        The journal entries that were added but never marked done, as (id, source, dest).
+        """
+        with self._lock:
+            return _unfinished(self.journal)
+
+    def compact(self):
+        """
+        Rewrite the journal with only the uploads that have not finished.
+        """
+        with self._lock:
+            entries = self.unfinished()
+            tmp_name = self.journal + '.tmp'
+            with open(tmp_name, 'w') as fobj:
+                for upload_id, source, dest in entries:
+                    fobj.write(json.dumps({'op': ADD, 'id': upload_id, 'source': source, 'dest': dest}) + '\n')
+            os.rename(tmp_name, self.journal)
+
+    def recover(self):
+        """
+        Re-queue the uploads this journal has unfinished, and those of the journals of this host's processes that
+        died, which are taken over into this one; uploads whose local file is gone are dropped.
+
+        :return: number of uploads re-queued
+        """
+        requeued = 0
+        for upload_id, source, dest in self.unfinished():
+            if not os.access(source, os.R_OK):
+                logger.warning("Cannot recover upload of {} to {}, local file is gone".format(source, dest))
+                self._append({'op': DONE, 'id': upload_id})
+                continue
+            self.submit(source, dest, upload_id=upload_id)
+            requeued += 1
+        pattern = os.path.join(os.path.dirname(self.journal), '{}.*.journal'.format(socket.gethostname()))
+        for journal in sorted(glob.glob(pattern)):
+            if journal == self.journal:
+                continue
+            with open(journal + '.lock', 'a') as owner:
+                try:
+                    fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue  # its process is still running
+                for upload_id, source, dest in _unfinished(journal):
+                    if not os.access(source, os.R_OK):
+                        logger.warning("Cannot recover upload of {} to {}, local file is gone".format(source, dest))
+                        continue
+                    self.submit(source, dest)
+                    requeued += 1
+                os.unlink(journal)
+                os.unlink(journal + '.lock')
+        if requeued > 0:
+            logger.info("Re-queued {} unfinished uploads".format(requeued))
+        return requeued
+
+    def close(self):
+        """
+        Flush and stop the worker threads.
+        """
+        failed = self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._owner.close()
+        return failed
+
+
+def _unfinished(journal):
+    # the entries of a journal that were added but never marked done, as (id, source, dest)
+    if not os.access(journal, os.R_OK):
+        return []
+    added = {}
+    order = []
+    with open(journal) as fobj:
+        for line in fobj:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a write cut short by a crash
+                continue
+            if entry['op'] == ADD:
+                added[entry['id']] = (entry['id'], entry['source'], entry['dest'])
+                order.append(entry['id'])
+            elif entry['op'] == DONE:
+                added.pop(entry['id'], None)
+    return [added[upload_id] for upload_id in order if upload_id in added]
+
+
+def _make_journal_dir():
+    # JOURNAL_DIR used to be a single journal shared by every process: keep it, as one whose process is gone
+    legacy = os.path.isfile(JOURNAL_DIR) and JOURNAL_DIR + '.{}'.format(os.getpid()) or None
+    if legacy is not None:
+        os.rename(JOURNAL_DIR, legacy)
+    try:
+        os.makedirs(JOURNAL_DIR)
+    except OSError:
+        if not os.path.isdir(JOURNAL_DIR):  # not another process having just made it
+            raise
+    if legacy is not None:
+        os.rename(legacy, os.path.join(JOURNAL_DIR, '{}.legacy.journal'.format(socket.gethostname())))
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """
+    The upload queue shared by the process, created (and recovered from its journal) on first use.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = UploadQueue()
+            _queue.recover()
+        return _queue
+
+
+def is_pending(path):
+    """
+    True while local file path waits for its upload in the shared queue; False if nothing was ever queued, without
+    creating the queue.
+    """
+    with _queue_lock:
+        queue = _queue
+    if queue is None:
+        return False
+    return queue.is_pending(path)
+
+
+def flush():
+    """
+    Wait for the shared queue's uploads, if anything was ever queued.
+    """
+    with _queue_lock:
+        queue = _queue
+    if queue is None:
+        return []
+    return queue.flush()
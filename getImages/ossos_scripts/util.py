@@ -8,7 +8,8 @@ import os
 from astropy.io import ascii
 import numpy
 import re
-import vos
+
+import cadc_session
 
 MATCH_TOLERANCE = 100.0
 
@@ -48,7 +49,7 @@ class VOFileHandler(handlers.BufferingHandler):
         """
         if self._client is not None:
             return self._client
-        self._client = vos.Client()
+        self._client = cadc_session.vospace
         return self._client
 
     def close(self):
@@ -0,0 +1,352 @@
+"""A work queue for spreading (object, expnum) tasks over machines: a sqlite broker, served over TCP as JSON lines."""
+import hmac
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+STATUSES = [QUEUED, LEASED, DONE, FAILED]
+
+PORT = int(os.getenv('OSSOS_QUEUE_PORT', 9753))
+TOKEN = os.getenv('OSSOS_QUEUE_TOKEN', None)  # shared secret every request has to carry, if set
+LEASE_SECONDS = 300.0
+HEARTBEAT_SECONDS = 60.0
+MAX_ATTEMPTS = 3
+
+
+class Broker(object):
+    """
+    The queue itself, one sqlite database.  Every task has a unique key and a JSON payload; a worker leases tasks
+    for a while, keeps them with heartbeats and hands back a result or an error.  A lease that runs out (the worker
+    died or lost the network) puts the task back in the queue, until it has been tried max_attempts times.
+    """
+
+    def __init__(self, filename, max_attempts=MAX_ATTEMPTS):
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._db.execute("CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, "
+                         "payload TEXT NOT NULL, status TEXT NOT NULL, worker TEXT, expires REAL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT, updated REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, expires)")
+
+    def _expire(self, now):
+        # leases past their time go back in the queue, or fail for good after max_attempts
+        self._db.execute("UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, "
+                         "error = 'lease expired', updated = ? WHERE status = ? AND expires < ?",
+                         (self.max_attempts, FAILED, QUEUED, now, LEASED, now))
+
+    def add(self, tasks):
+        """
+        Queue (key, payload) pairs, return how many were new; a key already known, in any state, is left alone.
+        """
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.executemany("INSERT OR IGNORE INTO tasks (key, payload, status, updated) VALUES (?, ?, ?, ?)",
+                                 [(key, json.dumps(payload), QUEUED, time.time()) for key, payload in tasks])
+            self._db.execute("COMMIT")
+            return self._db.total_changes - before
+
+    def lease(self, worker, n=1, lease_seconds=LEASE_SECONDS):
+        """
+        Hand up to n queued tasks to worker for lease_seconds: [{'id', 'key', 'payload', 'attempts'}].
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire(now)
+                rows = self._db.execute("SELECT id, key, payload, attempts FROM tasks WHERE status = ? "
+                                        "ORDER BY attempts, id LIMIT ?", (QUEUED, int(n))).fetchall()
+                self._db.executemany("UPDATE tasks SET status = ?, worker = ?, expires = ?, attempts = attempts + 1, "
+                                     "updated = ? WHERE id = ?",
+                                     [(LEASED, worker, now + lease_seconds, now, row[0]) for row in rows])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return [{'id': row[0], 'key': row[1], 'payload': json.loads(row[2]), 'attempts': row[3] + 1}
+                for row in rows]
+
+    def heartbeat(self, worker, ids, lease_seconds=LEASE_SECONDS):
+        """
+        Extend worker's leases on ids, return the ids it still holds.
+        """
+        now = time.time()
+        held = []
+        with self._lock:
+            for task_id in ids:
+                cursor = self._db.execute("UPDATE tasks SET expires = ?, updated = ? WHERE id = ? AND worker = ? "
+                                          "AND status = ? AND expires >= ?",
+                                          (now + lease_seconds, now, task_id, worker, LEASED, now))
+                if cursor.rowcount > 0:
+                    held.append(task_id)
+        return held
+
+    def complete(self, worker, task_id, result=None):
+        """
+        Store the result of a task worker holds, False if its lease was lost (someone else may be doing it now).
+        """
+        with self._lock:
+            cursor = self._db.execute("UPDATE tasks SET status = ?, result = ?, error = NULL, worker = NULL, "
+                                      "updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                                      (DONE, json.dumps(result), time.time(), task_id, worker, LEASED))
+            return cursor.rowcount > 0
+
+    def fail(self, worker, task_id, error):
+        """
+        Give back a task worker could not do: queued again unless it has had max_attempts already.
+        """
+        with self._lock:
+            cursor = self._db.execute("UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                                      "error = ?, worker = NULL, updated = ? WHERE id = ? AND worker = ? "
+                                      "AND status = ?",
+                                      (self.max_attempts, FAILED, QUEUED, error, time.time(), task_id, worker,
+                                       LEASED))
+            return cursor.rowcount > 0
+
+    def retry_failed(self):
+        """
+        Queue the tasks that failed for good once more, with their attempts reset; return how many.
+        """
+        with self._lock:
+            cursor = self._db.execute("UPDATE tasks SET status = ?, attempts = 0, updated = ? WHERE status = ?",
+                                      (QUEUED, time.time(), FAILED))
+            return cursor.rowcount
+
+    def counts(self):
+        with self._lock:
+            self._expire(time.time())
+            counts = dict((status, 0) for status in STATUSES)
+            counts.update(self._db.execute("SELECT status, count(*) FROM tasks GROUP BY status").fetchall())
+        return counts
+
+    def results(self, status=DONE):
+        """
+        (key, payload, result or error) of every task with status, in the order they were queued.
+        """
+        column = status == DONE and 'result' or 'error'
+        with self._lock:
+            rows = self._db.execute("SELECT key, payload, {} FROM tasks WHERE status = ? ORDER BY id".format(column),
+                                    (status,)).fetchall()
+        if status == DONE:
+            return [(key, json.loads(payload), json.loads(value) if value is not None else None)
+                    for key, payload, value in rows]
+        return [(key, json.loads(payload), value) for key, payload, value in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# the calls a remote worker may make, with the arguments each takes
+OPERATIONS = {'lease': ('worker', 'n', 'lease_seconds'),
+              'heartbeat': ('worker', 'ids', 'lease_seconds'),
+              'complete': ('worker', 'task_id', 'result'),
+              'fail': ('worker', 'task_id', 'error'),
+              'counts': ()}
+
+
+class BrokerHandler(StreamRequestHandler):
+    """
+    One connection: a JSON request per line, {"op": ..., "token": ..., arguments}, answered by a JSON line,
+    {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                op = request.get('op')
+                if self.server.token is not None and not hmac.compare_digest(str(request.get('token', '')),
+                                                                             str(self.server.token)):
+                    raise ValueError("bad token")
+                if op not in OPERATIONS:
+                    raise ValueError("unknown operation {}".format(op))
+                kwargs = dict((name, request[name]) for name in OPERATIONS[op] if name in request)
+                reply = {'ok': True, 'result': getattr(self.server.broker, op)(**kwargs)}
+            except Exception as e:
+                logger.warning("Bad request from {}: {}".format(self.client_address[0], e))
+                reply = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class BrokerServer(ThreadingMixIn, TCPServer):
+    """
+    Serves a Broker to workers on other machines.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, broker, host='', port=PORT, token=TOKEN):
+        TCPServer.__init__(self, (host, port), BrokerHandler)
+        self.broker = broker
+        self.token = token
+
+
+class BrokerClient(object):
+    """
+    A Broker on the other end of a TCP connection, with the same methods.  The connection is opened on first use and
+    opened again once if it broke, e.g. after the broker restarted.
+    """
+
+    def __init__(self, host, port=PORT, token=TOKEN, timeout=60.0):
+        self.address = (host, port)
+        self.token = token
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket = None
+        self._file = None
+
+    def _connect(self):
+        self._socket = socket.create_connection(self.address, self.timeout)
+        self._file = self._socket.makefile('rb')
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+        self._socket = self._file = None
+
+    def _call(self, op, **kwargs):
+        request = dict(kwargs, op=op)
+        if self.token is not None:
+            request['token'] = self.token
+        data = json.dumps(request) + '\n'
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    self._socket.sendall(data)
+                    line = self._file.readline()
+                    if not line:
+                        raise socket.error("connection closed by the broker")
+                    break
+                except socket.error:
+                    self._disconnect()
+                    if attempt > 0:
+                        raise
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise RuntimeError("Broker refused {}: {}".format(op, reply['error']))
+        return reply['result']
+
+    def lease(self, worker, n=1, lease_seconds=LEASE_SECONDS):
+        return self._call('lease', worker=worker, n=n, lease_seconds=lease_seconds)
+
+    def heartbeat(self, worker, ids, lease_seconds=LEASE_SECONDS):
+        return self._call('heartbeat', worker=worker, ids=ids, lease_seconds=lease_seconds)
+
+    def complete(self, worker, task_id, result=None):
+        return self._call('complete', worker=worker, task_id=task_id, result=result)
+
+    def fail(self, worker, task_id, error):
+        return self._call('fail', worker=worker, task_id=task_id, error=error)
+
+    def counts(self):
+        return self._call('counts')
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+class Worker(object):
+    """
+    Leases tasks from a Broker or BrokerClient and runs handler(payload) on each, its return value being the result.
+    A heartbeat thread keeps the leases of the tasks in hand.  run() returns once the queue has nothing left to
+    lease or to wait for, or after stop().
+    """
+
+    def __init__(self, queue, handler, name=None, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS,
+                 idle_seconds=10.0):
+        self.queue = queue
+        self.handler = handler
+        self.name = name or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), threading.current_thread().name)
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.idle_seconds = idle_seconds
+        self.stats = {DONE: 0, FAILED: 0, 'lost': 0}
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._finished = threading.Event()
+
+    def stop(self):
+        """
+        Lease nothing more, the task in hand is finished (and its lease kept) first.
+        """
+        self._stop.set()
+
+    def _heartbeat(self):
+        while not self._finished.wait(self.heartbeat_seconds):
+            with self._held_lock:
+                ids = list(self._held)
+            if len(ids) == 0:
+                continue
+            try:
+                held = self.queue.heartbeat(self.name, ids, self.lease_seconds)
+            except Exception as e:
+                logger.warning("Heartbeat failed, retrying in {}s: {}".format(self.heartbeat_seconds, e))
+                continue
+            for task_id in set(ids) - set(held):
+                logger.warning("Lost the lease on task {}".format(task_id))
+
+    def run(self):
+        heartbeat = threading.Thread(target=self._heartbeat, name='heartbeat-{}'.format(self.name))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            while not self._stop.is_set():
+                tasks = self.queue.lease(self.name, 1, self.lease_seconds)
+                if len(tasks) == 0:
+                    counts = self.queue.counts()
+                    if counts[QUEUED] == 0 and counts[LEASED] == 0:
+                        break
+                    # others hold the rest, one of their leases may yet run out
+                    self._stop.wait(self.idle_seconds)
+                    continue
+                for task in tasks:
+                    self._run_task(task)
+        finally:
+            self._finished.set()
+            heartbeat.join()
+        return self.stats
+
+    def _run_task(self, task):
+        with self._held_lock:
+            self._held.add(task['id'])
+        try:
+            try:
+                result = self.handler(task['payload'])
+            except Exception as e:
+                logger.error("Task {} failed (attempt {}): {}".format(task['key'], task['attempts'], e))
+                self.queue.fail(self.name, task['id'], traceback.format_exc())
+                self.stats[FAILED] += 1
+                return
+            if self.queue.complete(self.name, task['id'], result):
+                self.stats[DONE] += 1
+            else:
+                logger.warning("Result of {} refused, its lease ran out".format(task['key']))
+                self.stats['lost'] += 1
+        finally:
+            with self._held_lock:
+                self._held.discard(task['id'])
@@ -1,5 +1,6 @@
 import os
-import requests
+from ossos_scripts import cadc_session
+from ossos_scripts import services
 from astropy.table import Table
 import pandas as pd
 import numpy as np
@@ -40,8 +41,8 @@ def get_metadata(familyname):
     for item in counts:
         new_objects.append(item)        
 
-    BASEURL = 'http://hamilton.dm.unipi.it/~astdys2/propsynth/numb.syn'
-    r = requests.get(BASEURL)
+    BASEURL = services.ASTDYS_URL + '/numb.syn'
+    r = cadc_session.get_session().get(BASEURL)
     r.raise_for_status()
     
     tableobject_list = []    
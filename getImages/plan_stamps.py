@@ -0,0 +1,235 @@
+import argparse
+import getpass
+import glob
+import math
+import os
+
+import numpy as np
+
+import get_stamps
+from ossos_scripts import cadc_session
+from ossos_scripts import storage
+from ossos_scripts import upload_queue
+
+'''
+Plans postage stamp downloads across every family at once.
+The family image lists (asteroid_families/*/*_images.txt) reference the same exposures over and over,
+so pending stamps are grouped by exposure and CCD, and stamps close enough that one cutout of them all is
+smaller than their separate cutouts are merged into a region: each region is downloaded once and every
+object (in every family) that falls on it gets its stamp sliced out of the shared pixels.
+'''
+
+CCD_SIZE = 2048 * 0.185 / 3600.0   # degrees, width of a MegaCam CCD
+REQUESTS_PER_CUTOUT = 1            # get_stamps.fetch_cutout resolves the extension locally
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Group the postage stamps needed by all families by exposure and region of sky, '
+                    'report how many requests and bytes downloading each region once saves, and optionally do it.')
+    parser.add_argument("--family", '-f',
+                        action="append",
+                        default=None,
+                        help="Family to include, may be repeated. Default is every family directory.")
+    parser.add_argument("--radius", '-r',
+                        action='store',
+                        type=float,
+                        default=0.01,
+                        help='Radius (degree) of circle of cutout postage stamp.')
+    parser.add_argument("--max-region",
+                        action='store',
+                        type=float,
+                        default=CCD_SIZE,
+                        help='Largest extent (degree) of a group of stamps fetched in one cutout.')
+    parser.add_argument("--execute",
+                        action='store_true',
+                        help='Download the planned regions and write the stamps.')
+    args = parser.parse_args()
+
+    stamps = read_image_lists(args.family)
+    if args.execute:
+        username = raw_input("CADC username: ")
+        password = getpass.getpass("CADC password: ")
+        cadc_session.login(username, password)
+        stamps = drop_existing(stamps)
+    plan = plan_regions(stamps, args.radius, args.max_region)
+    report(stamps, plan)
+
+    if args.execute:
+        execute(plan, username, password)
+
+
+def read_image_lists(families=None):
+    '''
+    Read the family image lists and merge rows that ask for the same (object, image) stamp.
+    Returns a dict of (object, image) -> {'ra', 'dec', 'ext', 'families'}
+    '''
+    dir_path = os.path.dirname(os.path.abspath(__file__))
+    dir_path_base = '{}/asteroid_families'.format(dir_path)
+    if families is None:
+        families = sorted(os.path.basename(path) for path in glob.glob('{}/*'.format(dir_path_base))
+                          if os.path.isdir(path))
+
+    stamps = {}
+    rows = 0
+    for familyname in families:
+        image_list = '{}/{}/{}_images.txt'.format(dir_path_base, familyname, familyname)
+        if not os.path.exists(image_list):
+            continue
+        with open(image_list) as infile:
+            for line in infile.readlines()[1:]:  # skip header info
+                values = line.split()
+                if len(values) < 5:
+                    continue
+                rows += 1
+                key = (values[0], values[1])
+                if key not in stamps:
+                    # the time column is 'date time', the Ext column SSOIS resolved the CCD with is the last one
+                    ext = len(values) > 7 and values[-1] not in ['None', 'nan'] and values[-1] or None
+                    stamps[key] = {'ra': float(values[3]), 'dec': float(values[4]), 'ext': ext, 'families': []}
+                if familyname not in stamps[key]['families']:
+                    stamps[key]['families'].append(familyname)
+    print "----- {} image list rows, {} distinct stamps over {} families -----".format(rows, len(stamps), len(families))
+    return stamps
+
+
+def stamp_uri(familyname, objectname, image, ra, dec):
+    return 'vos:kawebb/postage_stamps/{}/{}_{}_{:8f}_{:8f}.fits'.format(familyname, objectname, image, ra, dec)
+
+
+def drop_existing(stamps):
+    '''
+    Remove from stamps the families whose copy of the stamp is already in VOSpace, and the stamps no family needs
+    any more, with one listing per family directory.
+    '''
+    uris = [stamp_uri(familyname, key[0], key[1], stamp['ra'], stamp['dec'])
+            for key, stamp in stamps.items() for familyname in stamp['families']]
+    present = len(uris) > 0 and storage.exists_many(uris, force=True) or {}
+    pending = {}
+    for key, stamp in stamps.items():
+        families = [familyname for familyname in stamp['families']
+                    if not present[stamp_uri(familyname, key[0], key[1], stamp['ra'], stamp['dec'])]]
+        if len(families) > 0:
+            pending[key] = dict(stamp, families=families)
+    print "----- {} of {} stamps are already in VOSpace for every family -----".format(len(stamps) - len(pending),
+                                                                                  len(stamps))
+    return pending
+
+
+def plan_regions(stamps, radius, max_region=CCD_SIZE):
+    '''
+    Group stamps by exposure and CCD, then greedily cluster the stamps of each group into regions no wider
+    than max_region. A stamp only joins a region when the merged cutout moves fewer bytes than cutting out
+    every member on its own; stamps whose CCD is unknown get a region each.
+    Returns a list of regions, each a dict with the image, CCD, centre, radius and member keys.
+    '''
+    by_ccd = {}
+    for key in sorted(stamps):
+        extname = get_stamps.resolve_extension(key[1].split('p')[0], stamps[key]['ra'], stamps[key]['dec'],
+                                               ext=stamps[key].get('ext', None))
+        by_ccd.setdefault((key[1], extname), []).append(key)
+
+    plan = []
+    for image, extname in sorted(by_ccd):
+        keys = by_ccd[(image, extname)]
+        ra = np.array([stamps[key]['ra'] for key in keys])
+        dec = np.array([stamps[key]['dec'] for key in keys])
+        unassigned = np.ones(len(keys), dtype=bool)
+        while unassigned.any():
+            seed = np.flatnonzero(unassigned)[0]
+            cos_dec = math.cos(math.radians(dec[seed]))
+            # RA offsets relative to the seed so regions straddling RA=0 stay together
+            d_ra = ((ra - ra[seed] + 180) % 360 - 180) * cos_dec
+            d_dec = dec - dec[seed]
+            members = np.array([seed])
+            if extname is not None:
+                close = np.flatnonzero(unassigned & (np.abs(d_ra) <= max_region) & (np.abs(d_dec) <= max_region))
+                for idx in close[np.argsort(np.hypot(d_ra[close], d_dec[close]), kind='mergesort')]:
+                    if idx == seed:
+                        continue
+                    trial = np.append(members, idx)
+                    if get_stamps.cutout_bytes(_extent(d_ra[trial], d_dec[trial]) + radius) \
+                            < len(trial) * get_stamps.cutout_bytes(radius):
+                        members = trial
+            members.sort()
+            unassigned[members] = False
+            plan.append({'image': image,
+                         'extname': extname,
+                         'ra': (ra[seed] + d_ra[members].mean() / cos_dec) % 360,
+                         'dec': dec[seed] + d_dec[members].mean(),
+                         'radius': _extent(d_ra[members], d_dec[members]) + radius,
+                         'stamp_radius': radius,
+                         'members': [(keys[idx][0], image, ra[idx], dec[idx], stamps[keys[idx]]['families'])
+                                     for idx in members]})
+    return plan
+
+
+def _extent(d_ra, d_dec):
+    '''
+    Largest distance (degrees) of the offsets d_ra (scaled by cos dec), d_dec from their mean.
+    '''
+    return np.max(np.hypot(d_ra - d_ra.mean(), d_dec - d_dec.mean()))
+
+
+def report(stamps, plan):
+    '''
+    Print the requests and bytes needed per stamp, per family row, against fetching each planned region once.
+    '''
+    rows = sum(len(stamp['families']) for stamp in stamps.values())
+    stamp_radius = len(plan) > 0 and plan[0]['stamp_radius'] or 0
+    requests_before = rows * REQUESTS_PER_CUTOUT
+    bytes_before = rows * get_stamps.cutout_bytes(stamp_radius)
+    # regions of one exposure go out together as get_stamps.cutout_many multi-cutout requests
+    by_image = {}
+    for region in plan:
+        by_image[region['image']] = by_image.get(region['image'], 0) + 1
+    requests_after = sum(int(math.ceil(count / float(get_stamps.MAX_CUTOUTS_PER_REQUEST)))
+                         for count in by_image.values())
+    bytes_after = sum(get_stamps.cutout_bytes(region['radius']) for region in plan)
+    print "  Stamps requested by families: {}, distinct: {}, regions: {}".format(rows, len(stamps), len(plan))
+    print "  Requests: {} -> {} (saves {})".format(requests_before, requests_after, requests_before - requests_after)
+    print "  Bytes: {:.3g} -> {:.3g} (saves {:.3g})".format(bytes_before, bytes_after, bytes_before - bytes_after)
+    return {'requests_before': requests_before, 'requests_after': requests_after,
+            'bytes_before': bytes_before, 'bytes_after': bytes_after}
+
+
+def execute(plan, username, password, test=False):
+    '''
+    Download the regions of each exposure together with get_stamps.cutout_many and write the stamp of every
+    member, for every family that lists it. Members that fall off the downloaded pixels (e.g. across a CCD gap)
+    are cut out individually.
+    '''
+    by_image = {}
+    for region in plan:
+        by_image.setdefault(region['image'], []).append(region)
+
+    for image in sorted(by_image):
+        regions = by_image[image]
+        print "-- {} regions of {} with {} stamps".format(len(regions), image,
+                                                         sum(len(region['members']) for region in regions))
+        hdus = get_stamps.cutout_many(image, [(region['ra'], region['dec'], region['radius']) for region in regions],
+                                      username, password)
+        for region, hdu in zip(regions, hdus):
+            _write_region(region, hdu, username, password, test=test)
+    upload_queue.flush()
+
+
+def _write_region(region, hdu, username, password, test=False):
+    '''
+    Slice every member stamp out of a downloaded region and write it for each family that lists it.
+    '''
+    for objectname, image, ra, dec, families in region['members']:
+        stamp = None
+        if hdu is not None:
+            stamp = get_stamps.slice_stamp(hdu, ra, dec, region['stamp_radius'])
+        if stamp is None:
+            stamp = get_stamps.fetch_cutout(image, ra, dec, region['stamp_radius'], username, password)
+        if stamp is None:
+            continue
+        for familyname in families:
+            get_stamps.write_stamp(stamp, objectname, image, ra, dec, familyname, test=test)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,7 @@
 import os
-import io
 import sep
 import re
 import vos
-import urllib2 as url
 import numpy as np
 from astropy.io import fits
 from astropy.table import Table, vstack
@@ -14,18 +12,29 @@ from scipy.spatial import cKDTree
 import math
 import pandas as pd
 import sys
+import getpass
+import threading
 from shapely.geometry import Polygon, Point
-from astropy.coordinates import SkyCoord
 
 from ossos_scripts import storage
+from ossos_scripts import horizons
+from ossos_scripts import horizons_parser
 import ossos_scripts.wcs as wcs
+from ossos_scripts import cadc_session
+from ossos_scripts import stamp_index
+from ossos_scripts import upload_queue
+from ossos_scripts import services
+from ossos_scripts import metrics
+from ossos_scripts import profiling
 from ossos_scripts.storage import get_astheader, exists
 
 from get_images import get_image_info
 from find_family import find_family_members
 import get_stamps
 
-client = vos.Client()
+client = cadc_session.vospace
+_checked_dirs = set()
+_output_lock = threading.Lock()  # do_all runs photometry on several threads, one writer at a time
 
 ''' 
 Preforms photometry on .fits files given an input of family name and object name
@@ -74,8 +83,13 @@ def main():
                         default='p',
                         choices=['o', 'p', 's'], 
                         help="restrict type of image (unprocessed, reduced, calibrated)")
+    profiling.add_arguments(parser)
                             
     args = parser.parse_args()
+    profiling.from_args(args)
+    
+    # CADC PERMISSIONS, kept by the shared session
+    cadc_session.login(raw_input("CADC username: "), getpass.getpass("CADC password: "))
     
     find_objects_by_phot(args.family, args.object, float(args.aperture), float(args.thresh), args.filter, args.type)
     
@@ -97,6 +111,8 @@ def find_objects_by_phot(familyname, objectname=None, ap=10.0, th=3.5, filtertyp
     if  os.path.exists('asteroid_families/{}/{}_images.txt'.format(familyname, familyname)):
         expnum_list = []
         image_list = []
+        ra_list = []
+        dec_list = []
         with open(image_list_path) as infile:
             filestr = infile.read()
             fileline = filestr.split('\n')
@@ -104,81 +120,122 @@ def find_objects_by_phot(familyname, objectname=None, ap=10.0, th=3.5, filtertyp
                 if len(item.split()) > 0:
                     image_list.append(item.split()[0])
                     expnum_list.append(item.split()[1])
+                    ra_list.append(float(item.split()[3]))
+                    dec_list.append(float(item.split()[4]))
     else:  
         image_list, expnum_list, ra_list, dec_list = get_image_info(familyname, filtertype, imagetype)
+    
+    # one listing of vos_dir up front rather than discovering missing stamps image by image
+    stamp_uris = ['{}/{}_{}_{:8f}_{:8f}.fits'.format(vos_dir, image_list[index], expnum_list[index], ra_list[index], dec_list[index])
+                  for index in range(len(image_list))]
+    present = storage.exists_many(stamp_uris, force=True)
+    missing = len([uri for uri in stamp_uris if not present[uri]])
+    if missing > 0:
+        print "WARNING: {} of {} stamps are not in {}, they will be cut out as they come up".format(missing, len(stamp_uris), vos_dir)
         
     if objectname == None:
         for index, imageobject in enumerate(image_list):
             print 'Finding asteroid {} in family {} '.format(objectname, familyname)
-            iterate_thru_images(familyname, imageobject, expnum_list[index], ap, th, filtertype, imagetype)    
+            iterate_thru_images(familyname, imageobject, expnum_list[index], None, None, ap, th, filtertype, imagetype)    
     else:  
         for index, imageobject in enumerate(image_list):
             if objectname == imageobject:
                 print 'Finding asteroid {} in family {} '.format(objectname, familyname)
-                iterate_thru_images(familyname, objectname, expnum_list[index], ap, th, filtertype, imagetype)
+                iterate_thru_images(familyname, objectname, expnum_list[index], None, None, ap, th, filtertype, imagetype)
         
 
-def iterate_thru_images(familyname, objectname, expnum_p, username, password, ap=10.0, th=5.0, filtertype='r', imagetype='p'):
+def iterate_thru_images(familyname, objectname, expnum_p, username, password, ap=10.0, th=5.0, filtertype='r', imagetype='p',
+                        results=None, dates=None):
+    '''
+    Photometry of one stamp; the output lines written for it are also appended to results, if given.
+    dates, the MJDs of all images of the object, saves reading them from the family image list.
+    '''
+
+    inputs = fetch_inputs(familyname, objectname, expnum_p, username, password, dates)
+    if inputs is None:
+        return
+    try:
+        good_neighbours = measure(inputs, ap, th)
+    except Exception, e:
+        # a stamp SEP fails on has been cut out again larger by measure_stamp, the next run picks it up
+        print "ERROR: Error while doing photometry, {}".format(e)
+        return
+    if good_neighbours is None:
+        return True
+
+    print_output(familyname, objectname, expnum_p, good_neighbours, ap, th, results)
+    
+    success = True
+                
+    return success
 
-    success = False            
+def fetch_inputs(familyname, objectname, expnum_p, username, password, dates=None):
+    '''
+    The I/O half of iterate_thru_images: read the stamp and query JPL Horizons for the object, None if there is no stamp.
+    Everything measure needs is in the returned dict, no network access is left for it.
+    '''
     # initiate directories
-    init_dirs(familyname, objectname) 
+    init_dirs(familyname, objectname, image_list=dates is None) 
     
     try:
-        print "-- Performing photometry on image {} ".format(expnum_p)
-        septable, exptime, zeropt, size, pvwcs, stamp_found, start, end = get_fits_data(familyname, objectname, expnum_p, username, password, ap, th, filtertype, imagetype)
-        if stamp_found == False:
+        print "-- Reading stamp of image {} ".format(expnum_p)
+        stamp = read_stamp(familyname, objectname, expnum_p, username, password)
+        if stamp is None:
             print "WARNING: no stamps exist"
             get_stamps.get_one_stamp(objectname, expnum_p, 0.02, username, password, familyname)
             return
     except Exception, e:
         print "ERROR: Error while doing photometry, {}".format(e)
         return
+    datas, header, size = stamp
+    start = '{} {}'.format(header['DATE-OBS'], header['UTIME'])
+    end = '{} {}'.format(header['DATEEND'], header['UTCEND'])
     
     try:
         print "-- Querying JPL Horizon's ephemeris"
-        mag_list_jpl, r_sig = get_mag_rad(familyname, objectname)
+        mag_list_jpl, r_sig = get_mag_rad(familyname, objectname, dates)
         pRA, pDEC, ra_dot, dec_dot = get_coords(familyname, objectname, expnum_p, start, end)
     except Exception, e:
         print 'ERROR: Error while doing JPL query, {}'.format(e)
         raise
     
+    return {'familyname': familyname, 'objectname': objectname, 'expnum': expnum_p, 'username': username,
+            'password': password, 'datas': datas, 'header': header, 'size': size, 'mag_list_jpl': mag_list_jpl,
+            'r_sig': r_sig, 'pRA': pRA, 'pDEC': pDEC, 'ra_dot': ra_dot, 'dec_dot': dec_dot}
+
+def measure(inputs, ap=10.0, th=5.0):
+    '''
+    The CPU half of iterate_thru_images: SEP photometry of the stamp from fetch_inputs, matched against the catalogue
+    and the predicted position.  Returns the good neighbours, None if the object could not be looked for.
+    '''
+    objectname = inputs['objectname']
+    expnum_p = inputs['expnum']
+    header = inputs['header']
+    
+    print "-- Performing photometry on image {} ".format(expnum_p)
+    septable = measure_stamp(inputs['familyname'], objectname, expnum_p, inputs['username'], inputs['password'],
+                             inputs['datas'], ap, th)
+    pvwcs = wcs.WCS(header)
+    zeropt = header['PHOTZP']
+    exptime = header['EXPTIME']
+    
     table = append_table(septable, pvwcs, zeropt)
     transients, num_cat_objs = compare_to_catalogue(table, pvwcs)
     
-    r_new, r_old, enough = check_num_stars(num_cat_objs, size, objectname, expnum_p, username, password, familyname)
+    r_new, r_old, enough = check_num_stars(num_cat_objs, inputs['size'], objectname, expnum_p, inputs['username'],
+                                           inputs['password'], inputs['familyname'])
     if enough == False:
         return
         
+    r_sig = inputs['r_sig']
     print '-- Identifying object from nearest neighbours wihing {} pixels'.format(r_sig)
-    i_list, found = find_neighbours(transients, pvwcs, r_sig, pRA, pDEC, expnum_p)
+    i_list, found = find_neighbours(transients, pvwcs, r_sig, inputs['pRA'], inputs['pDEC'], expnum_p)
     if found == False:
-        success = True
-        return success
+        return
     
-    '''try:
-        
-        good_neighbours, mean = iden_good_neighbours(expnum_p, i_list, transients, zeropt, mag_list_jpl, ra_dot, dec_dot, exptime, pvwcs)
-        print good_neighbours
-
-        print_output(familyname, objectname, expnum_p, good_neighbours, ap, th)
-        
-        if len(good_neighbours) == 1:
-            involved = check_involvement(good_neighbours, table)
-            if involved == False:
-                print '-- Cutting out recentered postage stamp'
-                #cut_centered_stamp(familyname, objectname, expnum_p, good_neighbours, r_old, username, password)
-        
-        success = True
-        
-    except Exception, e:
-        print 'ERROR: {}'.format(e)
-        #get_stamps.get_one_stamp(objectname, expnum_p, r_new, username, password, familyname)   
-    '''
-    good_neighbours, r_err = iden_good_neighbours(expnum_p, i_list, transients, zeropt, mag_list_jpl, ra_dot, dec_dot, exptime, pvwcs)
+    good_neighbours, r_err = iden_good_neighbours(expnum_p, i_list, transients, zeropt, inputs['mag_list_jpl'],
+                                                  inputs['ra_dot'], inputs['dec_dot'], exptime, pvwcs)
     print good_neighbours
-
-    print_output(familyname, objectname, expnum_p, good_neighbours, ap, th)
     
     if len(good_neighbours) == 1:
         involved = check_involvement(good_neighbours, table, r_err)
@@ -186,61 +243,67 @@ def iterate_thru_images(familyname, objectname, expnum_p, username, password, ap
             print '-- Cutting out recentered postage stamp'
             #cut_centered_stamp(familyname, objectname, expnum_p, good_neighbours, r_old, username, password)
     
-    success = True
-                
-    return success
+    return good_neighbours
+            
+def read_stamp(familyname, objectname, expnum_p, username, password):
+    '''
+    The image data (one array per CCD), header and size of the stamp of objectname in expnum_p, None if there is none.
+    A stamp still on disk (it may still be uploading) is read from there, otherwise it is copied from VOSpace.
+    '''
+    # images named with convention: object_expnum_RA_DEC.fits, indexed from one listing of vos_dir
+    for file in stamp_index.get_index(vos_dir).get(objectname, expnum_p):
+        file_path = '{}/{}'.format(stamps_dir, file)
+        downloaded = not os.access(file_path, os.R_OK)
+        if downloaded:
+            storage.copy('{}/{}'.format(vos_dir, file), file_path)
+        try:
+            with fits.open(file_path) as hdulist: 
+                if hdulist[0].data is None:
+                    print 'IMAGE is mosaic'
+                    datas = [np.array(hdulist[1].data), np.array(hdulist[2].data)]
+                    header = hdulist[1].header.copy()
+                    size = header['NAXIS1'] + hdulist[2].header['NAXIS1']
+                else:
+                    datas = [np.array(hdulist[0].data)]
+                    header = hdulist[0].header.copy()
+                    size = header['NAXIS1']
+        except Exception, e:
+            print 'ERROR: {} xxxxxxxxxxx'.format(e)
+            get_stamps.get_one_stamp(objectname, expnum_p, 0.03, username, password, familyname)
+            raise
+               
+        if downloaded or not upload_queue.is_pending(file_path):
+            os.unlink(file_path)
+        return datas, header, size
+
+def measure_stamp(familyname, objectname, expnum_p, username, password, datas, ap, th):
+    '''
+    SEP photometry of every CCD of a stamp, in one table; a stamp SEP fails on is cut out again, larger, and the
+    error raised for the caller to record.
+    '''
+    try:
+        return vstack([sep_phot(data, ap, th) for data in datas])
+    except Exception, e:
+        print 'ERROR: {} xxxxxxxxxxx'.format(e)
+        get_stamps.get_one_stamp(objectname, expnum_p, 0.03, username, password, familyname)
+        raise
             
 def get_fits_data(familyname, objectname, expnum_p, username, password, ap, th, filtertype, imagetype):    
     
-    stamp_found = False      
-    for file in client.listdir(vos_dir): # images named with convention: object_expnum_RA_DEC.fits
-        if file.endswith('.fits') == True:
-            objectname_file = file.split('_')[0]
-            expnum_file = file.split('_')[1]
-            if (expnum_file == expnum_p) and (objectname_file == objectname):
-                stamp_found = True
-                file_path = '{}/{}'.format(stamps_dir, file)
-                storage.copy('{}/{}'.format(vos_dir, file), file_path)
-                try:
-                    with fits.open('{}/{}'.format(stamps_dir, file)) as hdulist: 
-                        #print hdulist.info()
-                        
-                        if hdulist[0].data is None:
-                            print 'IMAGE is mosaic'
-                            data1 = fits.getdata(file_path, 1)
-                            data2 = fits.getdata(file_path, 2)
-                            header = fits.getheader(file_path, 1)
-                            header2 = fits.getheader(file_path, 2)
-                            size = header['NAXIS1']+header2['NAXIS1']
-                            print 'good until here'
-                        
-                            table1 = sep_phot(data1, ap, th)
-                            print 'this time it worked'
-                            table2 = sep_phot(data2, ap, th)
-                            table = vstack([table1, table2])
-                            #ascii.write(table, os.path.join(stamps_dir, '{}_phot.txt'.format(expnum_p)))
-                            
-                        else:
-                            data = fits.getdata(file_path)
-                            header = fits.getheader(file_path)
-                            size = header['NAXIS1']
-                            table = sep_phot(data, ap, th)
-                            #ascii.write(table, os.path.join(stamps_dir, '{}_phot.txt'.format(expnum_p)))
-
-                except Exception, e:
-                    print 'ERROR: {} xxxxxxxxxxx'.format(e)
-                    get_stamps.get_one_stamp(objectname, expnum_p, 0.03, username, password, familyname)
-                    raise
+    stamp = read_stamp(familyname, objectname, expnum_p, username, password)
+    if stamp is None:
+        return None, None, None, None, None, False, None, None
+    datas, header, size = stamp
+    table = measure_stamp(familyname, objectname, expnum_p, username, password, datas, ap, th)
+    pvwcs = wcs.WCS(header)
+    zeropt = header['PHOTZP']
+    exptime = header['EXPTIME']
+    start = '{} {}'.format(header['DATE-OBS'], header['UTIME'])
+    end = '{} {}'.format(header['DATEEND'], header['UTCEND'])
                
-                os.unlink('{}/{}'.format(stamps_dir, file))
-                pvwcs = wcs.WCS(header)
-                zeropt = header['PHOTZP']
-                exptime = header['EXPTIME']
-                start = '{} {}'.format(header['DATE-OBS'], header['UTIME'])
-                end = '{} {}'.format(header['DATEEND'], header['UTCEND'])
-               
-                return table, exptime, zeropt, size, pvwcs, stamp_found, start, end
+    return table, exptime, zeropt, size, pvwcs, True, start, end
              
+@metrics.timer(metrics.SEP_EXTRACTION)
 def sep_phot(data, ap, th):
     ''' 
     Preforms photometry by SEP, similar to source extractor 
@@ -285,18 +348,36 @@ def sep_phot(data, ap, th):
     table = Table([objs['x'], objs['y'], flux, objs['a'], objs['b'], objs['theta']], names=('x', 'y', 'flux', 'a', 'b', 'theta'))
     return table             
                                         
-def get_mag_rad(familyname, objectname):
+def read_image_dates(filename):
+    '''
+    {object: [MJD of each of its images]} from an image list, whose time column is an MJD or an ISO 'date time'
+    '''
+    dates = {}
+    with open(filename) as infile:
+        for line in infile.readlines()[1:]:
+            columns = line.split()
+            if len(columns) == 0:
+                continue
+            try:
+                mjd = float(columns[5])
+            except ValueError:
+                mjd = Time('{} {}'.format(columns[5], columns[6]), scale='utc').mjd
+            dates.setdefault(columns[0], []).append(mjd)
+    return dates
+
+def get_mag_rad(familyname, objectname, dates=None):
+    '''
+    Magnitudes and search radius from JPL Horizons over the dates (MJD) of the object's images, by default those in
+    the family image list
+    '''
     
     if type(objectname) is not str:
         objectname = str(objectname)
     
     # from familyname_images.txt get date range of images for objectname
-    date_range = []
-    with open('asteroid_families/{}/{}_images.txt'.format(familyname, familyname)) as infile:
-        for line in infile.readlines()[1:]:
-            if len(line.split()) > 0:
-                if objectname == line.split()[0]:
-                    date_range.append(float(line.split()[5]))   
+    if dates is None:
+        dates = read_image_dates('asteroid_families/{}/{}_images.txt'.format(familyname, familyname)).get(objectname, [])
+    date_range = sorted(dates)
                     
     date_range_t = Time(date_range, format='mjd', scale='utc')
     assert  len(date_range_t.iso) > 0
@@ -310,9 +391,9 @@ def get_mag_rad(familyname, objectname):
     
     ephemerides = query_jpl(objectname, time_start, time_end, params=[9, 36], step=1)
     
-    mag_list =  np.array(ephemerides.icol(2))
-    ra_sig = np.mean(np.mean(ephemerides.icol(3)))
-    dec_sig = np.mean(np.mean(ephemerides.icol(4)))
+    mag_list =  ephemerides.column(2)
+    ra_sig = np.mean(ephemerides.column(3))
+    dec_sig = np.mean(ephemerides.column(4))
     
     print '>> RA and DEC 3sigma error: {:2f} {:2f}'.format(ra_sig / 0.184, dec_sig / 0.184)
         
@@ -337,27 +418,10 @@ def get_coords(familyname, objectname, expnum, time_start, time_end):
     ephemerides = query_jpl(objectname, time_start, time_end, params=[1, 3], step='1', su='m')
             
     mid = int(len(ephemerides)/2)
-    ra = ephemerides['R.A._(ICRF/J2000.0)'][mid]
-    dec = ephemerides[' DEC_(ICRF/J2000.0)'][mid]
-    ra_dot = ephemerides[' dRA*cosD'][mid]
+    ra_deg = ephemerides[horizons_parser.RA_DEG_COLUMN][mid]
+    dec_deg = ephemerides[horizons_parser.DEC_DEG_COLUMN][mid]
+    ra_dot = ephemerides['dRA*cosD'][mid]
     dec_dot = ephemerides['d(DEC)/dt'][mid]
-    
-    if dec.split()[0] < 0:
-        sign = -1
-    else:
-        sign = 1   
-        
-    ra_h = ra.split()[0]
-    ra_m = ra.split()[1]
-    ra_s = ra.split()[2]
-    dec_d = dec.split()[0]
-    dec_m = dec.split()[1]
-    dec_s = dec.split()[2]
-    
-    # c = SkyCoord('00h42m30s', '+41d12m00s', frame='icrs')
-    c = SkyCoord('{}h{}m{}s'.format(ra_h, ra_m, ra_s), '{}d{}m{}s'.format(dec_d, dec_m, dec_s), frame='icrs')
-    ra_deg = c.ra.degree 
-    dec_deg = c.dec.degree 
                         
     return ra_deg, dec_deg, ra_dot, dec_dot
 
@@ -369,7 +433,7 @@ def query_jpl(objectname, time_start, time_end, params, step, su='d'):
         s += "{},".format(p)
 
     # form URL pieces that Horizon needs for its processing instructions
-    urlArr = ["http://ssd.jpl.nasa.gov/horizons_batch.cgi?batch=1&COMMAND=",
+    urlArr = [services.HORIZONS_URL + "?batch=1&COMMAND=",
                   '',
                   "&MAKE_EPHEM='YES'&TABLE_TYPE='OBSERVER'&CENTER='568'&START_TIME=",
                   '',
@@ -398,39 +462,7 @@ def query_jpl(objectname, time_start, time_end, params, step, su='d'):
     urlArr[7] = step  # timestep   
     urlStr = "".join(urlArr)  # create the url to pass to Horizons
        
-    # Query Horizons; if it's busy, wait and try again in a minute
-    done = 0
-    while not done:
-        urlHan = url.urlopen(urlStr)
-        urlData = urlHan.readlines()
-        urlHan.close()
-        if len(urlData[0].split()) > 1:
-            if "BUSY:" <> urlData[0].split()[1]:
-                done = 1
-            else:
-                print urlData[0],
-                print "Sleeping 60 s and trying again"
-                time.sleep(60)
-        else:
-            done = 1
-    
-    EPHEM_CSV_START_MARKER = '$$SOE'
-    EPHEM_CSV_END_MARKER = '$$EOE'
-    ephemCSV_start = None
-    ephemCSV_end = None
-    for i, dataLine in enumerate(urlData):
-        if dataLine.strip() == EPHEM_CSV_START_MARKER:
-            ephemCSV_start = i
-        elif dataLine.strip() == EPHEM_CSV_END_MARKER:
-            ephemCSV_end = i
-    assert ephemCSV_start is not None, 'No ephem start'
-    assert ephemCSV_end is not None, 'No ephem end'
-    assert ephemCSV_start < ephemCSV_end, 'Ephem are a bit odd'
-    # The header, the lines *after* the start marker, up to (but not including, because it is a slice) the end marker
-    csv_lines = [urlData[ephemCSV_start - 2]] + urlData[ephemCSV_start + 1: ephemCSV_end]
-    ephemCSV = ''.join(csv_lines)
-    ephemCSVfile = io.BytesIO(ephemCSV)
-    ephemerides = pd.DataFrame.from_csv(ephemCSVfile)
+    ephemerides = horizons.query(urlStr)
     
     return ephemerides
     
@@ -452,6 +484,7 @@ def append_table(table, pvwcs, zeropt):
     table['mag'] = mag_sep_list
     return table
 
+@metrics.timer(metrics.CATALOGUE_MATCH)
 def compare_to_catalogue(table, pvwcs):
     
     #convert sep table elements from pixels to WCS
@@ -504,6 +537,7 @@ def compare_to_catalogue(table, pvwcs):
     transients = Table([trans_x, trans_y, trans_a, trans_b, trans_ra ,trans_dec, trans_mag, trans_theta], names=['x', 'y', 'a', 'b', 'ra', 'dec', 'mag', 'theta'])
     return transients, cat_objs
 
+@metrics.timer(metrics.IDENTIFICATION)
 def find_neighbours(transients, pvwcs, r_sig, pRA, pDEC, expnum_p):
     
     pX, pY = pvwcs.sky2xy(pRA, pDEC)
@@ -537,6 +571,7 @@ def neighbour_search(septable, pvwcs, r_sig, pRA, pDEC):
     
     return i_list
     
+@metrics.timer(metrics.IDENTIFICATION)
 def iden_good_neighbours(expnum, i_list, septable, zeropt, mag_list_jpl, ra_dot, dec_dot, exptime, pvwcs):
     '''
     Selects nearest neighbour object from predicted coordinates as object of interest
@@ -659,6 +694,7 @@ def iden_good_neighbours(expnum, i_list, septable, zeropt, mag_list_jpl, ra_dot,
     else: 
         return good_neighbours, f_pix_err 
         
+@metrics.timer(metrics.IDENTIFICATION)
 def check_involvement(objectdata, septable, r_err):
     '''
     Determine whether two objects are involved (ie overlapping psf's)
@@ -752,20 +788,27 @@ def check_num_stars(num_objs, size, objectname, expnum_p, username, password, fa
     
     return r_new, r_old, enough 
     
-def print_output(familyname, objectname, expnum_p, object_data, ap, th):
+def output_lines(objectname, expnum_p, object_data):
+    '''
+    The lines print_output writes for object_data, 'Object', "Image", 'RA', 'DEC', 'mag', 'x', 'y'
+    '''
+    return ['{} {} {} {} {} {} {}\n'.format(objectname, expnum_p, object_data[i][2], object_data[i][3],
+                                           object_data[i][4], object_data[i][0], object_data[i][1])
+            for i in range(0, len(object_data))]
+
+def print_output(familyname, objectname, expnum_p, object_data, ap, th, results=None):
 
     if object_data is None:
         print "WARNING: Could not identify object {} in image".format(objectname, expnum_p)
         
     else:
         out_filename = '{}_r{}_t{}_output.txt'.format(familyname, ap, th)
-        with open('asteroid_families/{}/{}_stamps/{}'.format(familyname, familyname, out_filename), 'a') as outfile:
+        with _output_lock, open('asteroid_families/{}/{}_stamps/{}'.format(familyname, familyname, out_filename), 'a') as outfile:
             try:
-                for i in range(0, len(object_data)):
-                    #'Object', "Image", 'RA', 'DEC', 'mag', 'x', 'y'
-                    outfile.write('{} {} {} {} {} {} {}\n'.format(
-                          objectname, expnum_p, object_data[i][2], object_data[i][3], object_data[i][4], object_data[i][0], 
-                          object_data[i][1]))
+                lines = output_lines(objectname, expnum_p, object_data)
+                outfile.writelines(lines)
+                if results is not None:
+                    results.extend(lines)
             except:
                 print "ERROR: cannot write to outfile <<<<<<<<<<<<<<<<<<<<<<<<<<"
     
@@ -779,17 +822,18 @@ def cut_centered_stamp(familyname, objectname, expnum_p, object_data, r_old, use
         print '-- Cutting recentered stamp'
         get_stamps.centered_stamp(objectname, expnum_p, r_old, object_data[0][5], object_data[0][6], username, password, familyname)                    
 
-def init_dirs(familyname, objectname):
+def init_dirs(familyname, objectname, image_list=True):
     
     # initiate vos directories 
     global vos_dir
     vos_dir = 'vos:kawebb/postage_stamps/{}'.format(familyname)
-    assert exists(vos_dir, force=True)
+    if vos_dir not in _checked_dirs:  # init_dirs runs per image, check the container once
+        assert exists(vos_dir, force=True)
+        _checked_dirs.add(vos_dir)
 
     
-    # initiate local directories
-    dir_path = os.path.dirname(os.path.abspath(__file__))
-    dir_path_base = '{}/asteroid_families'.format(dir_path)
+    # initiate local directories, in the working directory like the image list and the output file
+    dir_path_base = 'asteroid_families'
     global family_dir
     family_dir = os.path.join(dir_path_base, familyname)
     if os.path.isdir(family_dir) == False:
@@ -798,13 +842,16 @@ def init_dirs(familyname, objectname):
     stamps_dir = os.path.join(family_dir, familyname+'_stamps')
     if os.path.isdir(stamps_dir) == False:
         os.makedirs(stamps_dir)
+    if os.path.isdir(os.path.join(dir_path_base, 'temp_phot_files')) == False:
+        os.makedirs(os.path.join(dir_path_base, 'temp_phot_files'))
         
     global imageinfo
     imageinfo = '{}_images.txt'.format(familyname)
     global image_list_path
     image_list_path = '{}/{}'.format(family_dir, imageinfo)
         
-    assert os.path.exists('{}/{}'.format(family_dir, imageinfo))
+    if image_list:
+        assert os.path.exists('{}/{}'.format(family_dir, imageinfo))
     
     return family_dir, stamps_dir, vos_dir
 
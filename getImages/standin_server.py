@@ -0,0 +1,436 @@
+import argparse
+import BaseHTTPServer
+import cgi
+import math
+import os
+import random
+import re
+import shutil
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from cStringIO import StringIO
+
+from astropy.io import fits
+from astropy import wcs as astropy_wcs
+
+from ossos_scripts import wcs
+
+'''
+Local stand-in for the services the pipeline talks to, so runs can be benchmarked without the network.
+Point the pipeline at it with OSSOS_STANDIN=http://localhost:PORT (see ossos_scripts/services.py).
+
+The data root is laid out as:
+  vospace/<path>              files and directories served as VOSpace nodes, e.g.
+                              vospace/OSSOS/dbimages/1616690/1616690p.fits for vos:OSSOS/dbimages/1616690/1616690p.fits
+  ssois/<object>.tsv          SSOIS responses, an empty table is returned for other objects
+  horizons/<object>.txt       Horizons batch responses
+  CFHTSG/<expnum><ver>.head   astrometric headers, otherwise built from the headers of the dbimages FITS file
+  astdys/<file>               AstDyS family tables
+  tap/sync.xml                TAP response
+
+Endpoints: synctrans cutouts (CIRCLE ICRS and [extension] cutouts, several cutout parameters per request),
+a minimal VOSpace node API (GET/PUT/DELETE nodes, push transfers), data/pub file GET/PUT, SSOIS, Horizons,
+CFHTSG, AstDyS and TAP fixtures. Latency and error injection are configurable.
+'''
+
+VOSPACE_PREFIX = re.compile(r'^vos://[^/]*[~!]vospace/')
+CIRCLE = re.compile(r'^CIRCLE\s+ICRS\s+(\S+)\s+(\S+)\s+(\S+)$', re.IGNORECASE)
+EXTENSION = re.compile(r'^\[(\w+)\]$')
+NODE_XML = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<vos:node xmlns:vos="http://www.ivoa.net/xml/VOSpace/v2.0" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" uri="{uri}" xsi:type="{node_type}">\n'
+            '<vos:properties>\n<vos:property uri="ivo://ivoa.net/vospace/core#length">{length}</vos:property>\n'
+            '</vos:properties>\n{children}</vos:node>\n')
+CHILD_XML = '<vos:node uri="{uri}" xsi:type="{node_type}"><vos:properties/></vos:node>\n'
+TRANSFER_XML = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<vos:transfer xmlns:vos="http://www.ivoa.net/xml/VOSpace/v2.0">\n'
+                '<vos:target>{target}</vos:target>\n<vos:direction>{direction}</vos:direction>\n'
+                '<vos:protocol uri="ivo://ivoa.net/vospace/core#httpput"><vos:endpoint>{endpoint}</vos:endpoint>'
+                '</vos:protocol>\n</vos:transfer>\n')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Serve cutouts, VOSpace nodes, SSOIS and Horizons responses from local files, '
+                    'with optional latency and error injection.')
+    parser.add_argument("--root", '-d',
+                        action='store',
+                        default='standin_data',
+                        help='Data root directory, see the module docstring for its layout.')
+    parser.add_argument("--port", '-p',
+                        action='store',
+                        type=int,
+                        default=8080,
+                        help='Port to listen on.')
+    parser.add_argument("--latency",
+                        action='store',
+                        type=float,
+                        default=0.0,
+                        help='Seconds added to every response.')
+    parser.add_argument("--jitter",
+                        action='store',
+                        type=float,
+                        default=0.0,
+                        help='Up to this many more seconds, uniformly random, added to every response.')
+    parser.add_argument("--error-rate",
+                        action='store',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of requests answered with --error-status instead.')
+    parser.add_argument("--error-status",
+                        action='store',
+                        type=int,
+                        default=503,
+                        help='HTTP status of injected errors.')
+    parser.add_argument("--seed",
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Random seed for jitter and error injection.')
+    args = parser.parse_args()
+
+    server = make_server(args.root, args.port, args.latency, args.jitter, args.error_rate, args.error_status,
+                         args.seed)
+    print "----- Stand-in serving {} on http://localhost:{} -----".format(args.root, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print server.stats
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, root, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandinHandler)
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.transfers = {}
+        self.stats = {'requests': 0, 'errors': 0, 'bytes': 0, 'endpoints': {}}
+
+    @property
+    def url(self):
+        return 'http://localhost:{}'.format(self.server_address[1])
+
+    def record(self, endpoint, nbytes, error=False):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += nbytes
+            self.stats['endpoints'][endpoint] = self.stats['endpoints'].get(endpoint, 0) + 1
+            if error:
+                self.stats['errors'] += 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'errors': 0, 'bytes': 0, 'endpoints': {}}
+
+
+def make_server(root, port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, seed=None):
+    '''
+    Build a StandinServer on localhost:port (0 picks a free port).
+    '''
+    return StandinServer(('localhost', port), root, latency, jitter, error_rate, error_status, seed)
+
+
+def start_in_thread(root, **kwargs):
+    '''
+    Start a stand-in on a free port in a daemon thread, returns the server (server.url, server.stats, server.shutdown()).
+    '''
+    server = make_server(root, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, name='standin')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def vospace_path(target):
+    '''
+    vos://cadc.nrc.ca~vospace/OSSOS/x.fits or vos:OSSOS/x.fits -> OSSOS/x.fits
+    '''
+    target = urllib.unquote(target)
+    if target.startswith('vos:') and not target.startswith('vos://'):
+        return target[4:].lstrip('/')
+    return VOSPACE_PREFIX.sub('', target).lstrip('/')
+
+
+def sky2xy(header, ra, dec):
+    '''
+    Pixel position of ra, dec; headers with the astgwyn PV fit go through ossos_scripts.wcs like slice_stamp does.
+    '''
+    if 'NORDFIT' in header:
+        return wcs.WCS(header).sky2xy(ra, dec)
+    x, y = astropy_wcs.WCS(header).wcs_world2pix(ra, dec, 1)
+    return float(x), float(y)
+
+
+def cutout_hdus(hdulist, cutouts):
+    '''
+    Apply synctrans cutout specifications to a local HDUList, returns the list of resulting HDUs.
+    '''
+    result = []
+    for spec in cutouts:
+        spec = spec.strip()
+        match = EXTENSION.match(spec)
+        if match is not None:
+            key = match.group(1)
+            hdu = hdulist[int(key)] if key.isdigit() else hdulist[key]
+            result.append(fits.ImageHDU(data=hdu.data, header=hdu.header))
+            continue
+        match = CIRCLE.match(spec)
+        if match is None:
+            raise ValueError("Unsupported cutout {}".format(spec))
+        ra, dec, radius = [float(value) for value in match.groups()]
+        for hdu in hdulist:
+            if hdu.data is None or 'CRVAL1' not in hdu.header:
+                continue
+            header = hdu.header
+            x, y = sky2xy(header, ra, dec)
+            scale = 3600.0 * math.sqrt(abs(header['CD1_1'] * header['CD2_2'] - header['CD1_2'] * header['CD2_1']))
+            half = radius * 3600.0 / scale
+            naxis2, naxis1 = hdu.data.shape
+            x0 = max(0, int(math.floor(x - half)) - 1)
+            x1 = min(naxis1, int(math.ceil(x + half)))
+            y0 = max(0, int(math.floor(y - half)) - 1)
+            y1 = min(naxis2, int(math.ceil(y + half)))
+            if x0 >= x1 or y0 >= y1:
+                continue
+            cut_header = header.copy()
+            cut_header['CRPIX1'] = header['CRPIX1'] - x0
+            cut_header['CRPIX2'] = header['CRPIX2'] - y0
+            result.append(fits.ImageHDU(data=hdu.data[y0:y1, x0:x1], header=cut_header))
+    return result
+
+
+def to_fits_bytes(hdus):
+    '''
+    One HDU goes out as a simple FITS file, several as an MEF with an empty primary, like the CADC service.
+    '''
+    if len(hdus) == 1:
+        hdulist = fits.HDUList([fits.PrimaryHDU(data=hdus[0].data, header=hdus[0].header)])
+    else:
+        hdulist = fits.HDUList([fits.PrimaryHDU()] + hdus)
+    buf = StringIO()
+    hdulist.writeto(buf)
+    return buf.getvalue()
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body='', content_type='text/plain', headers=None, endpoint='other'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.server.record(endpoint, len(body), error=status >= 400)
+
+    def _delay_or_fail(self, endpoint):
+        '''
+        Apply the configured latency, then maybe inject an error. Returns True if the request was failed.
+        '''
+        server = self.server
+        with server.lock:
+            delay = server.latency + server.random.uniform(0, server.jitter)
+            fail = server.random.random() < server.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            self._send(server.error_status, 'Injected error\n', endpoint=endpoint)
+        return fail
+
+    def _params(self):
+        parsed = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(parsed.query, keep_blank_values=True)
+        if self.command == 'POST':
+            if 'x-www-form-urlencoded' in (self.headers.getheader('Content-Type') or ''):
+                for key, values in urlparse.parse_qs(self.body, keep_blank_values=True).items():
+                    params.setdefault(key, []).extend(values)
+        return parsed.path, params
+
+    def _local(self, *parts):
+        path = os.path.normpath(os.path.join(self.server.root, *parts))
+        if path != self.server.root and not path.startswith(self.server.root + os.sep):
+            raise ValueError("Path outside the data root")
+        return path
+
+    def _route(self):
+        path, params = self._params()
+        if path.endswith('/synctrans') and self.command == 'POST':
+            return 'transfer', self._push_transfer, (params,)
+        if path.endswith('/synctrans'):
+            return 'synctrans', self._synctrans, (params,)
+        if '/vospace/transfers/' in path:
+            return 'transfer', self._transfer_details, (path,)
+        if '/vospace/nodes/' in path:
+            return 'nodes', self._nodes, (path.split('/vospace/nodes/', 1)[1],)
+        if '/data/pub/CFHTSG/' in path:
+            return 'cfhtsg', self._cfhtsg, (path.split('/data/pub/CFHTSG/', 1)[1],)
+        if '/data/pub/vospace/' in path:
+            return 'data', self._data, (path.split('/data/pub/vospace/', 1)[1],)
+        if path.endswith('/ssos.pl'):
+            return 'ssois', self._ssois, (params,)
+        if path.endswith('/horizons_batch.cgi'):
+            return 'horizons', self._horizons, (params,)
+        if '/propsynth/' in path:
+            return 'astdys', self._fixture, ('astdys', path.split('/propsynth/', 1)[1])
+        if path.endswith('/tap/sync'):
+            return 'tap', self._fixture, ('tap', 'sync.xml')
+        return 'other', None, ()
+
+    def _handle(self):
+        # the connection is kept alive: whatever the answer, the body must be read or it is taken for the next request
+        self.body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        try:
+            endpoint, handler, args = self._route()
+        except Exception as e:
+            self._send(400, '{}\n'.format(e))
+            return
+        if self._delay_or_fail(endpoint):
+            return
+        if handler is None:
+            self._send(404, 'No such endpoint {}\n'.format(self.path), endpoint=endpoint)
+            return
+        try:
+            handler(*args)
+        except (IOError, OSError, KeyError) as e:
+            self._send(404, '{}\n'.format(e), endpoint=endpoint)
+        except ValueError as e:
+            self._send(400, '{}\n'.format(e), endpoint=endpoint)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+    do_HEAD = _handle
+
+    def _synctrans(self, params):
+        target = params.get('TARGET', params.get('target', ['']))[0]
+        filename = self._local('vospace', vospace_path(target))
+        if params.get('view', [''])[0] != 'cutout':
+            with open(filename, 'rb') as fobj:
+                self._send(200, fobj.read(), 'application/fits', endpoint='synctrans')
+            return
+        with fits.open(filename) as hdulist:
+            hdus = cutout_hdus(hdulist, params.get('cutout', []))
+            if len(hdus) == 0:
+                raise ValueError("Cutout does not overlap {}".format(target))
+            body = to_fits_bytes(hdus)
+        self._send(200, body, 'application/fits', endpoint='synctrans')
+
+    def _push_transfer(self, params):
+        target = re.search(r'<vos:target>([^<]*)</vos:target>', self.body or '')
+        if target is None:
+            raise ValueError("No transfer target")
+        token = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.transfers[token] = target.group(1)
+        self._send(303, '', headers={'Location': '{}/vospace/transfers/{}/results/transferDetails'.format(
+            self.server.url, token)}, endpoint='transfer')
+
+    def _transfer_details(self, path):
+        token = path.split('/vospace/transfers/', 1)[1].split('/')[0]
+        with self.server.lock:
+            target = self.server.transfers[token]
+        endpoint = '{}/data/pub/vospace/{}'.format(self.server.url, vospace_path(target))
+        self._send(200, TRANSFER_XML.format(target=target, direction='pushToVoSpace', endpoint=endpoint),
+                   'text/xml', endpoint='transfer')
+
+    def _nodes(self, node_path):
+        node_path = urllib.unquote(node_path).strip('/')
+        local = self._local('vospace', node_path)
+        uri = 'vos://cadc.nrc.ca!vospace/{}'.format(node_path)
+        if self.command == 'PUT':
+            if not os.path.isdir(local):
+                os.makedirs(local)
+            self._send(201, '', endpoint='nodes')
+            return
+        if self.command == 'DELETE':
+            if os.path.isdir(local):
+                shutil.rmtree(local)
+            else:
+                os.unlink(local)
+            self._send(200, '', endpoint='nodes')
+            return
+        if os.path.isdir(local):
+            children = ''.join(CHILD_XML.format(uri='{}/{}'.format(uri, cgi.escape(name, True)),
+                                                node_type=os.path.isdir(os.path.join(local, name)) and
+                                                'vos:ContainerNode' or 'vos:DataNode')
+                               for name in sorted(os.listdir(local)))
+            body = NODE_XML.format(uri=uri, node_type='vos:ContainerNode', length=0,
+                                   children='<vos:nodes>\n{}</vos:nodes>\n'.format(children))
+        elif os.path.exists(local):
+            body = NODE_XML.format(uri=uri, node_type='vos:DataNode', length=os.path.getsize(local), children='')
+        else:
+            raise IOError("No node {}".format(node_path))
+        self._send(200, body, 'text/xml', endpoint='nodes')
+
+    def _data(self, data_path):
+        local = self._local('vospace', urllib.unquote(data_path))
+        if self.command == 'PUT':
+            if not os.path.isdir(os.path.dirname(local)):
+                os.makedirs(os.path.dirname(local))
+            with open(local, 'wb') as fobj:
+                fobj.write(self.body)
+            self._send(201, '', endpoint='data')
+            return
+        with open(local, 'rb') as fobj:
+            self._send(200, fobj.read(), 'application/octet-stream', endpoint='data')
+
+    def _cfhtsg(self, name):
+        fixture = self._local('CFHTSG', name)
+        if os.path.exists(fixture):
+            with open(fixture) as fobj:
+                self._send(200, fobj.read(), endpoint='cfhtsg')
+            return
+        match = re.match(r'^(\d+)([ops])\.head$', name)
+        if match is None:
+            raise IOError("No header {}".format(name))
+        expnum, version = match.groups()
+        image = self._local('vospace', 'OSSOS', 'dbimages', expnum, '{}{}.fits'.format(expnum, version))
+        with fits.open(image) as hdulist:
+            # the .head format: the cards of each extension, each block closed by END
+            body = ''.join(hdu.header.tostring(sep='\n', endcard=True) + '\n' for hdu in hdulist[1:])
+        self._send(200, body, endpoint='cfhtsg')
+
+    def _ssois(self, params):
+        obj = params.get('object', [''])[0]
+        fixture = self._local('ssois', '{}.tsv'.format(obj.replace(' ', '_')))
+        if os.path.exists(fixture):
+            with open(fixture) as fobj:
+                self._send(200, fobj.read(), 'text/tab-separated-values', endpoint='ssois')
+            return
+        columns = ['Image', 'MJD', 'Filter', 'Exptime', 'Object_RA', 'Object_Dec', 'Image_target',
+                   'Telescope_Insturment', 'MetaData', 'Datalink']
+        self._send(200, '\t'.join(columns) + '\r\n', 'text/tab-separated-values', endpoint='ssois')
+
+    def _horizons(self, params):
+        command = params.get('COMMAND', [''])[0].strip("'").replace(' ', '_')
+        self._fixture('horizons', '{}.txt'.format(command), endpoint='horizons')
+
+    def _fixture(self, directory, name, endpoint=None):
+        with open(self._local(directory, name)) as fobj:
+            self._send(200, fobj.read(), endpoint=endpoint or directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+import argparse
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+
+from ossos_scripts import wcs
+
+'''
+Generates MegaCam-like postage stamps with known content, to benchmark the speed and the recall of the
+identification in sep_phot at scale.
+Each stamp has a sky background with a gradient, Poisson and read noise, stars taken from the photcat catalogue
+(or random stars, which are then written out as a photcat catalogue so compare_to_catalogue knows them) and one
+injected moving source, trailed by its rate over the exposure, optionally with a coma and a tail.
+Headers carry a PV distortion WCS readable by ossos_scripts.wcs and the keywords sep_phot.get_fits_data uses.
+Writes, for family SYNTH:
+  asteroid_families/SYNTH/SYNTH_stamps/<object>_<expnum>_<RA>_<DEC>.fits   the stamps
+  asteroid_families/SYNTH/SYNTH_images.txt                                  the image list, as get_images writes it
+  asteroid_families/SYNTH/SYNTH_truth.txt                                   the injected sources
+'''
+
+PIXEL_SCALE = 0.184  # arcsec per pixel
+CCD_SHAPE = (4644, 2112)  # MegaCam CCD, rows x columns
+PHOTCAT_FILES = ['Eall', 'Hall', 'Lall', 'Oall']
+FILTER = 'r.MP9601'
+TRUTH_COLUMNS = ['Object', 'Image', 'file', 'RA', 'DEC', 'x', 'y', 'mag', 'ra_rate', 'dec_rate', 'trail_px',
+                 'coma', 'tail']
+
+_catalogue = None  # (ra, dec, mag) arrays, set in each worker by _init_worker
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic MegaCam stamps with injected trailed asteroids and a truth table.')
+    parser.add_argument("--family", '-f',
+                        action="store",
+                        default='SYNTH',
+                        help="Family name the stamps are filed under.")
+    parser.add_argument("--count", '-n',
+                        type=int,
+                        default=1000,
+                        help='Number of stamps to generate.')
+    parser.add_argument("--objects",
+                        type=int,
+                        default=50,
+                        help='Number of distinct moving objects, the stamps are shared out between them.')
+    parser.add_argument("--size",
+                        type=int,
+                        default=400,
+                        help='Stamp width and height in pixels.')
+    parser.add_argument("--ra",
+                        type=float,
+                        default=150.0,
+                        help='RA (degrees) of the field centre.')
+    parser.add_argument("--dec",
+                        type=float,
+                        default=10.0,
+                        help='DEC (degrees) of the field centre.')
+    parser.add_argument("--spread",
+                        type=float,
+                        default=0.5,
+                        help='Stamps are centred within this many degrees of the field centre.')
+    parser.add_argument("--catalogue-dir",
+                        default='catalogue',
+                        help='Directory of the photcat files; random stars are used, and written here, if absent.')
+    parser.add_argument("--star-density",
+                        type=float,
+                        default=1.0,
+                        help='Random stars per square arcminute.')
+    parser.add_argument("--mag-range",
+                        nargs=2,
+                        type=float,
+                        default=[19.0, 22.5],
+                        help='Magnitude range of the moving objects.')
+    parser.add_argument("--rate-range",
+                        nargs=2,
+                        type=float,
+                        default=[10.0, 60.0],
+                        help='Range of the rate of motion of the moving objects, arcsec/hour.')
+    parser.add_argument("--coma-fraction",
+                        type=float,
+                        default=0.0,
+                        help='Fraction of the moving objects given a coma.')
+    parser.add_argument("--tail-fraction",
+                        type=float,
+                        default=0.0,
+                        help='Fraction of the moving objects given a tail.')
+    parser.add_argument("--fwhm",
+                        type=float,
+                        default=0.7,
+                        help='Seeing, arcsec.')
+    parser.add_argument("--sky",
+                        type=float,
+                        default=1000.0,
+                        help='Sky level, counts per pixel.')
+    parser.add_argument("--read-noise",
+                        type=float,
+                        default=5.0,
+                        help='Read noise, counts.')
+    parser.add_argument("--exptime",
+                        type=float,
+                        default=287.0,
+                        help='Exposure time, seconds.')
+    parser.add_argument("--zeropoint",
+                        type=float,
+                        default=26.0,
+                        help='Photometric zeropoint (PHOTZP).')
+    parser.add_argument("--processes", '-p',
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of worker processes.')
+    parser.add_argument("--seed",
+                        type=int,
+                        default=1,
+                        help='Random seed, the same seed gives the same stamps.')
+    parser.add_argument("--output-dir",
+                        default=None,
+                        help='Where to write the stamps, default asteroid_families/<family>/<family>_stamps.')
+    args = parser.parse_args()
+
+    family_dir = 'asteroid_families/{}'.format(args.family)
+    output_dir = args.output_dir or '{}/{}_stamps'.format(family_dir, args.family)
+    for directory in (family_dir, output_dir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    catalogue = read_photcat(args.catalogue_dir)
+    if catalogue is None:
+        print "No photcat files in {}, using random stars".format(args.catalogue_dir)
+
+    specs = plan_stamps(args)
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes, initializer=_init_worker, initargs=(catalogue,))
+    try:
+        results = []
+        for i, result in enumerate(pool.imap_unordered(_render_to_file, [(spec, output_dir) for spec in specs],
+                                                       chunksize=8)):
+            results.append(result)
+            if (i + 1) % 500 == 0:
+                print "  {} stamps".format(i + 1)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    results.sort(key=lambda result: result['index'])
+
+    write_image_list('{}/{}_images.txt'.format(family_dir, args.family), results)
+    write_truth('{}/{}_truth.txt'.format(family_dir, args.family), results)
+    if catalogue is None:
+        write_photcat(args.catalogue_dir, [star for result in results for star in result['stars']])
+
+    print "----- {} stamps in {:.1f} s ({:.1f} stamps/s, {} processes) written to {} -----".format(
+        len(results), elapsed, len(results) / elapsed, args.processes, output_dir)
+
+
+def pv_header(ra, dec, shape=CCD_SHAPE, distortion=1e-6):
+    '''
+    A MegaCam-like header with a third order PV (astgwyn) solution, readable by ossos_scripts.wcs.
+    '''
+    header = fits.Header()
+    header['NAXIS1'] = shape[1]
+    header['NAXIS2'] = shape[0]
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRPIX1'] = shape[1] / 2.0
+    header['CRPIX2'] = shape[0] / 2.0
+    header['CRVAL1'] = ra
+    header['CRVAL2'] = dec
+    header['CD1_1'] = -PIXEL_SCALE / 3600.0
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = PIXEL_SCALE / 3600.0
+    header['NORDFIT'] = 3
+    for axis in (1, 2):
+        for term in range(11):
+            header['PV{}_{}'.format(axis, term)] = 1.0 if term == 1 else 0.0
+    # a little quadratic distortion so the PV terms matter
+    header['PV1_4'] = distortion
+    header['PV2_4'] = -distortion
+    return header
+
+
+def read_photcat(directory):
+    '''
+    The (ra, dec, mag) arrays of the photcat files compare_to_catalogue uses, or None if there are none.
+    '''
+    ra, dec, mag = [], [], []
+    for name in PHOTCAT_FILES:
+        filename = os.path.join(directory, '{}.photcat'.format(name))
+        if not os.access(filename, os.R_OK):
+            continue
+        with open(filename) as infile:
+            for line in infile.readlines()[1:]:
+                columns = line.split()
+                if len(columns) > 4:
+                    ra.append(float(columns[0]))
+                    dec.append(float(columns[1]))
+                    mag.append(float(columns[4]))
+    if len(ra) == 0:
+        return None
+    return np.array(ra), np.array(dec), np.array(mag)
+
+
+def write_photcat(directory, stars):
+    '''
+    Write (ra, dec, mag) stars in the photcat layout, split over the four files compare_to_catalogue reads.
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for part, name in enumerate(PHOTCAT_FILES):
+        with open(os.path.join(directory, '{}.photcat'.format(name)), 'w') as outfile:
+            outfile.write('ra  dec  x  y  mag\n')
+            for ra, dec, mag in stars[part::len(PHOTCAT_FILES)]:
+                outfile.write('{:.7f}  {:.7f}  0.0  0.0  {:.3f}\n'.format(ra, dec, mag))
+
+
+def plan_stamps(args):
+    '''
+    One spec per stamp; every object gets a magnitude, a rate and a track, and each stamp its own seed so the
+    stamps do not depend on which worker renders them.
+    '''
+    rng = np.random.RandomState(args.seed)
+    objects = []
+    for i in range(args.objects):
+        rate = rng.uniform(*args.rate_range)
+        angle = rng.uniform(0, 2 * math.pi)
+        objects.append({'name': 'S{:05d}'.format(i),
+                        'mag': rng.uniform(*args.mag_range),
+                        'ra_rate': rate * math.cos(angle),
+                        'dec_rate': rate * math.sin(angle),
+                        'ra': args.ra + rng.uniform(-args.spread, args.spread),
+                        'dec': args.dec + rng.uniform(-args.spread, args.spread),
+                        'coma': rng.uniform() < args.coma_fraction,
+                        'tail': rng.uniform() < args.tail_fraction})
+    specs = []
+    for index in range(args.count):
+        obj = objects[index % len(objects)]
+        visit = index // len(objects)
+        mjd = 57000.0 + visit * 0.05
+        specs.append({'index': index,
+                      'seed': args.seed * 1000003 + index,
+                      'object': obj,
+                      'expnum': '{}p'.format(1700000 + index),
+                      'mjd': mjd,
+                      'size': args.size,
+                      'star_density': args.star_density,
+                      'fwhm': args.fwhm,
+                      'sky': args.sky,
+                      'read_noise': args.read_noise,
+                      'exptime': args.exptime,
+                      'zeropoint': args.zeropoint})
+    return specs
+
+
+def _init_worker(catalogue):
+    global _catalogue
+    _catalogue = catalogue
+
+
+def _render_to_file(task):
+    spec, output_dir = task
+    hdu, truth, stars = render_stamp(spec, _catalogue)
+    filename = '{}_{}_{:8f}_{:8f}.fits'.format(truth['Object'], truth['Image'], truth['RA'], truth['DEC'])
+    hdu.writeto(os.path.join(output_dir, filename), clobber=True)
+    truth['file'] = filename
+    return {'index': spec['index'], 'truth': truth, 'mjd': spec['mjd'], 'exptime': spec['exptime'],
+            'stars': stars}
+
+
+def add_source(data, x, y, flux, sigma, trail=(0.0, 0.0), coma=0.0, tail=None):
+    '''
+    Add a source centred at pixel x, y (1-based, FITS convention), smeared along the trail (dx, dy) in pixels.
+
+    :param coma: fraction of the flux in an exponential coma around the nucleus
+    :param tail: (length in pixels, position angle in radians) of an exponential tail, taking 20% of the flux
+    '''
+    dx, dy = trail
+    extent = 5 * sigma + 0.5 * math.hypot(dx, dy)
+    if coma > 0:
+        extent += 10 * sigma
+    if tail is not None:
+        extent += 3 * tail[0]
+    x0 = max(0, int(math.floor(x - 1 - extent)))
+    x1 = min(data.shape[1], int(math.ceil(x - 1 + extent)) + 1)
+    y0 = max(0, int(math.floor(y - 1 - extent)))
+    y1 = min(data.shape[0], int(math.ceil(y - 1 + extent)) + 1)
+    if x0 >= x1 or y0 >= y1:
+        return
+    yy, xx = np.mgrid[y0:y1, x0:x1].astype(np.float64)
+    xx += 1 - x
+    yy += 1 - y
+    # the trail as a sum of point spread functions half a sigma apart
+    steps = max(1, int(math.ceil(2 * math.hypot(dx, dy) / sigma)))
+    offsets = np.linspace(-0.5, 0.5, steps) if steps > 1 else np.zeros(1)
+    profile = np.zeros(xx.shape)
+    for offset in offsets:
+        profile += np.exp(-((xx - offset * dx) ** 2 + (yy - offset * dy) ** 2) / (2 * sigma ** 2))
+    model = profile / (2 * math.pi * sigma ** 2 * len(offsets))
+    nucleus = 1.0 - coma - (0.2 if tail is not None else 0.0)
+    model *= nucleus
+    r = np.hypot(xx, yy)
+    if coma > 0:
+        scale = 2 * sigma
+        model += coma * np.exp(-r / scale) / (2 * math.pi * scale ** 2)
+    if tail is not None:
+        length, angle = tail
+        along = xx * math.cos(angle) + yy * math.sin(angle)
+        across = -xx * math.sin(angle) + yy * math.cos(angle)
+        shape = np.where(along > 0, np.exp(-along / length - across ** 2 / (2 * sigma ** 2)), 0.0)
+        model += 0.2 * shape / (length * math.sqrt(2 * math.pi) * sigma)
+    data[y0:y1, x0:x1] += flux * model
+
+
+def render_stamp(spec, catalogue=None):
+    '''
+    Build one stamp from a plan_stamps spec.
+
+    :return: (PrimaryHDU, truth dict, stars as (ra, dec, mag) if they were random, else [])
+    '''
+    rng = np.random.RandomState(spec['seed'] % 4294967296)
+    obj = spec['object']
+    size = spec['size']
+    hours = (spec['mjd'] - 57000.0) * 24.0
+    cos_dec = math.cos(math.radians(obj['dec']))
+    ra = obj['ra'] + obj['ra_rate'] * hours / 3600.0 / cos_dec
+    dec = obj['dec'] + obj['dec_rate'] * hours / 3600.0
+
+    # the object lands near, not on, the stamp centre, as predictions do
+    header = pv_header(ra, dec, shape=(size, size))
+    header['CRPIX1'] += rng.uniform(-10, 10)
+    header['CRPIX2'] += rng.uniform(-10, 10)
+    pvwcs = wcs.WCS(header)
+    sigma = spec['fwhm'] / PIXEL_SCALE / 2.3548
+
+    yy, xx = np.mgrid[0:size, 0:size]
+    gradient = rng.uniform(-0.05, 0.05, 2)
+    data = spec['sky'] * (1 + gradient[0] * (xx / float(size) - 0.5) + gradient[1] * (yy / float(size) - 0.5))
+
+    stars = []
+    if catalogue is not None:
+        half = size * PIXEL_SCALE / 3600.0
+        cat_ra, cat_dec, cat_mag = catalogue
+        near = np.where((abs(cat_ra - ra) * cos_dec < half) & (abs(cat_dec - dec) < half))[0]
+        for i in near:
+            x, y = pvwcs.sky2xy(cat_ra[i], cat_dec[i])
+            add_source(data, x, y, 10 ** (-0.4 * (cat_mag[i] - spec['zeropoint'])), sigma)
+    else:
+        area = (size * PIXEL_SCALE / 60.0) ** 2
+        for i in range(rng.poisson(spec['star_density'] * area)):
+            x, y = rng.uniform(1, size, 2)
+            # roughly the counts of field stars, many more faint than bright
+            mag = 24.0 - 2.5 * math.log10(1 + 300 * rng.uniform())
+            add_source(data, x, y, 10 ** (-0.4 * (mag - spec['zeropoint'])), sigma)
+            star_ra, star_dec = pvwcs.xy2sky(x, y)
+            stars.append((float(star_ra), float(star_dec), mag))
+
+    x, y = pvwcs.sky2xy(ra, dec)
+    # ra_rate is dRA*cosD, RA grows to -x
+    trail = (-obj['ra_rate'] * spec['exptime'] / 3600.0 / PIXEL_SCALE,
+             obj['dec_rate'] * spec['exptime'] / 3600.0 / PIXEL_SCALE)
+    mag = obj['mag'] + rng.normal(0, 0.05)
+    coma = 0.3 if obj['coma'] else 0.0
+    tail = (5 * sigma, math.atan2(-trail[1], -trail[0])) if obj['tail'] else None
+    add_source(data, x, y, 10 ** (-0.4 * (mag - spec['zeropoint'])), sigma, trail=trail, coma=coma, tail=tail)
+
+    data = rng.poisson(np.clip(data, 0, None)).astype(np.float32)
+    data += rng.normal(0, spec['read_noise'], data.shape).astype(np.float32)
+
+    start = Time(spec['mjd'], format='mjd', scale='utc')
+    end = Time(spec['mjd'] + spec['exptime'] / 86400.0, format='mjd', scale='utc')
+    header['OBJECT'] = obj['name']
+    header['EXPNUM'] = int(spec['expnum'][:-1])
+    header['FILTER'] = FILTER
+    header['EXPTIME'] = spec['exptime']
+    header['PHOTZP'] = spec['zeropoint']
+    header['MJD-OBS'] = spec['mjd']
+    header['DATE-OBS'], header['UTIME'] = start.iso.split()
+    header['DATEEND'], header['UTCEND'] = end.iso.split()
+    header['SYNTHETC'] = (True, 'Generated by synthetic_sky.py')
+
+    truth = {'Object': obj['name'], 'Image': spec['expnum'], 'RA': ra, 'DEC': dec, 'x': x, 'y': y, 'mag': mag,
+             'ra_rate': obj['ra_rate'], 'dec_rate': obj['dec_rate'], 'trail_px': math.hypot(*trail),
+             'coma': int(obj['coma']), 'tail': int(obj['tail'])}
+    return fits.PrimaryHDU(data=data, header=header), truth, stars
+
+
+def write_image_list(filename, results):
+    '''
+    The image list in the layout get_images writes; the time column is the MJD, which is what sep_phot reads back.
+    '''
+    with open(filename, 'w') as outfile:
+        outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+            "Object", "Image", "Exp_time", "RA", "DEC", "time", "filter", "ext"))
+        for result in results:
+            truth = result['truth']
+            outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                truth['Object'], truth['Image'], result['exptime'], truth['RA'], truth['DEC'], result['mjd'],
+                FILTER, 'None'))
+
+
+def write_truth(filename, results):
+    with open(filename, 'w') as outfile:
+        outfile.write('\t'.join(TRUTH_COLUMNS) + '\n')
+        for result in results:
+            outfile.write('\t'.join(str(result['truth'][column]) for column in TRUTH_COLUMNS) + '\n')
+
+
+if __name__ == '__main__':
+    main()
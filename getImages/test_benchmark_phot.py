@@ -0,0 +1,25 @@
+from unittest import TestCase
+
+import numpy as np
+
+import benchmark_phot
+import synthetic_sky
+from ossos_scripts import wcs
+
+
+class TestBenchmarkPhot(TestCase):
+
+    def test_summarize(self):
+        timing = benchmark_phot.summarize([0.4, 0.1, 0.3, 0.2])
+        self.assertEqual((timing['n'], timing['min'], timing['max']), (4, 0.1, 0.4))
+        self.assertAlmostEqual(timing['median'], 0.25)
+        self.assertAlmostEqual(timing['mean'], 0.25)
+        self.assertEqual(timing['p90'], 0.4)
+
+    def test_synthetic_sources(self):
+        pvwcs = wcs.WCS(synthetic_sky.pv_header(150.0, 10.0))
+        table = benchmark_phot.synthetic_sources(np.random.RandomState(1), 10, pvwcs)
+        self.assertEqual(len(table), 10)
+        x, y = pvwcs.sky2xy(table['ra'][0], table['dec'][0])
+        self.assertAlmostEqual(x, table['x'][0], places=2)
+        self.assertAlmostEqual(y, table['y'][0], places=2)
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import benchmark_pipeline
+from ossos_scripts import horizons_parser
+
+
+class TestBenchmarkPipeline(TestCase):
+
+    def test_compare(self):
+        baseline = {'stamps_per_second': 10.0, 'requests_per_stamp': 3.0, 'cpu_per_stamp': 0.5,
+                    'peak_rss_kb': 100000.0}
+        result = dict(baseline, stamps_per_second=9.5, requests_per_stamp=4.0)
+        regressions = benchmark_pipeline.compare(result, baseline, 0.10)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('requests_per_stamp'))
+        self.assertEqual(benchmark_pipeline.compare(baseline, baseline, 0.0), [])
+
+    def test_horizons_fixture(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'B00000.txt')
+            truth = {'RA': 150.123456, 'DEC': -9.87654, 'mag': 19.5, 'ra_rate': 30.0, 'dec_rate': -12.0}
+            benchmark_pipeline.write_horizons(filename, {'mjd': 57000.5}, truth)
+            with open(filename) as infile:
+                ephemerides = horizons_parser.parse(infile)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(len(ephemerides), 3)
+        # the columns get_mag_rad reads by position and get_coords by name
+        self.assertAlmostEqual(ephemerides.column(2)[1], 19.5)
+        self.assertAlmostEqual(ephemerides.column(3)[1], 0.5)
+        self.assertAlmostEqual(ephemerides[horizons_parser.RA_DEG_COLUMN][1], truth['RA'], places=4)
+        self.assertAlmostEqual(ephemerides[horizons_parser.DEC_DEG_COLUMN][1], truth['DEC'], places=4)
+        self.assertAlmostEqual(ephemerides['dRA*cosD'][1], 30.0)
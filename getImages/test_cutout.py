@@ -45,3 +45,13 @@ class TestCutout(TestCase):
         get_stamps.cutout(TEST_NAME, test_observation, ra, dec, radius, username, password, TEST_NAME, test=True)
         out_md5 = hashlib.md5(open(output_name).read())
         self.assertEqual(out_md5.hexdigest(), test_md5)
+
+    def test_plan_cutouts(self):
+        small = (21.12, 11.87, 0.01)
+        regions = [small, small, small]
+        jobs = get_stamps.plan_cutouts(regions, ['ccd07', 'ccd07', None])
+        self.assertEqual(jobs, [('multi', None, [0, 1, 2])])
+        # enough area on one CCD that downloading the whole extension moves fewer bytes
+        big = (21.12, 11.87, 0.1)
+        jobs = get_stamps.plan_cutouts([big, big, small], ['ccd07', 'ccd07', 'ccd08'])
+        self.assertEqual(jobs, [('full', 'ccd07', [0, 1]), ('multi', None, [2])])
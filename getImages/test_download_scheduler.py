@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+import requests
+
+import download_scheduler
+
+
+class Throttled(object):
+    '''
+    Fetch that answers 503 on the first attempt at each job.
+    '''
+
+    def __init__(self):
+        self.seen = set()
+
+    def __call__(self, job):
+        if job not in self.seen:
+            self.seen.add(job)
+            response = requests.Response()
+            response.status_code = 503
+            raise requests.HTTPError('503 Service Unavailable', response=response)
+        return job * 2
+
+
+class TestDownloadScheduler(TestCase):
+
+    def test_run(self):
+        scheduler = download_scheduler.DownloadScheduler(lambda job: job * 2, workers=2, max_workers=4,
+                                                         max_inflight_bytes=10)
+        results = dict((job, result) for job, result, error in scheduler.run((job, 4) for job in range(20)))
+        scheduler.close()
+        self.assertEqual(results, dict((job, job * 2) for job in range(20)))
+        self.assertEqual(scheduler.inflight_bytes, 0)
+        self.assertEqual(scheduler.completed, 20)
+
+    def test_retry_transient(self):
+        scheduler = download_scheduler.DownloadScheduler(Throttled(), workers=4, backoff=0.0)
+        results = list(scheduler.run((job, 1) for job in range(5)))
+        scheduler.close()
+        self.assertEqual(sorted(result for job, result, error in results), [0, 2, 4, 6, 8])
+        self.assertEqual(scheduler.retried, 5)
+        self.assertTrue(scheduler.limit < 4)
+
+    def test_permanent_failure(self):
+        def fetch(job):
+            raise ValueError(job)
+        scheduler = download_scheduler.DownloadScheduler(fetch, workers=1)
+        results = list(scheduler.run([('a', 1)]))
+        scheduler.close()
+        self.assertEqual(len(results), 1)
+        self.assertTrue(isinstance(results[0][2], ValueError))
+        self.assertEqual(scheduler.retried, 0)
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+import synthetic_sky
+from ossos_scripts import footprints
+
+MJD = 57000.5
+EXPTIME = 287.0
+
+
+class TestFootprints(TestCase):
+
+    def setUp(self):
+        # one synthetic CCD centred on 150, 10
+        self.index = footprints.FootprintIndex()
+        self.index.add(1700000, 5, synthetic_sky.pv_header(150.0, 10.0), mjd_start=MJD, exptime=EXPTIME,
+                       camera_filter='r.MP9601')
+
+    def test_locate(self):
+        during = MJD + 100.0 / footprints.SECONDS_PER_DAY
+        matches = self.index.locate([150.0, 151.0, 150.0], [10.0, 10.0, 10.0], [during, during, MJD + 1.0])
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0]['index'], 0)
+        self.assertEqual(matches[0]['expnum'], 1700000)
+        self.assertEqual(matches[0]['ccd'], 5)
+        self.assertAlmostEqual(matches[0]['x'], synthetic_sky.CCD_SHAPE[1] / 2.0, places=1)
+        self.assertAlmostEqual(matches[0]['y'], synthetic_sky.CCD_SHAPE[0] / 2.0, places=1)
+        self.assertEqual(len(self.index.locate([150.0], [10.0], [during], camera_filter='u.MP9301')), 0)
+
+    def test_locate_objects(self):
+        # a daily ephemeris crossing the CCD, interpolated to the middle of the exposure
+        predictions = {'crossing': self.index.predict([MJD - 1.0, MJD + 1.0], [149.9, 150.1], [10.0, 10.0]),
+                       'elsewhere': self.index.predict([MJD - 1.0, MJD + 1.0], [160.0, 160.0], [10.0, 10.0]),
+                       'too_late': self.index.predict([MJD + 1.0, MJD + 2.0], [150.0, 150.0], [10.0, 10.0])}
+        self.assertEqual(len(predictions['too_late'][0]), 0)
+        matches = footprints.locate_objects(self.index, predictions, camera_filter='r.MP9601')
+        self.assertEqual(len(matches), 1)
+        name, expnum, ccd, x, y, mjd, ra, dec = matches[0]
+        self.assertEqual((name, expnum, ccd), ('crossing', 1700000, 5))
+        self.assertAlmostEqual(mjd, MJD + EXPTIME / 2.0 / footprints.SECONDS_PER_DAY)
+        self.assertAlmostEqual(ra, 150.0, places=3)
+
+    def test_save_load(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'footprints.npz')
+            self.index.save(filename)
+            index = footprints.FootprintIndex.load(filename)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(index.expnum, [1700000])
+        self.assertEqual(index.filter, ['r.MP9601'])
+        self.assertEqual(index.exptime, [EXPTIME])
+        self.assertTrue(np.allclose(index.ra_max, self.index.ra_max))
@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+from astropy.time import Time
+
+import get_images
+
+TEST_RETURN = ("Image\tMJD\tFilter\tExptime\tObject_RA\tObject_Dec\tImage_target\tTelescope_Insturment\tMetaData\tDatalink\n"
+               "1778096p\t57046.2509323\tr.MP9601\t387\t26.4876398468\t13.3259579396\tO15BP\tCFHT/MegaCam\tx\ty\n"
+               "1778098o\t57046.2709323\tr.MP9601\t387\t26.4876398468\t13.3259579396\tO15BP\tCFHT/MegaCam\tx\ty\n"
+               "1778101p\t57046.3009323\tr.MP9601\t500\t26.4876398468\t13.3259579396\tO15BP\tCFHT/MegaCam\tx\ty\n")
+
+
+class FakeCache(object):
+    # stands in for an SSOISCache that has every object
+    offline = False
+
+    def __init__(self):
+        self.objects = []
+
+    def get(self, object_name, **kwargs):
+        self.objects.append(object_name)
+        return TEST_RETURN
+
+
+class TestGetImages(TestCase):
+
+    def test_query_ssois(self):
+        cache = FakeCache()
+        stats = {}
+        results = list(get_images.query_ssois(['1', '2', '3'], 'p', 'r.MP9601', Time('2013-01-01', scale='utc'),
+                                              Time('2017-01-01', scale='utc'), threads=2, ssois_cache=cache,
+                                              stats=stats))
+        self.assertEqual([object_name for object_name, objects in results], ['1', '2', '3'])
+        self.assertEqual(sorted(cache.objects), ['1', '2', '3'])
+        self.assertEqual(list(results[0][1]['Image']), ['1778096p', '1778101p'])
+        # the totals are only complete once the generator has been run to the end
+        self.assertEqual(stats['rows'], 6)
+        self.assertEqual(stats['bytes'], 3 * len(TEST_RETURN))
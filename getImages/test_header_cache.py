@@ -0,0 +1,44 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from astropy.io import fits
+
+from ossos_scripts import header_cache
+
+
+class TestHeaderCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def header(self, value):
+        header = fits.Header()
+        header['EXPNUM'] = value
+        return header
+
+    def test_lru_bound(self):
+        cache = header_cache.HeaderCache('test', cache_dir=self.cache_dir, max_bytes=2 * fits.Card.length,
+                                         persistent=False)
+        cache['a'] = self.header(1)
+        cache['b'] = self.header(2)
+        self.assertTrue('a' in cache)  # a is now the most recently used
+        cache['c'] = self.header(3)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache['a']['EXPNUM'], 1)
+        self.assertEqual(cache.bytes, 2 * fits.Card.length)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_disk_store(self):
+        cache = header_cache.HeaderCache('test', cache_dir=self.cache_dir)
+        cache['vos:expnum.head'] = [None, self.header(1), self.header(2)]
+        other = header_cache.HeaderCache('test', cache_dir=self.cache_dir)
+        headers = other['vos:expnum.head']
+        self.assertEqual(headers[0], None)
+        self.assertEqual(headers[2]['EXPNUM'], 2)
+        self.assertEqual(other.disk_hits, 1)
+        self.assertFalse('vos:other.head' in other)
+        self.assertAlmostEqual(other.hit_rate(), 0.5)
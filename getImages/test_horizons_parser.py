@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+import numpy as np
+
+from ossos_scripts import horizons_parser
+
+TEST_RESPONSE = """*******************************************************************************
+JPL/HORIZONS                   6385 Martindavid (1991 FH2)   2015-Jan-24 00:00:00
+*******************************************************************************
+ EPOCH=  2457000.5 ! 2014-Dec-09.00 (TDB)         Residual RMS= .39019
+  EC= .1184337669541488   QR= 2.350106024807536   TP= 2456688.2563108141
+  OM= 202.8718495289512   W=  139.6520186137536   IN= 7.227770309281064
+  A= 2.665808812493596    MA= 66.43463413282713   ADIST= 2.981511600179656
+*******************************************************************************
+ Date__(UT)__HR:MN, , , R.A._(ICRF/J2000.0), DEC_(ICRF/J2000.0), dRA*cosD,d(DEC)/dt,
+*******************************************************************************
+$$SOE
+ 2015-Jan-24 00:00, , , 01 45 57.23, +13 19 33.6, 55.5246, 14.0164,
+ 2015-Jan-24 00:01, , , 01 45 57.29, -00 19 33.8, 55.5235, 14.0168,
+$$EOE
+*******************************************************************************
+Column meaning:
+"""
+
+
+class TestHorizonsParser(TestCase):
+
+    def test_parse(self):
+        ephemerides = horizons_parser.parse(TEST_RESPONSE.splitlines(True))
+        self.assertEqual(len(ephemerides), 2)
+        self.assertEqual(ephemerides.dates[0], '2015-Jan-24 00:00')
+        self.assertAlmostEqual(ephemerides['dRA*cosD'][1], 55.5235)
+        self.assertAlmostEqual(ephemerides.column(4)[0], 55.5246)
+        self.assertAlmostEqual(ephemerides[horizons_parser.RA_DEG_COLUMN][0],
+                               15 * (1 + 45 / 60.0 + 57.23 / 3600.0))
+        self.assertAlmostEqual(ephemerides[horizons_parser.DEC_DEG_COLUMN][1],
+                               -(19 / 60.0 + 33.8 / 3600.0))
+        self.assertEqual(ephemerides.header_lines[3].split()[0], 'EPOCH=')
+
+    def test_busy(self):
+        self.assertRaises(horizons_parser.HorizonsBusyError, horizons_parser.parse,
+                          [" Horizons BUSY: try again later\n"])
+
+    def test_sexagesimal(self):
+        degrees = horizons_parser.sexagesimal_to_degrees(np.array(['-01 30 00.0', '+02 15 00']))
+        self.assertAlmostEqual(degrees[0], -1.5)
+        self.assertAlmostEqual(degrees[1], 2.25)
@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from ossos_scripts import metrics
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+
+    def test_timer_and_counters(self):
+        @metrics.timer(metrics.SEP_EXTRACTION)
+        def extract(x):
+            return x * 2
+
+        self.assertEqual(extract(2), 4)
+        with metrics.timer(metrics.SEP_EXTRACTION):
+            pass
+        metrics.cache_lookup('mopheaders', True, tier='memory')
+        metrics.cache_lookup('mopheaders', False)
+        metrics.incr('http_received_bytes', 100, host='www.canfar.phys.uvic.ca')
+        metrics.incr('http_received_bytes', 50, host='www.canfar.phys.uvic.ca')
+
+        data = metrics.snapshot()
+        self.assertEqual(data['stages'][metrics.SEP_EXTRACTION]['calls'], 2)
+        counters = dict((counter['name'], counter) for counter in data['counters'])
+        self.assertEqual(counters['http_received_bytes']['value'], 150)
+        self.assertEqual(counters['cache_hits']['labels'], {'cache': 'mopheaders', 'tier': 'memory'})
+
+        text = metrics.to_prometheus()
+        self.assertTrue('ossos_stage_calls_total{stage="sep_extraction"} 2' in text)
+        self.assertTrue('ossos_http_received_bytes_total{host="www.canfar.phys.uvic.ca"} 150' in text)
+        self.assertEqual(text.count('# TYPE ossos_cache_hits_total counter'), 1)
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+import get_stamps
+import plan_stamps
+
+RADIUS = 0.01
+STAMP = 4 * RADIUS / 3  # close enough that one cutout of two stamps is smaller than their two cutouts
+
+
+class TestPlanStamps(TestCase):
+
+    def stamps(self):
+        stamps = {}
+        # a tight pair and a stamp far from them on one CCD, the same positions on the next CCD of the exposure
+        for ext in ['3', '4']:
+            for i, (ra, dec) in enumerate([(10.0, 5.0), (10.0 + STAMP / 2, 5.0), (10.0, 5.05)]):
+                stamps[('OBJ{}{}'.format(ext, i), '1900000p')] = {'ra': ra, 'dec': dec, 'ext': ext,
+                                                                  'families': ['A', 'B']}
+        return stamps
+
+    def test_regions_per_ccd(self):
+        stamps = self.stamps()
+        plan = plan_stamps.plan_regions(stamps, RADIUS)
+        self.assertEqual(sorted(len(region['members']) for region in plan), [1, 1, 2, 2])
+        self.assertEqual(sum(len(region['members']) for region in plan), len(stamps))
+        for region in plan:
+            # the objects are named OBJ<ext><i>, SSOIS numbers the extensions from 1 and the CCDs from 0
+            exts = set(objectname[3] for objectname, image, ra, dec, families in region['members'])
+            self.assertEqual(len(exts), 1)
+            self.assertEqual(region['extname'], 'ccd{:02d}'.format(int(exts.pop()) - 1))
+
+    def test_no_more_bytes(self):
+        stamps = self.stamps()
+        totals = plan_stamps.report(stamps, plan_stamps.plan_regions(stamps, RADIUS))
+        self.assertTrue(totals['bytes_after'] <= totals['bytes_before'])
+        self.assertTrue(totals['bytes_after'] < len(stamps) * get_stamps.cutout_bytes(RADIUS))
+        # spread out, no two stamps are worth one cutout and nothing is merged
+        spread = dict((key, dict(stamp, dec=stamp['dec'] + 0.1 * i))
+                      for i, (key, stamp) in enumerate(sorted(stamps.items())))
+        plan = plan_stamps.plan_regions(spread, RADIUS)
+        self.assertEqual(len(plan), len(spread))
+        totals = plan_stamps.report(spread, plan)
+        self.assertEqual(totals['bytes_after'], len(spread) * get_stamps.cutout_bytes(RADIUS))
@@ -0,0 +1,91 @@
+import os
+import pstats
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from ossos_scripts import metrics
+from ossos_scripts import profiling
+
+
+class TestProfiling(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hooks = list(metrics._stage_hooks)
+
+    def tearDown(self):
+        metrics._stage_hooks[:] = self.hooks
+        shutil.rmtree(self.directory)
+
+    def profile(self, mode, stages=(metrics.SEP_EXTRACTION,)):
+        profiler = profiling.Profiler(mode, stages=stages, output_dir=self.directory, interval=0.001)
+        metrics.add_stage_hook(profiler.enter, profiler.exit)
+        return profiler
+
+    def test_cprofile_per_stage(self):
+        profiler = self.profile(profiling.CPROFILE)
+
+        @metrics.timer(metrics.SEP_EXTRACTION)
+        def extract():
+            return sum(range(1000))
+
+        @metrics.timer(metrics.CATALOGUE_MATCH)
+        def match():
+            return extract()
+
+        extract()
+        match()  # not profiled itself, the extraction inside it is
+        profiler.dump()
+
+        names = os.listdir(self.directory)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith(metrics.SEP_EXTRACTION + '.'))
+        self.assertTrue(names[0].endswith('.MainThread.pstats'))
+        stats = pstats.Stats(os.path.join(self.directory, names[0]))
+        calls = dict((function[2], values[0]) for function, values in stats.stats.items())
+        self.assertEqual(calls['extract'], 2)
+        self.assertFalse('match' in calls)
+
+    def test_sample_folded_stacks(self):
+        profiler = self.profile(profiling.SAMPLE)
+
+        def busy_wait():
+            end = time.time() + 0.1
+            while time.time() < end:
+                pass
+
+        with metrics.timer(metrics.SEP_EXTRACTION):
+            busy_wait()
+        profiler.dump()
+
+        names = os.listdir(self.directory)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].endswith('.folded'))
+        with open(os.path.join(self.directory, names[0])) as infile:
+            lines = infile.readlines()
+        self.assertTrue(len(lines) > 0)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue('test_profiling.py:busy_wait' in stack)
+        self.assertTrue(int(count) > 0)
+
+    def test_memory_growth(self):
+        profiler = profiling.Profiler(None, stages=[metrics.SEP_EXTRACTION], output_dir=self.directory,
+                                      trace_malloc=True)
+        metrics.add_stage_hook(profiler.enter, profiler.exit)
+        kept = []
+        for i in range(2):
+            with metrics.timer(metrics.SEP_EXTRACTION):
+                kept.append('x' * (20 * 1024 * 1024))
+        with metrics.timer(metrics.SEP_EXTRACTION):
+            pass
+        profiler.dump()
+
+        # growth in each pass, not the peak of the process
+        megabyte = profiling.tracemalloc is None and 1024 or 1024 * 1024
+        passes, total, largest = profiler.memory[metrics.SEP_EXTRACTION]
+        self.assertEqual(passes, 3)
+        self.assertTrue(30 * megabyte < total < 60 * megabyte)
+        self.assertTrue(15 * megabyte < largest < 30 * megabyte)
+        self.assertEqual(os.listdir(self.directory), ['memory.{}.txt'.format(os.getpid())])
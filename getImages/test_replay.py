@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import requests
+
+import standin_server
+from ossos_scripts import replay
+
+
+class TestReplay(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'horizons'))
+        with open(os.path.join(self.root, 'horizons', 'Ceres.txt'), 'w') as fobj:
+            fobj.write('$$SOE\n 2014-Jan-01 00:00 *  155.1 11.2\n$$EOE\n')
+        self.archive = os.path.join(self.root, 'run.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_request_key(self):
+        self.assertEqual(replay.request_key('get', 'http://a.org/x?b=2&a=1'),
+                         replay.request_key('GET', 'http://localhost:8080/x?a=1&b=2'))
+        self.assertNotEqual(replay.request_key('POST', 'http://a.org/x', 'object=A'),
+                            replay.request_key('POST', 'http://a.org/x', 'object=B'))
+
+    def test_record_then_replay(self):
+        server = standin_server.start_in_thread(self.root)
+        try:
+            session = requests.Session()
+            replay.install(session, record=self.archive)
+            url = server.url + '/horizons_batch.cgi'
+            recorded = session.get(url, params={'batch': 1, 'COMMAND': 'Ceres'}, stream=True)
+            lines = list(recorded.iter_lines())
+            self.assertEqual(session.get(url, params={'COMMAND': 'Pallas'}).status_code, 404)
+            replay.get_recorder(self.archive).close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        session = requests.Session()
+        adapter = replay.install(session, replay=self.archive)
+        # the server is gone, responses come from the archive whatever the host
+        replayed = session.get('http://ssd.jpl.nasa.gov/horizons_batch.cgi', params={'COMMAND': 'Ceres', 'batch': 1},
+                               stream=True)
+        self.assertEqual(list(replayed.iter_lines()), lines)
+        self.assertEqual(session.get(url, params={'COMMAND': 'Pallas'}).status_code, 404)
+        self.assertRaises(replay.ReplayMiss, session.get, url, params={'COMMAND': 'Vesta'})
+        self.assertEqual((adapter.served, adapter.missed), (2, 1))
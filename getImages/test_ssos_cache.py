@@ -0,0 +1,69 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from astropy.time import Time
+
+from ossos_scripts import ssos_cache
+
+COLUMNS = ['Image', 'MJD', 'Filter', 'Exptime']
+# one frame every 100 days from 2013 to 2016, and one on 2015-01-01 which two queries below both return
+MJDS = sorted([56300.5 + 100 * i for i in range(15)] + [57023.5])
+
+
+class FakeSSOISCache(ssos_cache.SSOISCache):
+    # answers from MJDS instead of SSOIS and remembers what it was asked
+    def __init__(self, *args, **kwargs):
+        super(FakeSSOISCache, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def _fetch(self, mbcobject, start_date, end_date, telescope_instrument):
+        self.requests.append((str(start_date), str(end_date)))
+        # SSOIS epochs are whole days, frames taken on the end date are included
+        return COLUMNS, [['{}p'.format(1600000 + i), repr(mjd), 'r.MP9601', '287'] for i, mjd in enumerate(MJDS)
+                         if start_date.mjd <= mjd < end_date.mjd + 1]
+
+
+def _mjds(response):
+    return [float(line.split('\t')[1]) for line in response.splitlines()[1:]]
+
+
+class TestSSOISCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def get(self, cache, start, end, mbcobject='elst-pizarro'):
+        return cache.get(mbcobject, search_start_date=Time(start, scale='utc'),
+                         search_end_date=Time(end, scale='utc'))
+
+    def test_partial_overlap(self):
+        cache = FakeSSOISCache(cache_dir=self.cache_dir)
+        first = self.get(cache, '2014-01-01', '2015-01-01')
+        self.assertEqual(cache.requests, [('2014-01-01', '2015-01-01')])
+        self.assertEqual(_mjds(first), [mjd for mjd in MJDS if 56658 <= mjd < 57024])
+
+        # only the epochs on either side of what is cached are asked for, and merged in order without duplicates
+        wider = self.get(cache, '2013-01-01', '2016-01-01')
+        self.assertEqual(cache.requests[1:], [('2013-01-01', '2014-01-01'), ('2015-01-01', '2016-01-01')])
+        self.assertEqual(_mjds(wider), [mjd for mjd in MJDS if 56293 <= mjd < 57389])
+        self.assertEqual(cache.misses, 2)
+
+        # a window inside the cached one is a hit, and a fresh cache on the same directory has it too
+        cache = FakeSSOISCache(cache_dir=self.cache_dir)
+        self.assertEqual(_mjds(self.get(cache, '2014-01-01', '2015-01-01')), _mjds(first))
+        self.assertEqual(cache.requests, [])
+        self.assertEqual(cache.hits, 1)
+
+    def test_offline(self):
+        self.get(FakeSSOISCache(cache_dir=self.cache_dir), '2014-01-01', '2015-01-01')
+
+        cache = FakeSSOISCache(cache_dir=self.cache_dir, offline=True)
+        # what is cached is all there is, the rest of the window is not asked for
+        response = self.get(cache, '2013-01-01', '2016-01-01')
+        self.assertEqual(_mjds(response), [mjd for mjd in MJDS if 56658 <= mjd < 57024])
+        self.assertRaises(IOError, self.get, cache, '2014-01-01', '2015-01-01', mbcobject='2001 QR322')
+        self.assertEqual(cache.requests, [])
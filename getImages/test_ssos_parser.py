@@ -0,0 +1,26 @@
+from unittest import TestCase
+
+from ossos_scripts import ssos_parser
+
+TEST_RETURN = ("Image\tMJD\tFilter\tExptime\tObject_RA\tObject_Dec\tImage_target\tTelescope_Insturment\tMetaData\tDatalink\n"
+               "1778096p\t57046.2509323\tr.MP9601\t387\t26.4876398468\t13.3259579396\tO15BP\tCFHT/MegaCam\tx\ty\n"
+               "1778097p\t57046.2609323\tr.MP9601\t387\t26.4876398468\t13.3259579396\tWP15\tCFHT/MegaCam\tx\ty\n"
+               "1778098o\t57046.2709323\tr.MP9601\t387\t26.4876398468\t13.3259579396\tO15BP\tCFHT/MegaCam\tx\ty\n"
+               "1778099p\t57046.2809323\tg.MP9401\t387\t26.4876398468\t13.3259579396\tO15BP\tCFHT/MegaCam\tx\ty\n"
+               "1778100p\t57046.2909323\tr.MP9601\t60\t26.4876398468\t13.3259579396\tO15BP\tCFHT/MegaCam\tx\ty\n"
+               "1778101p\t57046.3009323\tr.MP9601\t500\t26.4876398468\t13.3259579396\tO15BP\tCFHT/MegaCam\tx\n"
+               "1778102p\t57046.3109323\tr.MP9601\t500\n")
+
+
+class TestSSOSParser(TestCase):
+
+    def test_parse(self):
+        table = ssos_parser.parse(TEST_RETURN)
+        self.assertEqual(len(table), 6)
+        self.assertEqual(table['Exptime'].dtype.kind, 'i')
+        self.assertAlmostEqual(table['MJD'][0], 57046.2509323)
+        self.assertEqual(table['Datalink'][5], 'None')
+
+    def test_select(self):
+        table = ssos_parser.select(ssos_parser.parse(TEST_RETURN), 'CFHT/MegaCam', 'r.MP9601', 'p', [287, 387, 500])
+        self.assertEqual(list(table['Image']), ['1778096p', '1778101p'])
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from ossos_scripts import stamp_index
+
+VOS_DIR = 'vos:kawebb/postage_stamps/TEST'
+STAMP = 'TEST_1667879p_21.123633_11.869728.fits'
+
+
+class TestStampIndex(TestCase):
+
+    def setUp(self):
+        # the container as storage.listdir would list it, and the listings asked for
+        self.names = [STAMP, 'TEST_1616690p_216.966498_-13.832557_centered.fits', 'TEST_output.txt']
+        self.listed = []
+        self.listdir = stamp_index.storage.listdir
+        stamp_index.storage.listdir = self.fake_listdir
+
+    def tearDown(self):
+        stamp_index.storage.listdir = self.listdir
+        with stamp_index._indices_lock:
+            stamp_index._indices.clear()
+
+    def fake_listdir(self, uri, force=False):
+        self.listed.append(uri)
+        return list(self.names)
+
+    def test_parse_stamp_name(self):
+        parsed = stamp_index.parse_stamp_name('TEST_1667879p_21.123633_11.869728.fits')
+        self.assertEqual(parsed[:2], ('TEST', '1667879p'))
+        self.assertAlmostEqual(parsed[2], 21.123633)
+        self.assertAlmostEqual(parsed[3], 11.869728)
+        self.assertEqual(parsed[4], '')
+        parsed = stamp_index.parse_stamp_name('TEST_1616690p_216.966498_-13.832557_centered.fits')
+        self.assertEqual(parsed[4], 'centered')
+        self.assertEqual(stamp_index.parse_stamp_name('TEST_output.txt'), None)
+        self.assertEqual(stamp_index.parse_stamp_name('TEST_1616690p.fits'), None)
+
+    def test_shared_index(self):
+        index = stamp_index.get_index(VOS_DIR)
+        self.assertTrue(index is stamp_index.get_index(VOS_DIR))
+        # nothing listed yet, the write is kept for the next listing to merge in
+        stamp_index.record_write('{}/TEST_1616699p_21.123633_11.869728.fits'.format(VOS_DIR))
+        self.assertEqual(index.listings, 0)
+        self.assertTrue('TEST_1616699p_21.123633_11.869728.fits' in index._written)
+        self.assertEqual(index.get('TEST', '1616699p'), ['TEST_1616699p_21.123633_11.869728.fits'])
+        self.assertEqual(self.listed, [VOS_DIR])
+
+    def test_listing_per_ttl(self):
+        index = stamp_index.get_index(VOS_DIR, ttl=60.0)
+        self.assertEqual(index.get('TEST', '1667879p'), [STAMP])
+        self.assertTrue(index.exists('TEST_output.txt'))
+        self.assertEqual(index.get('TEST', '1616690p'), ['TEST_1616690p_216.966498_-13.832557_centered.fits'])
+        self.assertEqual(self.listed, [VOS_DIR])
+
+        # our own writes and removals are seen without listing again
+        written = 'TEST_1667879p_21.123633_11.869728_centered.fits'
+        stamp_index.record_write('{}/{}'.format(VOS_DIR, written))
+        self.assertEqual(index.get('TEST', '1667879p'), [STAMP, written])
+        stamp_index.record_remove('{}/{}'.format(VOS_DIR, STAMP))
+        self.assertFalse(index.exists(STAMP))
+        self.assertEqual(index.get('TEST', '1667879p'), [written])
+        self.assertEqual(index.listings, 1)
+
+        # once the listing is older than the ttl the container is listed again; the write, whose upload may still be
+        # queued, is kept even though the listing does not show it
+        self.names.remove(STAMP)
+        index._listed -= 61.0
+        self.assertEqual(index.get('TEST', '1667879p'), [written])
+        self.assertEqual(index.listings, 2)
+        self.assertEqual(self.listed, [VOS_DIR, VOS_DIR])
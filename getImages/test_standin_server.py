@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+from unittest import TestCase
+
+import numpy as np
+import requests
+from astropy.io import fits
+
+import standin_server
+
+
+def _ccd_header(extname, crval1):
+    header = fits.Header()
+    header['EXTNAME'] = extname
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRPIX1'] = 50.0
+    header['CRPIX2'] = 50.0
+    header['CRVAL1'] = crval1
+    header['CRVAL2'] = 10.0
+    header['CD1_1'] = -0.185 / 3600.0
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 0.185 / 3600.0
+    return header
+
+
+class TestStandinServer(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        dbimages = os.path.join(self.root, 'vospace', 'OSSOS', 'dbimages', '1616690')
+        os.makedirs(dbimages)
+        hdulist = fits.HDUList([fits.PrimaryHDU()] +
+                               [fits.ImageHDU(data=np.zeros((100, 100), dtype=np.float32),
+                                              header=_ccd_header('ccd{:02d}'.format(i), 200.0 + i))
+                                for i in range(2)])
+        hdulist.writeto(os.path.join(dbimages, '1616690p.fits'))
+        self.server = standin_server.start_in_thread(self.root)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def test_vospace_path(self):
+        self.assertEqual(standin_server.vospace_path('vos://cadc.nrc.ca~vospace/OSSOS/dbimages/1/1p.fits'),
+                         'OSSOS/dbimages/1/1p.fits')
+        self.assertEqual(standin_server.vospace_path('vos:OSSOS/dbimages/1/1p.fits'), 'OSSOS/dbimages/1/1p.fits')
+
+    def test_cutouts(self):
+        params = {'TARGET': 'vos://cadc.nrc.ca~vospace/OSSOS/dbimages/1616690/1616690p.fits',
+                  'DIRECTION': 'pullFromVoSpace', 'protocol': 'ivo://ivoa.net/vospace/core#httpget',
+                  'view': 'cutout', 'cutout': ['CIRCLE ICRS 200.0 10.0 0.001', '[ccd01]']}
+        response = requests.get(self.server.url + '/vospace/auth/synctrans', params=params)
+        self.assertEqual(response.status_code, 200)
+        hdulist = fits.open(StringIO(response.content))
+        self.assertEqual(len(hdulist), 3)
+        self.assertEqual(hdulist[1].header['EXTNAME'], 'ccd00')
+        self.assertTrue(hdulist[1].data.shape[0] < 100)
+        self.assertEqual(hdulist[2].data.shape, (100, 100))
+        self.assertEqual(self.server.stats['endpoints']['synctrans'], 1)
+
+    def test_nodes_and_injected_errors(self):
+        response = requests.get(self.server.url + '/vospace/nodes/OSSOS/dbimages/1616690')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('1616690p.fits' in response.text)
+        self.server.error_rate = 1.0
+        response = requests.get(self.server.url + '/vospace/nodes/OSSOS/dbimages/1616690')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.stats['errors'], 1)
+
+    def test_keep_alive_bodies(self):
+        # one connection: bodies left unread by a request would be taken for the next one
+        session = requests.Session()
+        node = '<vos:node xmlns:vos="http://www.ivoa.net/xml/VOSpace/v2.0" xsi:type="vos:ContainerNode"/>'
+        response = session.put(self.server.url + '/vospace/nodes/kawebb/postage_stamps', data=node)
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'vospace', 'kawebb', 'postage_stamps')))
+        response = session.delete(self.server.url + '/vospace/nodes/kawebb/missing.fits', data=node)
+        self.assertEqual(response.status_code, 404)
+        self.server.error_rate = 1.0
+        response = session.put(self.server.url + '/data/pub/vospace/kawebb/stamp.fits', data='SIMPLE')
+        self.assertEqual(response.status_code, 503)
+        self.server.error_rate = 0.0
+        response = session.get(self.server.url + '/vospace/nodes/kawebb/postage_stamps')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.stats['requests'], 4)
+
+    def test_outside_root(self):
+        # a sibling directory whose name starts with the root's is outside it too
+        sibling = self.root + 'x'
+        os.makedirs(sibling)
+        try:
+            response = requests.get(self.server.url + '/vospace/nodes/..%2F..%2F{}'.format(
+                os.path.basename(sibling)))
+            self.assertEqual(response.status_code, 400)
+        finally:
+            shutil.rmtree(sibling)
@@ -0,0 +1,62 @@
+import threading
+import time
+from unittest import TestCase
+
+from ossos_scripts import stream
+
+
+class TestStream(TestCase):
+
+    def test_stages_overlap(self):
+        active = {'fetch': 0, 'overlap': False}
+        lock = threading.Lock()
+        output = []
+
+        def fetch(item):
+            with lock:
+                active['fetch'] += 1
+            time.sleep(0.02)  # the network
+            with lock:
+                active['fetch'] -= 1
+            if item == 3:
+                raise IOError('no stamp')
+            return item
+
+        def compute(item):
+            with lock:
+                if active['fetch'] > 0:
+                    active['overlap'] = True
+            if item == 5:
+                return stream.SKIP
+            return item * item
+
+        errors = []
+        stages = stream.run(range(10), [stream.Stage('prefetch', fetch, workers=4),
+                                        stream.Stage('photometry', compute, queue_size=2),
+                                        stream.Stage('output', output.append)],
+                            on_error=lambda stage, item, error: errors.append((stage.name, item)), depth=3)
+
+        self.assertEqual(sorted(output), [0, 1, 4, 16, 36, 49, 64, 81])
+        self.assertEqual(errors, [('prefetch', 3)])
+        self.assertTrue(active['overlap'])
+        self.assertEqual([stage.stats['items'] for stage in stages], [9, 9, 8])
+        self.assertEqual(stages[0].stats['errors'], 1)
+        self.assertTrue('prefetch' in stream.report(stages))
+
+    def test_bounded(self):
+        # a slow last stage holds everything before it back to the queue lengths
+        fetched = []
+
+        def slow(item):
+            time.sleep(0.05)
+
+        def run():
+            stream.run(range(20), [stream.Stage('prefetch', fetched.append),
+                                   stream.Stage('output', slow)], depth=2)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        time.sleep(0.12)
+        self.assertTrue(len(fetched) <= 8)
+        thread.join()
+        self.assertEqual(len(fetched), 20)
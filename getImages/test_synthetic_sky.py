@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+import numpy as np
+
+import synthetic_sky
+from ossos_scripts import wcs
+
+
+def _spec(coma=False, tail=False):
+    return {'index': 0, 'seed': 7, 'expnum': '1700000p', 'mjd': 57000.5, 'size': 200, 'star_density': 0.0,
+            'fwhm': 0.7, 'sky': 100.0, 'read_noise': 1.0, 'exptime': 287.0, 'zeropoint': 26.0,
+            'object': {'name': 'S00000', 'mag': 16.0, 'ra_rate': 40.0, 'dec_rate': 0.0, 'ra': 150.0, 'dec': 10.0,
+                       'coma': coma, 'tail': tail}}
+
+
+class TestSyntheticSky(TestCase):
+
+    def test_add_source_flux(self):
+        data = np.zeros((300, 300))
+        synthetic_sky.add_source(data, 150.0, 150.0, 1000.0, 2.0, trail=(20.0, 5.0), coma=0.3, tail=(10.0, 1.0))
+        self.assertAlmostEqual(data.sum(), 1000.0, delta=20.0)
+
+    def test_render_stamp(self):
+        hdu, truth, stars = synthetic_sky.render_stamp(_spec(coma=True))
+        self.assertEqual(hdu.data.shape, (200, 200))
+        self.assertEqual(stars, [])
+        # the trail runs along x, so the peak sits on the injected row within the trail
+        row, column = np.unravel_index(np.argmax(hdu.data), hdu.data.shape)
+        self.assertAlmostEqual(row + 1, truth['y'], delta=2)
+        self.assertTrue(abs(column + 1 - truth['x']) <= truth['trail_px'] / 2 + 2)
+        x, y = wcs.WCS(hdu.header).sky2xy(truth['RA'], truth['DEC'])
+        self.assertAlmostEqual(x, truth['x'], places=3)
+        self.assertEqual(hdu.header['PHOTZP'], 26.0)
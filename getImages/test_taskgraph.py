@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from ossos_scripts import taskgraph
+
+
+class TestTaskGraph(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state = taskgraph.StateDB(os.path.join(self.directory, 'state.sqlite'))
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.directory)
+
+    def work(self, name, output=None, fail=False):
+        with self.lock:
+            self.calls.append(name)
+        if fail:
+            raise ValueError(name)
+        if output is not None:
+            with open(output, 'w') as outfile:
+                outfile.write(name)
+        return name
+
+    def graph(self, fail=()):
+        # images -> two stamps -> photometry of each
+        images = os.path.join(self.directory, 'images.txt')
+        graph = taskgraph.TaskGraph(self.state, workers=3)
+        graph.add(taskgraph.Task('images', self.work, ('images', images), outputs=[images]))
+        for expnum in ['1', '2']:
+            stamp = os.path.join(self.directory, '{}.fits'.format(expnum))
+            graph.add(taskgraph.Task('stamp:' + expnum, self.work, ('stamp:' + expnum, stamp),
+                                     requires=['images'], outputs=[stamp]))
+            graph.add(taskgraph.Task('photometry:' + expnum, self.work, ('photometry:' + expnum,),
+                                     {'fail': 'photometry:' + expnum in fail}, requires=['stamp:' + expnum]))
+        return graph
+
+    def test_order_and_resume(self):
+        counts = self.graph(fail=['photometry:2']).run()
+        self.assertEqual(counts[taskgraph.DONE], 4)
+        self.assertEqual(counts[taskgraph.FAILED], 1)
+        self.assertEqual(self.calls[0], 'images')
+        self.assertTrue(self.calls.index('stamp:1') < self.calls.index('photometry:1'))
+        self.assertEqual(self.state.result('photometry:1'), 'photometry:1')
+        self.assertEqual(self.state.status('photometry:2'), taskgraph.FAILED)
+
+        # only the failure is run again
+        self.calls = []
+        counts = self.graph().run()
+        self.assertEqual(self.calls, ['photometry:2'])
+        self.assertEqual(counts['skipped'], 4)
+        self.assertEqual(counts[taskgraph.DONE], 1)
+
+        # a lost stamp is cut out again, and its photometry redone
+        self.calls = []
+        os.unlink(os.path.join(self.directory, '1.fits'))
+        self.graph().run()
+        self.assertEqual(sorted(self.calls), ['photometry:1', 'stamp:1'])
+
+    def test_pending(self):
+        self.assertEqual(self.graph().pending()[0], 'images')
+        self.graph(fail=['photometry:1']).run()
+        graph = self.graph()
+        self.assertEqual(graph.pending(), ['photometry:1'])
+        self.assertEqual(len(graph.pending(force=True)), 5)
+        self.assertEqual(graph.execute('photometry:1'), taskgraph.DONE)
+        self.assertEqual(graph.pending(), [])
+
+    def test_failure_blocks_dependents(self):
+        graph = taskgraph.TaskGraph(self.state)
+        graph.add(taskgraph.Task('images', self.work, ('images',), {'fail': True}))
+        graph.add(taskgraph.Task('stamp', self.work, ('stamp',), requires=['images']))
+        counts = graph.run()
+        self.assertEqual(counts[taskgraph.BLOCKED], 1)
+        self.assertEqual(self.calls, ['images'])
+
+    def test_nothing_returned_is_failure(self):
+        # e.g. cutout, which prints a warning and returns None when there is no stamp to cut
+        graph = taskgraph.TaskGraph(self.state)
+        graph.add(taskgraph.Task('stamp', lambda: None))
+        graph.add(taskgraph.Task('photometry', self.work, ('photometry',), requires=['stamp']))
+        counts = graph.run()
+        self.assertEqual(counts[taskgraph.FAILED], 1)
+        self.assertEqual(counts[taskgraph.BLOCKED], 1)
+        self.assertEqual(self.state.status('stamp'), taskgraph.FAILED)
+        self.assertEqual(self.calls, [])
+
+    def test_existing_outputs_are_adopted(self):
+        images = os.path.join(self.directory, 'images.txt')
+        with open(images, 'w') as outfile:
+            outfile.write('from before the state database')
+        graph = taskgraph.TaskGraph(self.state)
+        graph.add(taskgraph.Task('images', self.work, ('images', images), outputs=[images]))
+        self.assertEqual(graph.run()['skipped'], 1)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.state.status('images'), taskgraph.DONE)
+
+    def test_cycle(self):
+        graph = taskgraph.TaskGraph(self.state)
+        graph.add(taskgraph.Task('a', self.work, ('a',), requires=['b']))
+        graph.add(taskgraph.Task('b', self.work, ('b',), requires=['a']))
+        self.assertRaises(ValueError, graph.run)
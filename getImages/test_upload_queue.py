@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+from unittest import TestCase
+
+from ossos_scripts import upload_queue
+
+
+class BrokenJournalQueue(upload_queue.UploadQueue):
+    # the journal can no longer be written once the upload is queued
+    def _upload(self, upload_id, source, dest):
+        raise IOError('No space left on device')
+
+
+class TestUploadQueue(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmp_dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unfinished(self):
+        source = os.path.join(self.tmp_dir, 'stamp.fits')
+        open(source, 'w').close()
+        with open(self.journal, 'w') as fobj:
+            for entry in [{'op': upload_queue.ADD, 'id': 'a', 'source': source, 'dest': 'vos:test/a.fits'},
+                          {'op': upload_queue.ADD, 'id': 'b', 'source': source, 'dest': 'vos:test/b.fits'},
+                          {'op': upload_queue.DONE, 'id': 'a'}]:
+                fobj.write(json.dumps(entry) + '\n')
+            fobj.write('{"op": "add", "id": "c"')  # cut short by a crash
+        queue = upload_queue.UploadQueue(journal=self.journal, workers=0)
+        self.assertEqual(queue.unfinished(), [('b', source, 'vos:test/b.fits')])
+        queue.compact()
+        self.assertEqual(len(open(self.journal).readlines()), 1)
+        self.assertEqual(queue.unfinished(), [('b', source, 'vos:test/b.fits')])
+
+    def test_recover_dead_journals(self):
+        source = os.path.join(self.tmp_dir, 'stamp.fits')
+        open(source, 'w').close()
+        dead = os.path.join(self.tmp_dir, '{}.1.journal'.format(socket.gethostname()))
+        with open(dead, 'w') as fobj:
+            fobj.write(json.dumps({'op': upload_queue.ADD, 'id': 'a', 'source': source, 'dest': 'vos:test/a.fits'}))
+        # a running process holds the lock of its journal, which is left alone
+        alive = upload_queue.UploadQueue(journal=os.path.join(self.tmp_dir, '{}.2.journal'.format(
+            socket.gethostname())), workers=0)
+        alive.submit(source, 'vos:test/b.fits')
+        queue = upload_queue.UploadQueue(journal=os.path.join(self.tmp_dir, '{}.3.journal'.format(
+            socket.gethostname())), workers=0)
+        self.assertEqual(queue.recover(), 1)
+        self.assertFalse(os.path.exists(dead))
+        self.assertEqual([dest for upload_id, s, dest in queue.unfinished()], ['vos:test/a.fits'])
+        self.assertEqual(len(alive.unfinished()), 1)
+
+    def test_superseded(self):
+        source = os.path.join(self.tmp_dir, 'stamp.fits')
+        open(source, 'w').close()
+        queue = upload_queue.UploadQueue(journal=self.journal, workers=0)
+        first = queue.submit(source, 'vos:test/a.fits')
+        second = queue.submit(source, 'vos:test/a.fits')
+        # the stamp was cut again before its first upload started: only the second is uploaded
+        queue._upload(first, os.path.abspath(source), 'vos:test/a.fits')
+        self.assertEqual([upload_id for upload_id, s, d in queue.unfinished()], [second])
+        self.assertTrue(queue.is_pending(source))
+
+    def test_worker_survives_errors(self):
+        source = os.path.join(self.tmp_dir, 'stamp.fits')
+        open(source, 'w').close()
+        queue = BrokenJournalQueue(journal=self.journal, workers=1)
+        queue.submit(source, 'vos:test/a.fits')
+        queue.submit(source, 'vos:test/b.fits')
+        # both reach the one worker and flush returns instead of waiting for a thread that died
+        self.assertEqual(queue.flush(), [(os.path.abspath(source), 'vos:test/a.fits'),
+                                         (os.path.abspath(source), 'vos:test/b.fits')])
+        self.assertTrue(queue.is_pending(source))
+        self.assertEqual(len(queue.unfinished()), 2)
+        queue.close()
+
+    def test_is_pending_without_queue(self):
+        shared = upload_queue._queue
+        upload_queue._queue = None
+        try:
+            # asking does not create the shared queue, its threads and its journal
+            self.assertFalse(upload_queue.is_pending(os.path.join(self.tmp_dir, 'stamp.fits')))
+            self.assertTrue(upload_queue._queue is None)
+        finally:
+            upload_queue._queue = shared
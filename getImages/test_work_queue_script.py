@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+import benchmark_pipeline
+import standin_server
+import work_queue
+from ossos_scripts import workqueue
+
+
+class TestWorkQueueScript(TestCase):
+
+    def test_task_without_image_list(self):
+        # a worker machine has the catalogue but none of the broker's lists: all it needs comes in the payload
+        fixture_dir = tempfile.mkdtemp()
+        try:
+            benchmark_pipeline.build_fixture(fixture_dir, 2, 512, 3)
+            work = os.path.join(fixture_dir, 'work')
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                settings = {'radius': 0.01, 'aperture': 10.0, 'thresh': 5.0, 'filter': 'r', 'type': 'p'}
+                tasks = work_queue.make_tasks(benchmark_pipeline.FAMILY, 'asteroid_families/{0}/{0}_images.txt'.format(
+                    benchmark_pipeline.FAMILY), settings)
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(len(tasks), 2)
+            shutil.rmtree(os.path.join(work, 'asteroid_families'))
+
+            server = standin_server.start_in_thread(os.path.join(fixture_dir, 'standin'))
+            env = dict(os.environ)
+            env.update({'OSSOS_STANDIN': server.url,
+                        'VOSPACE_WEBSERVICE': server.url.split('://', 1)[1],
+                        'HOME': fixture_dir,
+                        'OSSOS_HEADER_CACHE': os.path.join(fixture_dir, 'header_cache'),
+                        'OSSOS_UPLOAD_JOURNAL': os.path.join(fixture_dir, 'upload_journal'),
+                        'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))})
+            env.pop('OSSOS_RECORD', None)
+            env.pop('OSSOS_REPLAY', None)
+            try:
+                process = subprocess.Popen(
+                    [sys.executable, '-c', 'import json, sys, work_queue\n'
+                                           'result = work_queue.do_task(json.loads(sys.argv[1]))\n'
+                                           'print json.dumps(result)', json.dumps(tasks[0][1])],
+                    cwd=work, env=env, stdout=subprocess.PIPE)
+                out, _ = process.communicate()
+            finally:
+                server.shutdown()
+                server.server_close()
+            self.assertEqual(process.returncode, 0)
+            self.assertFalse(os.path.exists(os.path.join(work, 'asteroid_families', benchmark_pipeline.FAMILY,
+                                                         '{}_images.txt'.format(benchmark_pipeline.FAMILY))))
+            result = json.loads(out.strip().splitlines()[-1])
+            self.assertTrue(len(result['lines']) > 0)
+            self.assertTrue(result['lines'][0].startswith(tasks[0][1]['object']))
+        finally:
+            shutil.rmtree(fixture_dir)
+
+    def test_task_without_exposure(self):
+        # the stand-in has no such exposure: nothing can be cut out and the task must not end up done
+        fixture_dir = tempfile.mkdtemp()
+        try:
+            benchmark_pipeline.build_fixture(fixture_dir, 1, 512, 3)
+            work = os.path.join(fixture_dir, 'work')
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                settings = {'radius': 0.01, 'aperture': 10.0, 'thresh': 5.0, 'filter': 'r', 'type': 'p'}
+                tasks = work_queue.make_tasks(benchmark_pipeline.FAMILY, 'asteroid_families/{0}/{0}_images.txt'.format(
+                    benchmark_pipeline.FAMILY), settings)
+            finally:
+                os.chdir(cwd)
+            expnum = tasks[0][1]['expnum'].split('p')[0]
+            shutil.rmtree(os.path.join(fixture_dir, 'standin', 'vospace', 'OSSOS', 'dbimages', expnum))
+            db = os.path.join(fixture_dir, 'queue.sqlite')
+            broker = workqueue.Broker(db, max_attempts=1)
+            broker.add(tasks[:1])
+            broker.close()
+
+            server = standin_server.start_in_thread(os.path.join(fixture_dir, 'standin'))
+            env = dict(os.environ)
+            env.update({'OSSOS_STANDIN': server.url,
+                        'VOSPACE_WEBSERVICE': server.url.split('://', 1)[1],
+                        'HOME': fixture_dir,
+                        'OSSOS_HEADER_CACHE': os.path.join(fixture_dir, 'header_cache'),
+                        'OSSOS_UPLOAD_JOURNAL': os.path.join(fixture_dir, 'upload_journal'),
+                        'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))})
+            env.pop('OSSOS_RECORD', None)
+            env.pop('OSSOS_REPLAY', None)
+            try:
+                process = subprocess.Popen(
+                    [sys.executable, '-c', 'import sys, work_queue\n'
+                                           'from ossos_scripts import workqueue\n'
+                                           'broker = workqueue.Broker(sys.argv[1], max_attempts=1)\n'
+                                           'workqueue.Worker(broker, work_queue.do_task).run()', db],
+                    cwd=work, env=env)
+                process.communicate()
+            finally:
+                server.shutdown()
+                server.server_close()
+            self.assertEqual(process.returncode, 0)
+            broker = workqueue.Broker(db, max_attempts=1)
+            try:
+                counts = broker.counts()
+                self.assertEqual(counts[workqueue.DONE], 0)
+                self.assertEqual(counts[workqueue.FAILED], 1)
+                self.assertEqual(len(broker.results(workqueue.FAILED)), 1)
+            finally:
+                broker.close()
+        finally:
+            shutil.rmtree(fixture_dir)
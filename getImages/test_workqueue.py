@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from ossos_scripts import workqueue
+
+
+class TestBroker(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.broker = workqueue.Broker(os.path.join(self.directory, 'queue.sqlite'), max_attempts=2)
+        self.broker.add([('{}:1234567p'.format(i), {'object': str(i), 'expnum': '1234567p'}) for i in range(4)])
+
+    def tearDown(self):
+        self.broker.close()
+        shutil.rmtree(self.directory)
+
+    def test_leases(self):
+        self.assertEqual(self.broker.add([('0:1234567p', {})]), 0)
+        first = self.broker.lease('a', 2)
+        second = self.broker.lease('b', 5)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 2)
+        self.assertEqual(self.broker.lease('c'), [])
+
+        self.assertTrue(self.broker.complete('a', first[0]['id'], {'lines': ['x\n']}))
+        self.assertFalse(self.broker.complete('b', first[1]['id'], None))  # not b's lease
+        self.assertTrue(self.broker.fail('a', first[1]['id'], 'Traceback\nIOError: timed out'))
+        self.assertEqual(self.broker.heartbeat('b', [task['id'] for task in second], 0.01),
+                         [task['id'] for task in second])
+
+        # b went quiet: its leases run out and the tasks go back in the queue
+        time.sleep(0.05)
+        counts = self.broker.counts()
+        self.assertEqual(counts[workqueue.QUEUED], 3)
+        self.assertEqual(counts[workqueue.DONE], 1)
+        self.assertFalse(self.broker.complete('b', second[0]['id'], None))
+
+        # second attempts, the last one allowed
+        for task in self.broker.lease('c', 10):
+            self.assertEqual(task['attempts'], 2)
+            self.broker.fail('c', task['id'], 'again')
+        counts = self.broker.counts()
+        self.assertEqual(counts[workqueue.FAILED], 3)
+        self.assertEqual(self.broker.results(), [('0:1234567p', {'object': '0', 'expnum': '1234567p'},
+                                                  {'lines': ['x\n']})])
+        self.assertEqual(self.broker.retry_failed(), 3)
+
+    def test_workers_over_tcp(self):
+        server = workqueue.BrokerServer(self.broker, host='127.0.0.1', port=0, token='secret')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = workqueue.BrokerClient('127.0.0.1', server.server_address[1], token='secret')
+
+            def handler(payload):
+                if payload['object'] == '3':
+                    raise ValueError('no stamp')
+                return {'lines': ['{} {}\n'.format(payload['object'], payload['expnum'])]}
+
+            workers = [workqueue.Worker(client, handler, name='worker{}'.format(i), heartbeat_seconds=0.01,
+                                        idle_seconds=0.01) for i in range(2)]
+            runners = [threading.Thread(target=worker.run) for worker in workers]
+            for runner in runners:
+                runner.start()
+            for runner in runners:
+                runner.join(10)
+            self.assertEqual(sum(worker.stats[workqueue.DONE] for worker in workers), 3)
+            self.assertEqual(sum(worker.stats[workqueue.FAILED] for worker in workers), 2)
+            self.assertEqual(client.counts()[workqueue.FAILED], 1)
+            self.assertEqual(sorted(result['lines'][0] for key, payload, result in self.broker.results()),
+                             ['0 1234567p\n', '1 1234567p\n', '2 1234567p\n'])
+
+            intruder = workqueue.BrokerClient('127.0.0.1', server.server_address[1], token='wrong')
+            self.assertRaises(RuntimeError, intruder.counts)
+            client.close()
+            intruder.close()
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,268 @@
+import argparse
+import os
+import signal
+import threading
+import time
+
+from find_family import find_family_members, find_by_status
+from get_images import get_image_info, read_image_list
+from get_stamps import cutout
+from sep_phot import iterate_thru_images, read_image_dates
+from ossos_scripts import cadc_session
+from ossos_scripts import stamp_index
+from ossos_scripts import upload_queue
+from ossos_scripts import workqueue
+
+'''
+Spreads the stamps and photometry of a family, or of the whole belt (family all), over several machines.
+
+    python work_queue.py broker -f all               # builds the image list, queues a task per (object, expnum)
+    python work_queue.py worker --server host:9753   # on every machine, as many as you like
+    python work_queue.py status --server host:9753
+
+The broker keeps the queue in asteroid_families/<family>/<family>_queue.sqlite, collects the photometry the workers
+send back and, once everything is done or has failed, merges it into the family output file.  Each task carries what
+it needs of the image list, so workers can start in an empty directory; they need no terminal either: they log in
+with ~/.ssl/cadcproxy.pem (or --certfile) and/or a CADC machine in ~/.netrc.  A worker that dies loses its leases
+when they time out and its tasks go to the others.  Set OSSOS_QUEUE_TOKEN (or --token) to the same secret on the
+broker and the workers if the port is reachable by others.
+'''
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+                    description='Run the stamps and photometry of a family on several machines through a work queue.')
+    parser.add_argument('mode',
+                        choices=['broker', 'worker', 'status', 'merge'],
+                        help='broker: queue and serve the tasks, worker: do them, status: counts, merge: write the output file')
+    parser.add_argument("--family", '-f',
+                        action="store",
+                        default='all',
+                        help='asteroid family, all for the whole main belt')
+    parser.add_argument("--status",
+                        action='store',
+                        default=3,
+                        help='Family status of the objects in family all, see find_family.find_by_status')
+    parser.add_argument("--db",
+                        action='store',
+                        default=None,
+                        help='Queue database, default asteroid_families/<family>/<family>_queue.sqlite')
+    parser.add_argument("--server",
+                        action='store',
+                        default=None,
+                        help='host:port of the broker; without it workers and status use the --db on this machine')
+    parser.add_argument("--port",
+                        action='store',
+                        type=int,
+                        default=workqueue.PORT,
+                        help='Port the broker listens on.')
+    parser.add_argument("--token",
+                        action='store',
+                        default=workqueue.TOKEN,
+                        help='Shared secret of the broker and its workers, default $OSSOS_QUEUE_TOKEN')
+    parser.add_argument("--threads",
+                        action='store',
+                        type=int,
+                        default=2,
+                        help='Tasks a worker runs at the same time.')
+    parser.add_argument("--lease",
+                        action='store',
+                        type=float,
+                        default=workqueue.LEASE_SECONDS,
+                        help='Seconds a task stays with a worker that stopped sending heartbeats.')
+    parser.add_argument("--certfile",
+                        action='store',
+                        default=None,
+                        help='CADC proxy certificate, default ~/.ssl/cadcproxy.pem')
+    parser.add_argument("--netrc",
+                        action='store',
+                        default=None,
+                        help='netrc file with the CADC user name and password, default ~/.netrc')
+    parser.add_argument("--filter", '-fil',
+                        action="store",
+                        default='r',
+                        choices=['r', 'u'],
+                        help="passband: default is r'")
+    parser.add_argument('--type',
+                        default='p',
+                        choices=['o', 'p', 's'],
+                        help="restrict type of image (unprocessed, reduced, calibrated)")
+    parser.add_argument("--radius", '-r',
+                        action='store',
+                        default=0.01,
+                        help='Radius (degree) of circle of cutout postage stamp.')
+    parser.add_argument("--aperture", '-ap',
+                        action='store',
+                        default=10.0,
+                        help='aperture (degree) of circle for photometry.')
+    parser.add_argument("--thresh", '-th',
+                        action='store',
+                        default=5.0,
+                        help='threshold value.')
+    parser.add_argument("--retry-failed",
+                        action='store_true',
+                        help='broker: queue the tasks that failed for good in an earlier run again')
+
+    args = parser.parse_args()
+    db = args.db or 'asteroid_families/{}/{}_queue.sqlite'.format(args.family, args.family)
+
+    if args.mode == 'broker':
+        try:
+            cadc_session.login_unattended(args.certfile, args.netrc)
+        except EnvironmentError, e:
+            print "WARNING: {}, building the image list without CADC credentials".format(e)
+        broker = workqueue.Broker(db)
+        settings = {'radius': float(args.radius), 'aperture': float(args.aperture), 'thresh': float(args.thresh),
+                    'filter': args.filter, 'type': args.type}
+        queue_family(broker, args.family, settings, args.status)
+        if args.retry_failed:
+            print "----- {} failed tasks queued again -----".format(broker.retry_failed())
+        serve(broker, args.port, args.token)
+        merge(broker, args.family, float(args.aperture), float(args.thresh))
+    elif args.mode == 'worker':
+        cadc_session.login_unattended(args.certfile, args.netrc)
+        run_workers(connect(args.server, db, args.token), args.threads, args.lease)
+    elif args.mode == 'status':
+        print_counts(connect(args.server, db, args.token).counts())
+    else:
+        merge(workqueue.Broker(db), args.family, float(args.aperture), float(args.thresh))
+
+def connect(server, db, token):
+    '''
+    The queue: the broker at server (host:port), or the database itself when there is no server
+    '''
+    if server is None:
+        return workqueue.Broker(db)
+    host, _, port = server.partition(':')
+    return workqueue.BrokerClient(host, port and int(port) or workqueue.PORT, token=token)
+
+def queue_family(broker, familyname, settings, status=3):
+    '''
+    Queue a task per (object, expnum) of the family's image list, making the lists first if need be
+    '''
+    family_dir = 'asteroid_families/{}'.format(familyname)
+    if not os.path.exists('{}/{}_family.txt'.format(family_dir, familyname)):
+        if familyname == 'all':
+            find_by_status(status)
+        else:
+            find_family_members(familyname)
+    image_list_path = '{}/{}_images.txt'.format(family_dir, familyname)
+    if not os.path.exists(image_list_path):
+        get_image_info(familyname, settings['filter'], settings['type'])
+
+    tasks = make_tasks(familyname, image_list_path, settings)
+    print "----- {} new tasks queued of {} in {} -----".format(broker.add(tasks), len(tasks), image_list_path)
+    print_counts(broker.counts())
+
+def make_tasks(familyname, image_list_path, settings):
+    '''
+    (key, payload) of each row of the image list. The payload has all the worker needs from the list, the dates of
+    every image of the object included, so workers do not need a copy of it
+    '''
+    dates = read_image_dates(image_list_path)
+    tasks = []
+    for objectname, expnum, ra, dec, ext in read_image_list(image_list_path):
+        payload = dict(settings, family=familyname, object=objectname, expnum=expnum, ra=ra, dec=dec, ext=ext,
+                       dates=dates[objectname])
+        tasks.append(('{}:{}:{:8f}:{:8f}'.format(objectname, expnum, ra, dec), payload))
+    return tasks
+
+def serve(broker, port, token, interval=30.0):
+    '''
+    Serve the queue until nothing is queued or leased any more
+    '''
+    server = workqueue.BrokerServer(broker, port=port, token=token)
+    thread = threading.Thread(target=server.serve_forever, name='broker')
+    thread.daemon = True
+    thread.start()
+    print "----- Broker listening on port {} -----".format(server.server_address[1])
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    try:
+        while not stopped.is_set():
+            counts = broker.counts()
+            if counts[workqueue.QUEUED] == 0 and counts[workqueue.LEASED] == 0:
+                break
+            print_counts(counts)
+            stopped.wait(interval)
+    except KeyboardInterrupt:
+        print "Stopping, the queue is kept for the next run"
+    server.shutdown()
+    server.server_close()
+    print_counts(broker.counts())
+
+def do_task(payload):
+    '''
+    Cut out the stamp if it does not exist yet and do its photometry, return the output lines. Raises if either
+    fails, so the worker gives the task back and it is tried again, up to the broker's max_attempts
+    '''
+    vos_dir = 'vos:kawebb/postage_stamps/{}'.format(payload['family'])
+    postage_stamp_filename = '{}_{}_{:8f}_{:8f}.fits'.format(payload['object'], payload['expnum'], payload['ra'],
+                                                             payload['dec'])
+    if not stamp_index.get_index(vos_dir).exists(postage_stamp_filename):
+        if cutout(payload['object'], payload['expnum'], payload['ra'], payload['dec'], payload['radius'], None, None,
+                  payload['family'], ext=payload['ext']) is None:
+            raise IOError('No stamp of {} on {} could be cut out'.format(payload['object'], payload['expnum']))
+    lines = []
+    if iterate_thru_images(payload['family'], payload['object'], payload['expnum'], None, None, payload['aperture'],
+                           payload['thresh'], payload['filter'], payload['type'], results=lines,
+                           dates=payload['dates']) is None:
+        raise RuntimeError('Photometry of {} on {} failed'.format(payload['object'], payload['expnum']))
+    if len(lines) == 0:
+        raise RuntimeError('Photometry of {} on {} found no source'.format(payload['object'], payload['expnum']))
+    return {'lines': lines}
+
+def run_workers(queue, threads=2, lease_seconds=workqueue.LEASE_SECONDS):
+    '''
+    Work through the queue on a number of threads until it is empty
+    '''
+    workers = [workqueue.Worker(queue, do_task, lease_seconds=lease_seconds,
+                                heartbeat_seconds=min(workqueue.HEARTBEAT_SECONDS, lease_seconds / 3))
+               for i in range(threads)]
+    for i, worker in enumerate(workers):
+        worker.name = '{}-{}'.format(worker.name, i)
+    runners = [threading.Thread(target=worker.run, name=worker.name) for worker in workers]
+    for runner in runners:
+        runner.daemon = True
+        runner.start()
+    try:
+        while any(runner.is_alive() for runner in runners):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print "Stopping after the tasks in hand"
+        for worker in workers:
+            worker.stop()
+        for runner in runners:
+            runner.join()
+    failed = upload_queue.flush()
+    if len(failed) > 0:
+        print "WARNING: {} stamps were not uploaded, they are retried on the next run".format(len(failed))
+    for worker in workers:
+        print "{}: {}".format(worker.name, ', '.join('{} {}'.format(n, s) for s, n in sorted(worker.stats.items())))
+
+def merge(broker, familyname, aperture, thresh):
+    '''
+    Write the photometry the workers sent back to the family output file, the way do_all writes it
+    '''
+    out_filename = '{}_r{}_t{}_output.txt'.format(familyname, aperture, thresh)
+    stamps_dir = 'asteroid_families/{}/{}_stamps'.format(familyname, familyname)
+    if not os.path.isdir(stamps_dir):
+        os.makedirs(stamps_dir)
+    results = broker.results()
+    with open('{}/{}'.format(stamps_dir, out_filename), 'w') as outfile:
+        outfile.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format('Object', "Image", 'flux', 'mag', 'RA', 'DEC', 'ecc', 'index'))
+        for key, payload, result in results:
+            if result is not None:
+                outfile.writelines(result['lines'])
+    failed = broker.results(workqueue.FAILED)
+    print "----- Merged {} results into {}/{}, {} tasks failed -----".format(len(results), stamps_dir, out_filename,
+                                                                           len(failed))
+    for key, payload, error in failed:
+        print "  {}: {}".format(key, (error or '').strip().split('\n')[-1])
+
+def print_counts(counts):
+    print "  {}".format(', '.join('{} {}'.format(counts[status], status) for status in workqueue.STATUSES))
+
+if __name__ == '__main__':
+    main()